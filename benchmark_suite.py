@@ -0,0 +1,230 @@
+import gc
+import json
+import os
+import sys
+import time
+
+import c_generation
+import crossplatform_ir_generation
+import lowering
+import optimization
+import parsing
+import program_generation
+import tokenization
+
+# Usage:
+#     python benchmark_suite.py                      compares against the baseline
+#     python benchmark_suite.py --update-baseline    records a new baseline
+#     python benchmark_suite.py --threshold=0.5      fails only below half the baseline
+#     python benchmark_suite.py closures nesting     runs only some shapes
+#
+# Compiles a program of each shape in program_generation.py at a small and a
+# large size, timing each stage, and reports the throughput of each stage in
+# KB of source per second. A pass which has gone quadratic shows up as its
+# throughput at the large size falling behind the small one.
+#
+# How fast a machine runs varies from one second to the next, by as much as
+# the regressions we're looking for, so each stage is also timed against a
+# fixed reference loop run just before it. The baseline in BASELINE_PATH
+# holds KB of source per run of the reference loop, and the suite exits with
+# status 1 if any stage falls more than the threshold (by default 40%) below
+# it. Noise only ever makes a stage slower, so the baseline is the best of
+# RUNS runs, and a shape with a stage below the threshold is run again, up to
+# RUNS times in all, keeping the best, before it counts as regressed.
+# Baselines still differ between machines and Python versions, so record
+# one where the comparison runs. Nothing here touches the network or the
+# compile cache.
+
+# Go to the directory of the current file so we know where we are in the filesystem
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+BASELINE_PATH = 'benchmark_baseline.json'
+DEFAULT_THRESHOLD = 0.4
+
+# Each stage is timed this many times and the fastest time is kept, since
+# anything slower is noise from the rest of the machine. The garbage
+# collector is off while timing, since when it runs depends on everything
+# allocated before, not just on the stage.
+REPEATS = 7
+
+STAGES = (
+    ('tokenize', tokenization.tokenize),
+    ('parse', parsing.parse_memoized),
+    ('lower', lowering.lower),
+    ('generate', crossplatform_ir_generation.generate),
+    ('optimize', optimization.optimize),
+    ('c', c_generation.generate),
+)
+
+# Shape, small size, large size, and the last stage the compiler supports for
+# that shape; C generation can't generate list and structure instructions yet
+SUITE = (
+    ('closures', 200, 2000, 'c'),
+    ('functions', 200, 2000, 'c'),
+    ('lists', 2000, 20000, 'optimize'),
+    ('nesting', 200, 2000, 'c'),
+    ('operators', 2000, 20000, 'c'),
+    ('structures', 2000, 20000, 'optimize'),
+)
+
+RUNS = 3
+
+REFERENCE_ITERATIONS = 100000
+
+def reference_loop(iterations):
+    total = 0
+
+    for i in range(iterations):
+        total += i * i % 7
+
+    return total
+
+def timed_without_gc(function, argument):
+    gc.collect()
+    gc.disable()
+
+    try:
+        start = time.perf_counter()
+        result = function(argument)
+        return time.perf_counter() - start, result
+    finally:
+        gc.enable()
+
+# Returns the fastest time of the function and of the reference loop
+def fastest(function, argument):
+    best = None
+    best_reference = None
+
+    for _ in range(REPEATS):
+        reference, _ = timed_without_gc(reference_loop, REFERENCE_ITERATIONS)
+        elapsed, result = timed_without_gc(function, argument)
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+        if best_reference is None or reference < best_reference:
+            best_reference = reference
+
+    return best, best_reference, result
+
+# Returns the throughput of each stage in KB of source per second, and in KB
+# of source per run of the reference loop, keyed by 'shape/size/stage'
+def run_suite(shapes):
+    throughputs = {}
+    relative_throughputs = {}
+
+    for shape, small_size, large_size, last_stage in SUITE:
+        if shape not in shapes:
+            continue
+
+        for size in (small_size, large_size):
+            source = program_generation.SHAPES[shape](size)
+            kilobytes = len(source.encode('utf-8')) / 1024
+            result = source
+
+            for stage, function in STAGES:
+                elapsed, reference, result = fastest(function, result)
+                key = '{}/{}/{}'.format(shape, size, stage)
+                throughputs[key] = kilobytes / elapsed
+                relative_throughputs[key] = kilobytes * reference / elapsed
+
+                if stage == last_stage:
+                    break
+
+    return throughputs, relative_throughputs
+
+def best_throughputs(throughputs, relative_throughputs, shapes):
+    new_throughputs, new_relative_throughputs = run_suite(shapes)
+
+    for key, relative_throughput in new_relative_throughputs.items():
+        if relative_throughput > relative_throughputs[key]:
+            throughputs[key] = new_throughputs[key]
+            relative_throughputs[key] = relative_throughput
+
+def regressed_shapes(relative_throughputs, baseline, threshold):
+    return sorted(set(
+        key.split('/')[0]
+        for key, relative_throughput in relative_throughputs.items()
+        if key in baseline and relative_throughput < baseline[key] * (1 - threshold)
+    ))
+
+def read_baseline():
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+
+    with open(BASELINE_PATH, 'r') as f:
+        return json.load(f)
+
+def write_baseline(throughputs):
+    with open(BASELINE_PATH, 'w') as f:
+        json.dump(throughputs, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+def main(arguments):
+    flags = [argument for argument in arguments if argument.startswith('--')]
+    shapes = [argument for argument in arguments if not argument.startswith('--')]
+    shapes = shapes or [shape for shape, _, _, _ in SUITE]
+
+    for shape in shapes:
+        if shape not in program_generation.SHAPES:
+            raise Exception('Unknown shape "{}"'.format(shape))
+
+    threshold = DEFAULT_THRESHOLD
+
+    for flag in flags:
+        if flag.startswith('--threshold='):
+            threshold = float(flag[len('--threshold='):])
+
+    update_baseline = '--update-baseline' in flags
+    throughputs, relative_throughputs = run_suite(shapes)
+    baseline = read_baseline()
+
+    for _ in range(RUNS - 1):
+        if update_baseline:
+            best_throughputs(throughputs, relative_throughputs, shapes)
+        else:
+            rerun_shapes = regressed_shapes(relative_throughputs, baseline, threshold)
+
+            if not rerun_shapes:
+                break
+
+            best_throughputs(throughputs, relative_throughputs, rerun_shapes)
+
+    regressions = 0
+
+    print('{:>34} {:>12} {:>12} {:>12} {:>8}'.format('stage', 'KB/s', 'KB/ref', 'baseline', 'change'))
+
+    for key, throughput in throughputs.items():
+        relative_throughput = relative_throughputs[key]
+
+        if key in baseline:
+            change = relative_throughput / baseline[key] - 1
+            regressed = change < -threshold
+            regressions += regressed
+
+            print('{:>34} {:>12.1f} {:>12.3f} {:>12.3f} {:>+7.0%}{}'.format(
+                key,
+                throughput,
+                relative_throughput,
+                baseline[key],
+                change,
+                '  REGRESSED' if regressed else '',
+            ))
+        else:
+            print('{:>34} {:>12.1f} {:>12.3f} {:>12}'.format(key, throughput, relative_throughput, '-'))
+
+    if update_baseline:
+        # Keep the baseline of shapes which weren't run
+        baseline.update(relative_throughputs)
+        write_baseline(baseline)
+        print('Wrote {}'.format(BASELINE_PATH))
+        return 0
+
+    if regressions:
+        print('{} stages regressed more than {:.0%}'.format(regressions, threshold))
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
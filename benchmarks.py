@@ -0,0 +1,358 @@
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import conversion
+import c_generation
+import compilation
+import crossplatform_ir_generation
+import desugaring
+import lowering
+import normalization
+import optimization
+import parsing
+import program_generation
+import serialization
+import tokenization
+
+# Go to the directory of the current file so we know where we are in the filesystem
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+KILOBYTE = 1024
+MEGABYTE = 1024 * KILOBYTE
+
+def example_source():
+    sources = []
+
+    for entry in sorted(os.scandir('examples'), key=lambda entry: entry.name):
+        if entry.is_file() and entry.name.endswith('.fur'):
+            with open(entry.path, 'r') as f:
+                sources.append(f.read())
+
+    return '\n'.join(sources)
+
+def source_of_size(size):
+    # Repeat the examples and cut at a line boundary so we never split a token
+    base = example_source()
+    source = base * (size // len(base) + 1)
+    return source[:source.rindex('\n', 0, size) + 1]
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def traced_peak(function, *args):
+    tracemalloc.start()
+
+    try:
+        result = function(*args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak, current, result
+
+def format_size(size):
+    if size >= MEGABYTE:
+        return '{} MB'.format(size // MEGABYTE)
+    return '{} KB'.format(size // KILOBYTE)
+
+def benchmark_tokenization():
+    print('tokenization')
+    print('{:>8} {:>10} {:>12} {:>12}'.format('size', 'tokens', 'seconds', 'ns/byte'))
+
+    for size in (KILOBYTE, 10 * KILOBYTE, 100 * KILOBYTE, MEGABYTE, 10 * MEGABYTE):
+        source = source_of_size(size)
+        elapsed, tokens = timed(tokenization.tokenize, source)
+
+        print('{:>8} {:>10} {:>12.4f} {:>12.1f}'.format(
+            format_size(size),
+            len(tokens),
+            elapsed,
+            elapsed * 1e9 / len(source),
+        ))
+
+def benchmark_parsing():
+    print('parsing')
+    print('{:>8} {:>10} {:>12} {:>14}'.format('size', 'tokens', 'seconds', 'tokens/s'))
+
+    for size in (100 * KILOBYTE, MEGABYTE):
+        tokens = tokenization.tokenize(source_of_size(size))
+        elapsed, _ = timed(parsing.parse, tokens)
+
+        print('{:>8} {:>10} {:>12.4f} {:>14.0f}'.format(
+            format_size(size),
+            len(tokens),
+            elapsed,
+            len(tokens) / elapsed,
+        ))
+
+def parse_tuple(source):
+    return parsing.parse(tokenization.tokenize(source))
+
+def parse_stream(source):
+    return parsing.parse(tokenization.tokenize_stream(io.StringIO(source)))
+
+def benchmark_streaming():
+    # The retained memory is the AST, which both modes have to build; the
+    # difference between peak and retained is what the tokens cost
+    print('streaming')
+    print('{:>8} {:>8} {:>14} {:>14}'.format('size', 'mode', 'retained KB', 'peak KB'))
+
+    for size in (100 * KILOBYTE, MEGABYTE):
+        source = source_of_size(size)
+
+        for mode, function in (('tuple', parse_tuple), ('stream', parse_stream)):
+            peak, retained, _ = traced_peak(function, source)
+
+            print('{:>8} {:>8} {:>14} {:>14}'.format(
+                format_size(size),
+                mode,
+                retained // KILOBYTE,
+                peak // KILOBYTE,
+            ))
+
+def benchmark_packrat():
+    print('packrat')
+    print('{:>8} {:>8} {:>12} {:>8} {:>8}'.format('depth', 'memo', 'seconds', 'hits', 'misses'))
+
+    for memoized, depths in ((False, (4, 8, 10)), (True, (10, 20, 30))):
+        for depth in depths:
+            tokens = tokenization.tokenize('(' * depth + 'x' + ')' * depth + '\n')
+            memo = parsing.PackratMemo() if memoized else None
+            elapsed, _ = timed(parsing.parse, tokens, memo)
+
+            print('{:>8} {:>8} {:>12.4f} {:>8} {:>8}'.format(
+                depth,
+                'yes' if memoized else 'no',
+                elapsed,
+                memo.hits if memoized else '',
+                memo.misses if memoized else '',
+            ))
+
+FRONT_END_PASSES = (
+    ('parse', parsing.parse),
+    ('desugar', desugaring.desugar),
+    ('normalize', normalization.normalize),
+    ('convert', conversion.convert),
+)
+
+def benchmark_front_end():
+    print('front end')
+    print('{:>8} {:>10} {:>12} {:>14}'.format('size', 'pass', 'seconds', 'tokens/s'))
+
+    for size in (100 * KILOBYTE, MEGABYTE):
+        tokens = tokenization.tokenize(source_of_size(size))
+        result = tokens
+
+        for name, function in FRONT_END_PASSES:
+            elapsed, result = timed(function, result)
+
+            print('{:>8} {:>10} {:>12.4f} {:>14.0f}'.format(
+                format_size(size),
+                name,
+                elapsed,
+                len(tokens) / elapsed,
+            ))
+
+def benchmark_memory():
+    # Each pass starts with its input already built, so what it retains is the
+    # tree it builds. Parsing reads the source as a stream, as main.py does, so
+    # the metadata it keeps from the tokens is counted too.
+    print('memory')
+    print('{:>8} {:>10} {:>14} {:>14}'.format('size', 'pass', 'retained KB', 'peak KB'))
+
+    for size in (100 * KILOBYTE, MEGABYTE):
+        result = source_of_size(size)
+
+        for name, function in (('parse', parse_stream),) + FRONT_END_PASSES[1:]:
+            peak, retained, result = traced_peak(function, result)
+
+            print('{:>8} {:>10} {:>14} {:>14}'.format(
+                format_size(size),
+                name,
+                retained // KILOBYTE,
+                peak // KILOBYTE,
+            ))
+
+def lower_separately(program):
+    return conversion.convert(normalization.normalize(desugaring.desugar(program)))
+
+def benchmark_lowering():
+    print('lowering')
+    print('{:>8} {:>10} {:>12} {:>14}'.format('size', 'mode', 'seconds', 'peak KB'))
+
+    for size in (100 * KILOBYTE, MEGABYTE):
+        program = parsing.parse(tokenization.tokenize(source_of_size(size)))
+
+        for mode, function in (('separate', lower_separately), ('fused', lowering.lower)):
+            elapsed, _ = timed(function, program)
+            peak, _, _ = traced_peak(function, program)
+
+            print('{:>8} {:>10} {:>12.4f} {:>14}'.format(
+                format_size(size),
+                mode,
+                elapsed,
+                peak // KILOBYTE,
+            ))
+
+NESTED_SOURCES = {
+    'calls': lambda depth: 'x = ' + 'f(' * depth + '1' + ')' * depth + '\n',
+    'concatenation': lambda depth: "x = 'a'" + " ++ 'a'" * depth + '\n',
+    'functions': lambda depth: 'def f() do\n' * depth + '1\n' + 'end\nf\n' * depth,
+    'if': lambda depth: 'x = ' + 'if 1 do\n' * depth + '1\n' + 'end\n' * depth,
+    'if_else': lambda depth: 'x = ' + 'if 1 do\n' * depth + '1\n' + 'else\n2\nend\n' * depth,
+}
+
+def benchmark_nesting():
+    # Every pass runs on an explicit stack, so these depths are well past the
+    # recursion limit
+    print('nesting')
+    print('{:>14} {:>8} {:>10} {:>12}'.format('source', 'depth', 'pass', 'seconds'))
+
+    for source_name, source_of_depth in sorted(NESTED_SOURCES.items()):
+        for depth in (1000, 10000, 100000):
+            result = tokenization.tokenize(source_of_depth(depth))
+
+            for name, function in FRONT_END_PASSES:
+                elapsed, result = timed(function, result)
+
+                print('{:>14} {:>8} {:>10} {:>12.4f}'.format(source_name, depth, name, elapsed))
+
+def benchmark_cir_generation():
+    # Nested ifs and closures used to copy every instruction once per level
+    print('cir generation')
+    print('{:>14} {:>8} {:>14} {:>12}'.format('source', 'depth', 'instructions', 'seconds'))
+
+    for source_name in ('functions', 'if_else'):
+        for depth in (1000, 10000, 100000):
+            converted = lowering.lower(parsing.parse(tokenization.tokenize(NESTED_SOURCES[source_name](depth))))
+            elapsed, program = timed(crossplatform_ir_generation.generate, converted)
+
+            print('{:>14} {:>8} {:>14} {:>12.4f}'.format(
+                source_name,
+                depth,
+                len(program.opcodes),
+                elapsed,
+            ))
+
+# A little of everything the CIR has, generated once and repeated to get
+# programs with millions of instructions
+CIR_SOURCE = """def add_one(x) do
+  x + 1
+end
+y = 'a'
+z = if add_one(1) < 3 do
+  add_one(2)
+else
+  -add_one(4)
+end
+print(z, y)
+"""
+
+def repeated_cir_program(instruction_count):
+    program = crossplatform_ir_generation.generate(
+        lowering.lower(parsing.parse(tokenization.tokenize(CIR_SOURCE))),
+    )
+    repeats = instruction_count // len(program.opcodes) + 1
+
+    return crossplatform_ir_generation.CIRProgram(
+        opcodes=program.opcodes * repeats,
+        arguments=program.arguments * repeats,
+        symbols=program.symbols,
+        strings=program.strings,
+        labels=program.labels,
+    )
+
+def benchmark_packed_cir():
+    # Retained memory of the packed program against the same program as a
+    # tuple of CIRLabel and CIRInstruction entries, and how long the stages
+    # after CIR generation take on the packed program
+    print('packed cir')
+    print('{:>14} {:>12} {:>12} {:>10} {:>10} {:>10}'.format(
+        'instructions', 'packed KB', 'tuples KB', 'optimize', 'output', 'c'))
+
+    for instruction_count in (100000, 1000000, 3000000):
+        _, packed_size, program = traced_peak(repeated_cir_program, instruction_count)
+        _, tuples_size, _ = traced_peak(crossplatform_ir_generation.unpack, program)
+
+        optimize_elapsed, optimized = timed(optimization.optimize, program)
+        output_elapsed, _ = timed(crossplatform_ir_generation.output, optimized)
+        c_elapsed, _ = timed(c_generation.separate_labels_and_instructions, optimized)
+
+        print('{:>14} {:>12} {:>12} {:>10.4f} {:>10.4f} {:>10.4f}'.format(
+            len(program.opcodes),
+            packed_size // KILOBYTE,
+            tuples_size // KILOBYTE,
+            optimize_elapsed,
+            output_elapsed,
+            c_elapsed,
+        ))
+
+def benchmark_furc():
+    # Reading maps the file rather than reading it, so it shouldn't take longer
+    # for more instructions
+    print('furc')
+    print('{:>14} {:>10} {:>10} {:>10}'.format('instructions', 'size KB', 'write', 'read'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'program.furc')
+
+        for instruction_count in (100000, 1000000, 3000000):
+            program = repeated_cir_program(instruction_count)
+            write_elapsed, _ = timed(serialization.write, program, path)
+            read_elapsed, _ = timed(serialization.read, path)
+
+            print('{:>14} {:>10} {:>10.4f} {:>10.4f}'.format(
+                len(program.opcodes),
+                os.path.getsize(path) // KILOBYTE,
+                write_elapsed,
+                read_elapsed,
+            ))
+
+def benchmark_incremental():
+    # Edits one function of many and generates the CIR again, against
+    # generating it from scratch
+    print('incremental')
+    print('{:>10} {:>12} {:>12} {:>12}'.format('functions', 'full', 'cold cache', 'one edited'))
+
+    for function_count in (100, 1000, 10000):
+        source = program_generation.functions(function_count)
+        edited_source = program_generation.functions(function_count, edited=function_count // 2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = compilation.CompileCache(directory)
+
+            full_elapsed, _ = timed(compilation.generate_cir, edited_source)
+            cold_elapsed, _ = timed(compilation.generate_cir_incrementally, source, cache)
+            edited_elapsed, _ = timed(compilation.generate_cir_incrementally, edited_source, cache)
+
+        print('{:>10} {:>12.4f} {:>12.4f} {:>12.4f}'.format(
+            function_count,
+            full_elapsed,
+            cold_elapsed,
+            edited_elapsed,
+        ))
+
+BENCHMARKS = {
+    'cir_generation': benchmark_cir_generation,
+    'front_end': benchmark_front_end,
+    'furc': benchmark_furc,
+    'incremental': benchmark_incremental,
+    'lowering': benchmark_lowering,
+    'memory': benchmark_memory,
+    'nesting': benchmark_nesting,
+    'packed_cir': benchmark_packed_cir,
+    'packrat': benchmark_packrat,
+    'parsing': benchmark_parsing,
+    'streaming': benchmark_streaming,
+    'tokenization': benchmark_tokenization,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -6,88 +6,131 @@ import crossplatform_ir_generation
 
 TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 
-def separate_labels_and_instructions(entry_list):
-    labels_to_instruction_indices = {}
-    instruction_list = []
-
-    for entry in entry_list:
-        if isinstance(entry, crossplatform_ir_generation.CIRInstruction):
-            instruction_list.append(entry)
-        elif isinstance(entry, crossplatform_ir_generation.CIRLabel):
-            labels_to_instruction_indices[entry.label] = len(instruction_list)
+# The runtime which generated programs are built on
+TEMPLATE_NAME = 'program2.c'
 
-    return labels_to_instruction_indices, tuple(instruction_list)
+# The generate_*_argument functions take the program as well as the argument,
+# because symbol, string and label arguments are indices into its tables, and
+# return an initializer for the instruction's Argument union
 
-def generate_integer_argument(argument):
-    assert isinstance(argument, int)
-    return '(int32_t){}'.format(argument)
+def generate_integer_argument(program, argument):
+    return '(Argument)(int32_t){}'.format(argument)
 
-def generate_label_argument(argument):
-    return 'LABEL_{}'.format(argument)
+def generate_label_argument(program, argument):
+    return '(Argument)LABEL_{}'.format(program.labels[argument])
 
-def generate_null_argument(argument):
-    assert argument is None
-    return 'NULL'
+def generate_null_argument(program, argument):
+    assert argument == 0
+    return '(Argument)NULL'
 
 def generate_null_argument_from(argument_count):
-    def generator(argument):
-        assert isinstance(argument, int)
+    def generator(program, argument):
         assert argument == argument_count
-        return 'NULL'
+        return '(Argument)NULL'
     return generator
 
-def generate_size_t_argument(argument):
-    assert isinstance(argument, int)
-    return '(size_t){}'.format(argument)
-
-def generate_string_argument(argument):
-    return argument
-
-def generate_symbol_argument(argument):
-    assert argument.startswith('sym(') and argument.endswith(')')
-    return '"{}"'.format(argument[4:-1])
-
-def generate_argument(instruction):
-    try:
-        return {
-            'add': generate_null_argument_from(2),
-            'call': generate_size_t_argument,
-            'close': generate_label_argument,
-            'drop': generate_null_argument,
-            'end': generate_null_argument,
-            'eq': generate_null_argument_from(2),
-            'gt': generate_null_argument_from(2),
-            'gte': generate_null_argument_from(2),
-            'idiv': generate_null_argument_from(2),
-            'jump': generate_label_argument,
-            'jump_if_false': generate_label_argument,
-            'lt': generate_null_argument_from(2),
-            'lte': generate_null_argument_from(2),
-            'mod': generate_null_argument_from(2),
-            'mul': generate_null_argument_from(2),
-            'neg': generate_null_argument_from(1),
-            'neq': generate_null_argument_from(2),
-            'pop': generate_symbol_argument,
-            'push': generate_symbol_argument,
-            'push_integer': generate_integer_argument,
-            'push_string': generate_string_argument,
-            'return': generate_null_argument,
-            'sub': generate_null_argument_from(2),
-        }[instruction.instruction](instruction.argument)
-
-    except KeyError:
-        import ipdb; ipdb.set_trace()
+def generate_size_t_argument(program, argument):
+    return '(Argument)(size_t){}'.format(argument)
+
+def generate_string_argument(program, argument):
+    return '(Argument)"{}"'.format(program.strings[argument])
+
+def generate_symbol_argument(program, argument):
+    return '(Argument)"{}"'.format(program.symbols[argument])
+
+# A symbol and an integer go in a structure in the union, which can only be
+# initialized with braces: as a compound literal, like the other arguments,
+# it wouldn't be a constant that the program array could be initialized with
+def generate_symbol_and_integer_argument(program, argument):
+    symbol, integer = crossplatform_ir_generation.unpack_symbol_and_integer(argument)
+    return '{{ .symbolAndInteger = {{ "{}", (int32_t){} }} }}'.format(program.symbols[symbol], integer)
+
+_ARGUMENT_GENERATORS = {
+    'add': generate_null_argument_from(2),
+    'add_symbol_integer': generate_symbol_and_integer_argument,
+    'call': generate_size_t_argument,
+    'call_symbol': generate_symbol_and_integer_argument,
+    'close': generate_label_argument,
+    'drop': generate_null_argument,
+    'dup': generate_null_argument,
+    'end': generate_null_argument,
+    'eq': generate_null_argument_from(2),
+    'eq_jump_if_false': generate_label_argument,
+    'gt': generate_null_argument_from(2),
+    'gt_jump_if_false': generate_label_argument,
+    'gte': generate_null_argument_from(2),
+    'gte_jump_if_false': generate_label_argument,
+    'idiv': generate_null_argument_from(2),
+    'idiv_symbol_integer': generate_symbol_and_integer_argument,
+    'jump': generate_label_argument,
+    'jump_if_false': generate_label_argument,
+    'lt': generate_null_argument_from(2),
+    'lt_jump_if_false': generate_label_argument,
+    'lte': generate_null_argument_from(2),
+    'lte_jump_if_false': generate_label_argument,
+    'mod': generate_null_argument_from(2),
+    'mod_symbol_integer': generate_symbol_and_integer_argument,
+    'mul': generate_null_argument_from(2),
+    'mul_symbol_integer': generate_symbol_and_integer_argument,
+    'neg': generate_null_argument_from(1),
+    'neq': generate_null_argument_from(2),
+    'neq_jump_if_false': generate_label_argument,
+    'pop': generate_symbol_argument,
+    'push': generate_symbol_argument,
+    'push_integer': generate_integer_argument,
+    'push_string': generate_string_argument,
+    'return': generate_null_argument,
+    'rot': generate_null_argument,
+    'sub': generate_null_argument_from(2),
+    'sub_symbol_integer': generate_symbol_and_integer_argument,
+    'swap': generate_null_argument,
+}
+
+# Indexed by opcode, with None for the opcodes we can't generate yet
+_ARGUMENT_GENERATORS_BY_OPCODE = tuple(
+    _ARGUMENT_GENERATORS.get(name)
+    for name in crossplatform_ir_generation.OPCODES
+)
+
+def generate_argument(program, opcode, argument):
+    generator = _ARGUMENT_GENERATORS_BY_OPCODE[opcode]
+
+    if generator is None:
+        raise Exception('C generation does not support the "{}" instruction yet'.format(
+            crossplatform_ir_generation.OPCODES[opcode],
+        ))
+
+    return generator(program, argument)
+
+def separate_labels_and_instructions(program):
+    labels_to_instruction_indices = {}
+    instruction_list = []
+
+    for opcode, argument in zip(program.opcodes, program.arguments):
+        if opcode == crossplatform_ir_generation.LABEL:
+            labels_to_instruction_indices[program.labels[argument]] = len(instruction_list)
+        else:
+            instruction_list.append((
+                crossplatform_ir_generation.OPCODES[opcode],
+                generate_argument(program, opcode, argument),
+            ))
+
+    return labels_to_instruction_indices, tuple(instruction_list)
+
+# One environment for the process, so that the template is only compiled
+# once however many programs we generate. The environment's loader checks
+# whether the template file has changed each time we get it.
+_ENVIRONMENT = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_PATH))
+
+def get_template():
+    return _ENVIRONMENT.get_template(TEMPLATE_NAME)
 
 def generate(ir):
-    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATE_PATH))
-    template = environment.get_template('program2.c')
+    template = get_template()
 
-    labels_to_instruction_indices, instruction_list = separate_labels_and_instructions(
-        ir.entry_list,
-    )
+    labels_to_instruction_indices, instruction_list = separate_labels_and_instructions(ir)
 
     return template.render(
         labels_to_instruction_indices=labels_to_instruction_indices,
         instruction_list=instruction_list,
-        generate_argument=generate_argument,
     )
@@ -0,0 +1,588 @@
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import c_generation
+import conversion
+import crossplatform_ir_generation
+import desugaring
+import lowering
+import normalization
+import optimization
+import parsing
+import serialization
+import tokenization
+import util
+
+# Compiles Fur source to C, keeping what each stage produces in an on-disk
+# cache so that compiling an unchanged file again does no work. Entries are
+# named by a hash of everything the stage's result depends on:
+#
+#     function   the CIR block of a top level function definition, as a
+#                .furc file; the tokens of the definition and the compiler
+#     cir        the optimized CIR, as a .furc file; the source and compiler
+#     listing    the text of the optimized CIR; the source and compiler
+#     c          the generated C; the source, compiler and templates
+#
+# The compiler is identified by the contents of its modules, so editing the
+# compiler invalidates every entry without anyone having to bump a version.
+# After a template change the C is regenerated from the cached CIR. After a
+# source change, only the functions that changed and __main__ go through
+# the front end again (see generate_cir_incrementally).
+
+# Every module the cached stages run, including the ones they only import,
+# and this one, which generates CIR a function at a time
+COMPILER_MODULES = (
+    c_generation,
+    sys.modules[__name__],
+    conversion,
+    crossplatform_ir_generation,
+    desugaring,
+    lowering,
+    normalization,
+    optimization,
+    parsing,
+    serialization,
+    tokenization,
+    util,
+)
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'fur')
+DEFAULT_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+def _hash_files(paths):
+    digest = hashlib.sha256()
+
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents = f.read()
+
+        # Lengths keep the boundaries between files from being ambiguous
+        digest.update(os.path.basename(path).encode('utf-8'))
+        digest.update(len(contents).to_bytes(8, 'little'))
+        digest.update(contents)
+
+    return digest.hexdigest()
+
+# Hashed once, when the compiler is imported, so that a long running process
+# keeps describing the code it's actually running
+COMPILER_VERSION = _hash_files(sorted(module.__file__ for module in COMPILER_MODULES))
+
+def compiler_version():
+    return COMPILER_VERSION
+
+def templates_version():
+    return _hash_files(sorted(
+        entry.path
+        for entry in os.scandir(c_generation.TEMPLATE_PATH)
+        if entry.is_file()
+    ))
+
+class CompileCache(object):
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_size=DEFAULT_CACHE_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = []
+        self.misses = []
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, stage, key):
+        return os.path.join(self.directory, '{}.{}'.format(key, stage))
+
+    def _lookup(self, stage, key):
+        path = self._path(stage, key)
+
+        try:
+            # The modification time is when the entry was last used, which is
+            # what eviction goes by
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses.append(stage)
+            return None
+
+        self.hits.append(stage)
+        return path
+
+    def _store(self, stage, key, write):
+        # Write somewhere else and rename, so a compiler running at the same
+        # time never sees half an entry
+        descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(descriptor)
+
+        try:
+            write(temporary_path)
+            os.replace(temporary_path, self._path(stage, key))
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def get_program(self, stage, key):
+        path = self._lookup(stage, key)
+
+        if path is None:
+            return None
+
+        return serialization.read(path)
+
+    def put_program(self, stage, key, program):
+        self._store(stage, key, lambda path: serialization.write(program, path))
+
+    def get_text(self, stage, key):
+        path = self._lookup(stage, key)
+
+        if path is None:
+            return None
+
+        with open(path, 'r') as f:
+            return f.read()
+
+    def put_text(self, stage, key, text):
+        def write(path):
+            with open(path, 'w') as f:
+                f.write(text)
+
+        self._store(stage, key, write)
+
+    def evict(self):
+        entries = []
+        size = 0
+
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            size += stat.st_size
+
+        # Least recently used first
+        entries.sort()
+
+        for _, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            size -= entry_size
+            self.evictions += 1
+
+    def report(self):
+        stages = sorted(set(self.hits + self.misses))
+
+        return 'cache: {}{}'.format(
+            ', '.join(
+                '{} {} hit {} miss'.format(stage, self.hits.count(stage), self.misses.count(stage))
+                for stage in stages
+            ),
+            ', {} evicted'.format(self.evictions) if self.evictions else '',
+        )
+
+def _key(*parts):
+    digest = hashlib.sha256()
+
+    for part in parts:
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+
+    return digest.hexdigest()
+
+def generate_cir(source):
+    # Tokens are streamed, so the parser only holds the ones it may backtrack to
+    parsed = parsing.parse_memoized(tokenization.tokenize_stream(io.StringIO(source)))
+
+    # This builds the same tree as conversion.convert(normalization.normalize(desugaring.desugar(parsed))),
+    # in one traversal
+    converted = lowering.lower(parsed)
+    del parsed
+
+    return crossplatform_ir_generation.generate(converted)
+
+_BLOCK_KEYWORDS = {'def', 'do', 'end'}
+
+# Returns where each function definition in the top level statement list
+# starts, where its body starts and where it ends, as indices into the source
+def _top_level_function_definitions(source):
+    definitions = []
+    depth = 0
+    start = None
+    body_start = None
+
+    for keyword, keyword_start, keyword_end in tokenization.scan_keywords(source, _BLOCK_KEYWORDS):
+        if keyword == 'def' and depth == 0:
+            start = keyword_start
+        elif keyword == 'do':
+            if depth == 0 and start is not None:
+                body_start = keyword_end
+
+            depth += 1
+        elif keyword == 'end':
+            depth -= 1
+
+            if depth == 0 and start is not None:
+                definitions.append((start, body_start, keyword_end))
+                start = None
+
+    return definitions
+
+def _function_key(compiler, definition):
+    # The definition's position isn't part of the key, so moving it to
+    # another line doesn't change it
+    return _key(compiler, b'function', definition.encode('utf-8'))
+
+def _stub_function_definition(source, start, body_start, end, line):
+    # Keeps the name and arguments, and replaces the body with a single
+    # statement, which is all the parser has to get through
+    header = tokenization.tokenize(source[start:body_start], start, line)
+    body_metadata = header[-1].metadata
+
+    return header + (
+        tokenization.Token('integer_literal', '1', body_metadata),
+        tokenization.Token('newline', '\n', body_metadata),
+        tokenization.Token(
+            'keyword',
+            'end',
+            tokenization.NodeMetadata(end - len('end'), line + source.count('\n', start, end)),
+        ),
+    )
+
+def _is_function_definition(statement):
+    # Function definitions are the only lambdas with names
+    return isinstance(statement, conversion.CPSVariableInitializationStatement)\
+        and isinstance(statement.expression, conversion.CPSLambdaExpression)\
+        and statement.expression.name is not None
+
+# Generates the CIR of a program, reusing the CIR of each top level function
+# definition whose text is unchanged since it was cached. The labels in a
+# function's CIR only depend on the function and its label, so the program
+# comes out the same as it would from generate_cir. Functions found in the
+# cache have their bodies stubbed out before parsing, and their cached CIR
+# is spliced in after lowering.
+def generate_cir_incrementally(source, cache):
+    compiler = compiler_version().encode('utf-8')
+
+    definitions = _top_level_function_definitions(source)
+    keys = [_function_key(compiler, source[start:end]) for start, _, end in definitions]
+    blocks = [cache.get_program('function', key) for key in keys]
+
+    # The source between the stubs is tokenized where it is in the source,
+    # so errors in it are reported on the right lines
+    tokens = []
+    previous_end = 0
+    line = 1
+
+    for (start, body_start, end), block in zip(definitions, blocks):
+        if block is not None:
+            tokens.extend(tokenization.tokenize(source[previous_end:start], previous_end, line))
+            line += source.count('\n', previous_end, start)
+
+            tokens.extend(_stub_function_definition(source, start, body_start, end, line))
+            line += source.count('\n', start, end)
+
+            previous_end = end
+
+    tokens.extend(tokenization.tokenize(source[previous_end:], previous_end, line))
+
+    converted = lowering.lower(parsing.parse_memoized(tokens))
+
+    statement_list = list(converted.statement_list)
+    definition_indices = [
+        index for index, statement in enumerate(statement_list)
+        if _is_function_definition(statement)
+    ]
+    assert len(definition_indices) == len(definitions)
+
+    for index, block in zip(definition_indices, blocks):
+        if block is not None:
+            statement_list[index] = conversion.CPSVariableInitializationStatement(
+                variable=statement_list[index].variable,
+                expression=crossplatform_ir_generation.PrecompiledLambdaExpression(
+                    name=statement_list[index].expression.name,
+                    block=block,
+                ),
+            )
+
+    unit_blocks = []
+    program = crossplatform_ir_generation.generate(
+        conversion.CPSProgram(statement_list=tuple(statement_list)),
+        unit_blocks,
+    )
+
+    blocks_by_lambda = {id(expression): block for expression, block in unit_blocks}
+
+    for index, key, block in zip(definition_indices, keys, blocks):
+        if block is None:
+            cache.put_program('function', key, blocks_by_lambda[id(statement_list[index].expression)])
+
+    return program
+
+# Both of these return the listing of the optimized CIR, which main.py
+# prints, and the C
+def compile_cir(program, counters=None):
+    optimized = optimization.optimize(program, counters)
+    return crossplatform_ir_generation.output(optimized), c_generation.generate(optimized)
+
+# Only what is optimized is counted in counters, so with a cache a program
+# whose CIR is cached counts nothing
+def compile_source(source, cache=None, counters=None):
+    if cache is None:
+        return compile_cir(generate_cir(source), counters)
+
+    compiler = compiler_version().encode('utf-8')
+    encoded_source = source.encode('utf-8')
+
+    cir_key = _key(compiler, encoded_source)
+    c_key = _key(compiler, templates_version().encode('utf-8'), encoded_source)
+
+    # Go back only as far as the deepest stage we have
+    listing = cache.get_text('listing', cir_key)
+    c = cache.get_text('c', c_key)
+
+    if listing is not None and c is not None:
+        return listing, c
+
+    optimized = cache.get_program('cir', cir_key)
+
+    if optimized is None:
+        optimized = optimization.optimize(generate_cir_incrementally(source, cache), counters)
+        cache.put_program('cir', cir_key, optimized)
+
+    if listing is None:
+        listing = crossplatform_ir_generation.output(optimized)
+        cache.put_text('listing', cir_key, listing)
+
+    if c is None:
+        c = c_generation.generate(optimized)
+        cache.put_text('c', c_key, c)
+
+    return listing, c
+
+def open_cache():
+    return CompileCache(
+        os.environ.get('FUR_CACHE_DIRECTORY', DEFAULT_CACHE_DIRECTORY),
+        int(os.environ.get('FUR_CACHE_MAX_SIZE', DEFAULT_CACHE_MAX_SIZE)),
+    )
+
+# Compiles a .fur file, or a .furc file saved with save_furc, to a .c file
+# next to it, and returns the listing of the optimized CIR
+def compile_file(source_path, cache=None, save_furc=False, counters=None):
+    if source_path.endswith('.furc'):
+        listing, generated = compile_cir(serialization.read(source_path), counters)
+
+    else:
+        if not source_path.endswith('.fur'):
+            raise Exception('Expected a .fur or .furc file, got "{}"'.format(source_path))
+
+        with open(source_path, 'r') as f:
+            source = f.read()
+
+        if save_furc:
+            crossplatform_ir = generate_cir(source)
+            serialization.write(crossplatform_ir, source_path + 'c')
+            listing, generated = compile_cir(crossplatform_ir, counters)
+
+        else:
+            listing, generated = compile_source(source, cache, counters)
+
+    with open(source_path + '.c', 'w') as f:
+        f.write(generated)
+
+    return listing
+
+def find_source_files(paths):
+    source_paths = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            source_paths.extend(sorted(
+                entry.path
+                for entry in os.scandir(path)
+                if entry.is_file() and entry.name.endswith('.fur')
+            ))
+        else:
+            source_paths.append(path)
+
+    return source_paths
+
+BatchResult = collections.namedtuple(
+    'BatchResult',
+    (
+        'source_path',
+        'error',
+        'seconds',
+    ),
+)
+
+# Each worker process keeps its cache, and the imported compiler and loaded
+# template, for every file it compiles
+_worker_cache = None
+_worker_save_furc = False
+
+def _initialize_worker(use_cache, save_furc):
+    global _worker_cache, _worker_save_furc
+
+    _worker_cache = open_cache() if use_cache else None
+    _worker_save_furc = save_furc
+    c_generation.get_template()
+
+def _compile_and_time(source_path, cache, save_furc):
+    start = time.perf_counter()
+
+    try:
+        compile_file(source_path, cache, save_furc)
+        error = None
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+
+    return BatchResult(
+        source_path=source_path,
+        error=error,
+        seconds=time.perf_counter() - start,
+    )
+
+def _compile_in_worker(source_path):
+    return _compile_and_time(source_path, _worker_cache, _worker_save_furc)
+
+# Compiles each file in a pool of worker processes, or in this process if
+# workers is 0, and yields a BatchResult for each in the order they were
+# given. Errors are reported in the results rather than raised, so one bad
+# file doesn't stop the batch.
+def compile_files(source_paths, workers=None, use_cache=True, save_furc=False):
+    if workers == 0:
+        cache = open_cache() if use_cache else None
+
+        for source_path in source_paths:
+            yield _compile_and_time(source_path, cache, save_furc)
+
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_initialize_worker,
+            initargs=(use_cache, save_furc),
+        ) as executor:
+            yield from executor.map(_compile_in_worker, source_paths)
+
+    # Workers only add to the cache, so it's trimmed once they're done
+    if use_cache:
+        open_cache().evict()
+
+if __name__ == '__main__':
+    import shutil
+    import unittest
+
+    class CompileCacheTests(unittest.TestCase):
+        source = "x = 1\nprint(x + 2)\n"
+
+        def setUp(self):
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+            self.cache = CompileCache(directory)
+
+        def test_stores_and_finds_programs(self):
+            program = generate_cir(self.source)
+
+            self.assertIsNone(self.cache.get_program('cir', 'key'))
+            self.cache.put_program('cir', 'key', program)
+            self.assertEqual(self.cache.get_program('cir', 'key'), program)
+
+            self.assertEqual(self.cache.hits, ['cir'])
+            self.assertEqual(self.cache.misses, ['cir'])
+
+        def test_compiles_to_c_from_the_cache(self):
+            compiled = compile_source(self.source)
+
+            self.assertEqual(compile_source(self.source, self.cache), compiled)
+            self.assertEqual(compile_source(self.source, self.cache), compiled)
+            self.assertEqual(self.cache.hits, ['listing', 'c'])
+            self.assertIn('int main(', compiled[1])
+
+        def test_evicts_least_recently_used_entries(self):
+            for key, mtime in (('old', 1), ('used', 2), ('new', 3)):
+                self.cache.put_text('c', key, 'x' * 100)
+                os.utime(self.cache._path('c', key), (mtime, mtime))
+
+            self.cache.get_text('c', 'used')
+            self.cache.max_size = 200
+            self.cache.evict()
+
+            self.assertIsNone(self.cache.get_text('c', 'old'))
+            self.assertEqual(self.cache.get_text('c', 'used'), 'x' * 100)
+            self.assertEqual(self.cache.get_text('c', 'new'), 'x' * 100)
+            self.assertEqual(self.cache.evictions, 1)
+
+        def test_hashes_every_compiler_module_imported(self):
+            directory = os.path.dirname(os.path.abspath(__file__))
+            hashed = set(os.path.abspath(module.__file__) for module in COMPILER_MODULES)
+
+            for module in COMPILER_MODULES:
+                with open(module.__file__, 'r') as f:
+                    imported = [
+                        line.split()[1]
+                        for line in f
+                        if line.startswith(('import ', 'from '))
+                    ]
+
+                for name in imported:
+                    path = os.path.join(directory, name + '.py')
+
+                    if os.path.exists(path):
+                        self.assertIn(path, hashed, '{} imports {}'.format(module.__name__, name))
+
+        def test_reuses_unchanged_functions(self):
+            source = (
+                "def first(x) do\n  if x do\n    lambda() do\n      1\n    end\n  else\n    2\n  end\nend\n"
+                "def second(x) do\n  if x < 1 do\n    'a'\n  else\n    'b'\n  end\nend\n"
+                "print(first(1), second(2))\n"
+            )
+            edited_source = '# An edit\n' + source.replace("'b'", "'c'")
+
+            generate_cir_incrementally(source, self.cache)
+            self.cache.hits, self.cache.misses = [], []
+
+            self.assertEqual(
+                crossplatform_ir_generation.output(generate_cir_incrementally(edited_source, self.cache)),
+                crossplatform_ir_generation.output(generate_cir(edited_source)),
+            )
+            self.assertEqual(self.cache.hits, ['function'])
+            self.assertEqual(self.cache.misses, ['function'])
+
+        def test_parses_deeply_nested_parentheses(self):
+            # Unmemoized, this depth would take longer to parse than anyone waits
+            depth = 30
+            source = 'print(' + '(' * depth + '1' + ')' * depth + ')\n'
+
+            self.assertEqual(
+                crossplatform_ir_generation.output(generate_cir_incrementally(source, self.cache)),
+                crossplatform_ir_generation.output(generate_cir(source)),
+            )
+
+        def test_keys_change_with_every_part(self):
+            self.assertNotEqual(_key(b'a', b'bc'), _key(b'ab', b'c'))
+
+    class CompileFilesTests(unittest.TestCase):
+        def test_reports_each_file_in_order(self):
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+
+            missing_path = os.path.join(directory, 'missing.fur')
+            text_path = os.path.join(directory, 'program.txt')
+
+            for workers in (0, 2):
+                results = list(compile_files([missing_path, text_path], workers=workers, use_cache=False))
+
+                self.assertEqual([result.source_path for result in results], [missing_path, text_path])
+                self.assertTrue(results[0].error.startswith('FileNotFoundError'))
+                self.assertEqual(results[1].error, 'Exception: Expected a .fur or .furc file, got "{}"'.format(text_path))
+
+    unittest.main()
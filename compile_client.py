@@ -0,0 +1,86 @@
+# The socket module imports enough of the standard library to take longer
+# than a small compile does on the server, and this only needs a Unix socket
+import _socket
+import os
+import sys
+
+# Sends a main.py command line to compile_server.py and prints what it gives
+# back. If the server isn't running, the command runs here instead, so that
+# the client can always stand in for main.py:
+#
+#     python compile_client.py examples/01_hello.fur
+#
+# A request is the client's directory and the arguments, separated by NUL
+# characters. A response is a line with the exit status and the lengths of
+# stdout and stderr in bytes, then stdout and stderr.
+
+DEFAULT_SOCKET_PATH = os.path.join(
+    os.environ.get('TMPDIR', '/tmp'),
+    'fur-compile-server-{}.sock'.format(os.getuid()),
+)
+
+def socket_path():
+    return os.environ.get('FUR_SERVER_SOCKET', DEFAULT_SOCKET_PATH)
+
+def encode_request(directory, arguments):
+    return '\0'.join([directory] + list(arguments)).encode('utf-8')
+
+def decode_request(request):
+    directory, *arguments = request.decode('utf-8').split('\0')
+    return directory, arguments
+
+def encode_response(status, stdout, stderr):
+    stdout = stdout.encode('utf-8')
+    stderr = stderr.encode('utf-8')
+    return '{} {} {}\n'.format(status, len(stdout), len(stderr)).encode('utf-8') + stdout + stderr
+
+def decode_response(response):
+    header, _, body = response.partition(b'\n')
+    status, stdout_length, stderr_length = (int(field) for field in header.split())
+
+    if len(body) != stdout_length + stderr_length:
+        raise Exception('Expected a response of {} bytes from the compile server, got {}'.format(
+            stdout_length + stderr_length,
+            len(body),
+        ))
+
+    return (
+        status,
+        body[:stdout_length].decode('utf-8'),
+        body[stdout_length:].decode('utf-8'),
+    )
+
+def request(arguments, directory):
+    connection = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+
+    try:
+        connection.connect(socket_path())
+        connection.sendall(encode_request(directory, arguments))
+        connection.shutdown(_socket.SHUT_WR)
+
+        chunks = []
+
+        while True:
+            chunk = connection.recv(65536)
+
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+
+    finally:
+        connection.close()
+
+    return decode_response(b''.join(chunks))
+
+if __name__ == '__main__':
+    try:
+        status, stdout, stderr = request(sys.argv[1:], os.getcwd())
+
+    except (FileNotFoundError, ConnectionRefusedError):
+        import main
+        sys.exit(main.run(sys.argv[1:], sys.stdout, sys.stderr))
+
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(status)
@@ -0,0 +1,89 @@
+import io
+import os
+import signal
+import socket
+import socketserver
+import sys
+import traceback
+
+import compilation
+import compile_client
+import main
+
+# Runs main.py command lines sent by compile_client.py, keeping the compiler
+# imported and the C template compiled between them, so that a small compile
+# costs little more than starting the client. Each request is handled on its
+# own thread. Start it with:
+#
+#     python compile_server.py
+#
+# It listens on FUR_SERVER_SOCKET, or a socket in the temporary directory,
+# and uses the same cache settings as main.py. The compiler is whatever was
+# imported when the server started, so restart it after changing the
+# compiler.
+
+class CompileRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        directory, arguments = compile_client.decode_request(self.rfile.read())
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+
+        try:
+            status = main.run(arguments, stdout, stderr, directory, in_process=True)
+        except Exception:
+            # main.py would have died with the traceback, so send that back
+            traceback.print_exc(file=stderr)
+            status = 1
+
+        self.wfile.write(compile_client.encode_response(status, stdout.getvalue(), stderr.getvalue()))
+
+class CompileServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+def _remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+
+    raise Exception('A compile server is already listening on "{}"'.format(path))
+
+def _warm_up():
+    # Compiling once loads the templates which program2.c includes, and runs
+    # each pass once
+    try:
+        compilation.compile_source('print(1)\n')
+    except Exception as e:
+        print('Compiling failed while warming up: {}'.format(e), file=sys.stderr)
+
+def _exit_on_signal(signal_number, frame):
+    sys.exit(0)
+
+def serve(path):
+    _remove_stale_socket(path)
+    _warm_up()
+
+    # Being stopped with kill should still remove the socket
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+    with CompileServer(path, CompileRequestHandler) as server:
+        print('Listening on {}'.format(path), file=sys.stderr)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(path)
+
+if __name__ == '__main__':
+    serve(sys.argv[1] if len(sys.argv) > 1 else compile_client.socket_path())
@@ -1,15 +1,14 @@
-import collections
-
 import normalization
+import util
 
-CPSBuiltinExpression = collections.namedtuple(
+CPSBuiltinExpression = util.node_type(
     'CPSBuiltinExpression',
     (
         'symbol',
     ),
 )
 
-CPSFunctionCallExpression = collections.namedtuple(
+CPSFunctionCallExpression = util.node_type(
     'CPSFunctionCallExpression',
     (
         'metadata',
@@ -18,14 +17,14 @@ CPSFunctionCallExpression = collections.namedtuple(
     ),
 )
 
-CPSIntegerLiteralExpression = collections.namedtuple(
+CPSIntegerLiteralExpression = util.node_type(
     'CPSIntegerLiteralExpression',
     (
         'integer',
     ),
 )
 
-CPSLambdaExpression = collections.namedtuple(
+CPSLambdaExpression = util.node_type(
     'CPSLambdaExpression',
     (
         'name',
@@ -34,49 +33,49 @@ CPSLambdaExpression = collections.namedtuple(
     ),
 )
 
-CPSListConstructExpression = collections.namedtuple(
+CPSListConstructExpression = util.node_type(
     'CPSListConstructExpression',
     (
         'allocate',
     ),
 )
 
-CPSStringLiteralExpression = collections.namedtuple(
+CPSStringLiteralExpression = util.node_type(
     'CPSStringLiteralExpression',
     (
         'string',
     ),
 )
 
-CPSStructureLiteralExpression = collections.namedtuple(
+CPSStructureLiteralExpression = util.node_type(
     'CPSStructureLiteralExpression',
     (
         'field_count',
     ),
 )
 
-CPSSymbolExpression = collections.namedtuple(
+CPSSymbolExpression = util.node_type(
     'CPSSymbolExpression',
     (
         'symbol',
     ),
 )
 
-CPSSymbolLiteralExpression = collections.namedtuple(
+CPSSymbolLiteralExpression = util.node_type(
     'CPSSymbolLiteralExpression',
     (
         'symbol',
     ),
 )
 
-CPSVariableExpression = collections.namedtuple(
+CPSVariableExpression = util.node_type(
     'CPSVariableExpression',
     (
         'variable',
     ),
 )
 
-CPSArrayVariableInitializationStatement = collections.namedtuple(
+CPSArrayVariableInitializationStatement = util.node_type(
     'CPSArrayVariableInitializationStatement',
     (
         'variable',
@@ -84,7 +83,7 @@ CPSArrayVariableInitializationStatement = collections.namedtuple(
     ),
 )
 
-CPSAssignmentStatement = collections.namedtuple(
+CPSAssignmentStatement = util.node_type(
     'CPSAssignmentStatement',
     (
         'target',
@@ -92,14 +91,14 @@ CPSAssignmentStatement = collections.namedtuple(
     ),
 )
 
-CPSExpressionStatement = collections.namedtuple(
+CPSExpressionStatement = util.node_type(
     'CPSExpressionStatement',
     (
         'expression',
     ),
 )
 
-CPSIfElseExpression = collections.namedtuple(
+CPSIfElseExpression = util.node_type(
     'CPSIfElseExpression',
     (
         'condition_expression',
@@ -108,14 +107,14 @@ CPSIfElseExpression = collections.namedtuple(
     ),
 )
 
-CPSPushStatement = collections.namedtuple(
+CPSPushStatement = util.node_type(
     'CPSPushStatement',
     (
         'expression',
     ),
 )
 
-CPSVariableInitializationStatement = collections.namedtuple(
+CPSVariableInitializationStatement = util.node_type(
     'CPSVariableInitializationStatement',
     (
         'variable',
@@ -123,7 +122,7 @@ CPSVariableInitializationStatement = collections.namedtuple(
     ),
 )
 
-CPSSymbolArrayVariableInitializationStatement = collections.namedtuple(
+CPSSymbolArrayVariableInitializationStatement = util.node_type(
     'CPSSymbolArrayVariableInitializationStatement',
     (
         'variable',
@@ -131,7 +130,7 @@ CPSSymbolArrayVariableInitializationStatement = collections.namedtuple(
     ),
 )
 
-CPSProgram = collections.namedtuple(
+CPSProgram = util.node_type(
     'CPSProgram',
     (
         'statement_list',
@@ -144,7 +143,7 @@ def convert_builtin_expression(expression):
 def convert_function_call_expression(expression):
     return CPSFunctionCallExpression(
         metadata=expression.metadata,
-        function_expression=convert_expression(expression.function_expression),
+        function_expression=(yield convert_expression(expression.function_expression)),
         argument_count=expression.argument_count,
     )
 
@@ -155,7 +154,7 @@ def convert_lambda_expression(expression):
     return CPSLambdaExpression(
         name=expression.name,
         argument_name_list=expression.argument_name_list,
-        statement_list=tuple(convert_statement(s) for s in expression.statement_list),
+        statement_list=(yield convert_statement_list(expression.statement_list)),
     )
 
 def convert_list_construct_expression(expression):
@@ -179,65 +178,75 @@ def convert_variable_expression(expression):
     return CPSVariableExpression(variable=expression.variable)
 
 def convert_expression(expression):
-    return {
-        normalization.NormalBuiltinExpression: convert_builtin_expression,
-        normalization.NormalFunctionCallExpression: convert_function_call_expression,
-        normalization.NormalIfElseExpression: convert_if_else_expression,
-        normalization.NormalIntegerLiteralExpression: convert_integer_literal_expression,
-        normalization.NormalLambdaExpression: convert_lambda_expression,
-        normalization.NormalListConstructExpression: convert_list_construct_expression,
-        normalization.NormalStringLiteralExpression: convert_string_literal_expression,
-        normalization.NormalStructureLiteralExpression: convert_structure_literal_expression,
-        normalization.NormalSymbolExpression: convert_symbol_expression,
-        normalization.NormalSymbolLiteralExpression: convert_symbol_literal_expression,
-        normalization.NormalVariableExpression: convert_variable_expression,
-    }[type(expression)](expression)
+    return _EXPRESSION_CONVERTERS[type(expression)](expression)
 
 def convert_assignment_statement(statement):
     return CPSAssignmentStatement(
         target=statement.target,
-        expression=convert_expression(statement.expression),
+        expression=(yield convert_expression(statement.expression)),
     )
 
 def convert_expression_statement(statement):
     return CPSExpressionStatement(
-        expression=convert_expression(statement.expression),
+        expression=(yield convert_expression(statement.expression)),
     )
 
 def convert_if_else_expression(statement):
-    if_statement_list=tuple(convert_statement(s) for s in statement.if_statement_list)
-    else_statement_list=tuple(convert_statement(s) for s in statement.else_statement_list)
+    if_statement_list = yield convert_statement_list(statement.if_statement_list)
+    else_statement_list = yield convert_statement_list(statement.else_statement_list)
 
     return CPSIfElseExpression(
-        condition_expression=convert_expression(statement.condition_expression),
+        condition_expression=(yield convert_expression(statement.condition_expression)),
         if_statement_list=if_statement_list,
         else_statement_list=else_statement_list,
     )
 
 def convert_push_statement(statement):
     return CPSPushStatement(
-        expression=convert_expression(statement.expression),
+        expression=(yield convert_expression(statement.expression)),
     )
 
 def convert_variable_initialization_statement(statement):
     return CPSVariableInitializationStatement(
         variable=statement.variable,
-        expression=convert_expression(statement.expression),
+        expression=(yield convert_expression(statement.expression)),
     )
 
+# As in desugaring, the convert_* functions that contain subexpressions are
+# generators run by util.trampoline, and the ones for leaves are plain functions
+_EXPRESSION_CONVERTERS = {
+    normalization.NormalBuiltinExpression: convert_builtin_expression,
+    normalization.NormalFunctionCallExpression: convert_function_call_expression,
+    normalization.NormalIfElseExpression: convert_if_else_expression,
+    normalization.NormalIntegerLiteralExpression: convert_integer_literal_expression,
+    normalization.NormalLambdaExpression: convert_lambda_expression,
+    normalization.NormalListConstructExpression: convert_list_construct_expression,
+    normalization.NormalStringLiteralExpression: convert_string_literal_expression,
+    normalization.NormalStructureLiteralExpression: convert_structure_literal_expression,
+    normalization.NormalSymbolExpression: convert_symbol_expression,
+    normalization.NormalSymbolLiteralExpression: convert_symbol_literal_expression,
+    normalization.NormalVariableExpression: convert_variable_expression,
+}
+
+_STATEMENT_CONVERTERS = {
+    normalization.NormalAssignmentStatement: convert_assignment_statement,
+    normalization.NormalExpressionStatement: convert_expression_statement,
+    normalization.NormalPushStatement: convert_push_statement,
+    normalization.NormalVariableInitializationStatement: convert_variable_initialization_statement,
+}
+
 def convert_statement(statement):
-    return {
-        normalization.NormalAssignmentStatement: convert_assignment_statement,
-        normalization.NormalExpressionStatement: convert_expression_statement,
-        normalization.NormalPushStatement: convert_push_statement,
-        normalization.NormalVariableInitializationStatement: convert_variable_initialization_statement,
-    }[type(statement)](statement)
+    return _STATEMENT_CONVERTERS[type(statement)](statement)
 
 def convert_statement_list(statement_list):
-    return tuple(convert_statement(s) for s in statement_list)
+    result = []
+
+    for statement in statement_list:
+        result.append((yield convert_statement(statement)))
 
+    return tuple(result)
 
 def convert(program):
     return CPSProgram(
-        statement_list=convert_statement_list(program.statement_list),
+        statement_list=util.trampoline(convert_statement_list(program.statement_list)),
     )
@@ -1,17 +1,28 @@
+import array
 import collections
 
 import conversion
-
-def flatten(xses):
-    return tuple(x for xs in xses for x in xs)
-
-CIRProgram = collections.namedtuple(
+import util
+
+# The CIR of a program is packed into two parallel arrays. Each entry is an
+# opcode from OPCODES and an integer argument, which ARGUMENT_KINDS says how
+# to read: an index into the program's symbol, string or label table, an
+# integer, a symbol index and an integer packed together, or nothing. Labels
+# are entries too, with the "label" opcode, so they keep their place in the
+# stream.
+CIRProgram = util.node_type(
     'CIRProgram',
     (
-        'entry_list',
+        'opcodes',
+        'arguments',
+        'symbols',
+        'strings',
+        'labels',
     ),
 )
 
+# The unpacked form, one tuple per entry, which is easier to read when
+# debugging
 CIRLabel = collections.namedtuple(
     'CIRLabel',
     (
@@ -27,6 +38,127 @@ CIRInstruction = collections.namedtuple(
     ),
 )
 
+NO_ARGUMENT = 'none'
+INTEGER_ARGUMENT = 'integer'
+LABEL_ARGUMENT = 'label'
+STRING_ARGUMENT = 'string'
+SYMBOL_ARGUMENT = 'symbol'
+SYMBOL_AND_INTEGER_ARGUMENT = 'symbol and integer'
+
+# The superinstructions, which do the work of a sequence of the other
+# instructions in one dispatch, are only made by optimization.py, so nothing
+# before it has to handle them. See SUPERINSTRUCTIONS there.
+
+_OPCODE_DEFINITIONS = (
+    ('label',                LABEL_ARGUMENT),
+    ('add',                  INTEGER_ARGUMENT),
+    ('add_symbol_integer',   SYMBOL_AND_INTEGER_ARGUMENT),
+    ('call',                 INTEGER_ARGUMENT),
+    ('call_symbol',          SYMBOL_AND_INTEGER_ARGUMENT),
+    ('close',                LABEL_ARGUMENT),
+    ('drop',                 NO_ARGUMENT),
+    ('dup',                  NO_ARGUMENT),
+    ('end',                  NO_ARGUMENT),
+    ('eq',                   INTEGER_ARGUMENT),
+    ('eq_jump_if_false',     LABEL_ARGUMENT),
+    ('gt',                   INTEGER_ARGUMENT),
+    ('gt_jump_if_false',     LABEL_ARGUMENT),
+    ('gte',                  INTEGER_ARGUMENT),
+    ('gte_jump_if_false',    LABEL_ARGUMENT),
+    ('idiv',                 INTEGER_ARGUMENT),
+    ('idiv_symbol_integer',  SYMBOL_AND_INTEGER_ARGUMENT),
+    ('jump',                 LABEL_ARGUMENT),
+    ('jump_if_false',        LABEL_ARGUMENT),
+    ('list',                 INTEGER_ARGUMENT),
+    ('lt',                   INTEGER_ARGUMENT),
+    ('lt_jump_if_false',     LABEL_ARGUMENT),
+    ('lte',                  INTEGER_ARGUMENT),
+    ('lte_jump_if_false',    LABEL_ARGUMENT),
+    ('mod',                  INTEGER_ARGUMENT),
+    ('mod_symbol_integer',   SYMBOL_AND_INTEGER_ARGUMENT),
+    ('mul',                  INTEGER_ARGUMENT),
+    ('mul_symbol_integer',   SYMBOL_AND_INTEGER_ARGUMENT),
+    ('neg',                  INTEGER_ARGUMENT),
+    ('neq',                  INTEGER_ARGUMENT),
+    ('neq_jump_if_false',    LABEL_ARGUMENT),
+    ('pop',                  SYMBOL_ARGUMENT),
+    ('push',                 SYMBOL_ARGUMENT),
+    ('push_integer',         INTEGER_ARGUMENT),
+    ('push_string',          STRING_ARGUMENT),
+    ('push_symbol',          SYMBOL_ARGUMENT),
+    ('return',               NO_ARGUMENT),
+    ('rot',                  NO_ARGUMENT),
+    ('structure',            INTEGER_ARGUMENT),
+    ('sub',                  INTEGER_ARGUMENT),
+    ('sub_symbol_integer',   SYMBOL_AND_INTEGER_ARGUMENT),
+    ('swap',                 NO_ARGUMENT),
+)
+
+OPCODES = tuple(name for name, _ in _OPCODE_DEFINITIONS)
+ARGUMENT_KINDS = tuple(kind for _, kind in _OPCODE_DEFINITIONS)
+OPCODES_BY_NAME = {name: opcode for opcode, name in enumerate(OPCODES)}
+
+LABEL = OPCODES_BY_NAME['label']
+CALL = OPCODES_BY_NAME['call']
+CLOSE = OPCODES_BY_NAME['close']
+DROP = OPCODES_BY_NAME['drop']
+DUP = OPCODES_BY_NAME['dup']
+END = OPCODES_BY_NAME['end']
+JUMP = OPCODES_BY_NAME['jump']
+JUMP_IF_FALSE = OPCODES_BY_NAME['jump_if_false']
+LIST = OPCODES_BY_NAME['list']
+POP = OPCODES_BY_NAME['pop']
+PUSH = OPCODES_BY_NAME['push']
+PUSH_INTEGER = OPCODES_BY_NAME['push_integer']
+PUSH_STRING = OPCODES_BY_NAME['push_string']
+PUSH_SYMBOL = OPCODES_BY_NAME['push_symbol']
+RETURN = OPCODES_BY_NAME['return']
+ROT = OPCODES_BY_NAME['rot']
+STRUCTURE = OPCODES_BY_NAME['structure']
+SWAP = OPCODES_BY_NAME['swap']
+
+# The symbol index goes in the high half and the integer, which has to fit
+# in 32 bits, in the low half
+INTEGER_BITS = 32
+INTEGER_MINIMUM = -(1 << (INTEGER_BITS - 1))
+INTEGER_MAXIMUM = (1 << (INTEGER_BITS - 1)) - 1
+
+def pack_symbol_and_integer(symbol, integer):
+    assert INTEGER_MINIMUM <= integer <= INTEGER_MAXIMUM
+    return (symbol << INTEGER_BITS) | (integer & ((1 << INTEGER_BITS) - 1))
+
+def unpack_symbol_and_integer(argument):
+    integer = argument & ((1 << INTEGER_BITS) - 1)
+
+    if integer > INTEGER_MAXIMUM:
+        integer -= 1 << INTEGER_BITS
+
+    return argument >> INTEGER_BITS, integer
+
+def opcode_array(opcodes=()):
+    return array.array('H', opcodes)
+
+def argument_array(arguments=()):
+    # Signed 64 bit, so that integer literals fit as well as table indices
+    return array.array('q', arguments)
+
+# Gives each distinct value an index, in the order they're first seen
+class InternTable(object):
+    def __init__(self, values=()):
+        self.values = []
+        self._indices = {}
+
+        for value in values:
+            self.index(value)
+
+    def index(self, value):
+        try:
+            return self._indices[value]
+        except KeyError:
+            index = self._indices[value] = len(self.values)
+            self.values.append(value)
+            return index
+
 def generate_integer_literal(integer):
     return integer
 
@@ -55,312 +187,532 @@ def generate_instruction_name_from_builtin(builtin):
         }[builtin]
 
     except KeyError:
-        import ipdb; ipdb.set_trace()
+        raise Exception('CIR generation does not support the builtin "{}" yet'.format(builtin))
+
+def escape_name(name):
+    return name.replace('$','$$').replace('_','$')
+
+# Stands in a CPS tree for a lambda whose CIR was generated earlier, as a
+# block: see CIREmitter.block
+PrecompiledLambdaExpression = util.node_type(
+    'PrecompiledLambdaExpression',
+    (
+        'name',
+        'block',
+    ),
+)
+
+# Collects the CIR for a program as it's generated. Instructions are appended
+# to the entry being generated, so no instruction is copied once it's
+# emitted. Lambda bodies are their own entries: one is started when we reach
+# a lambda, and when it's finished it goes into the referenced entry list,
+# which comes before __main__ in the program.
+#
+# A lambda in __main__, together with the lambdas nested in it, is a unit.
+# Labels within a unit are numbered from zero and prefixed with the unit's
+# label, so they don't depend on anything outside it. That makes the CIR of
+# a unit the same wherever it is, so it can be kept as a block and spliced
+# into a later program. If a list is given as unit_blocks, the lambda
+# expression and block of every unit are appended to it.
+class CIREmitter(object):
+    def __init__(self, unit_blocks=None):
+        self.symbols = InternTable()
+        self.strings = InternTable()
+        self.labels = InternTable()
+        self.referenced_opcodes = opcode_array()
+        self.referenced_arguments = argument_array()
+        self.unit_blocks = unit_blocks
+        self._entry_stack = [(opcode_array(), argument_array())]
+        self._label_counters = {}
+        self._if_counter = 0
+        self._unit_label = None
+        self._main_counters = None
+
+    def in_main(self):
+        return len(self._entry_stack) == 1
+
+    def emit(self, opcode, argument=0):
+        opcodes, arguments = self._entry_stack[-1]
+        opcodes.append(opcode)
+        arguments.append(argument)
+
+    def emit_symbol(self, opcode, symbol):
+        self.emit(opcode, self.symbols.index(symbol))
+
+    def emit_label(self, opcode, label):
+        self.emit(opcode, self.labels.index(label))
+
+    def remove_trailing_drop(self):
+        # Statements end by dropping their value, but the last statement of a
+        # block leaves its value as the value of the block
+        opcodes, arguments = self._entry_stack[-1]
+        assert opcodes and opcodes[-1] == DROP
+        opcodes.pop()
+        arguments.pop()
+
+    def _unit_prefixed(self, label):
+        if self._unit_label is None:
+            return label
+
+        return '{}$${}'.format(self._unit_label, label)
+
+    def allocate_label(self, name):
+        counter = self._label_counters.get(name, 0)
+        self._label_counters[name] = counter + 1
+        return self._unit_prefixed('{}${}'.format(name, counter))
+
+    def allocate_if_labels(self):
+        counter = self._if_counter
+        self._if_counter += 1
 
-def generate_function_call_expression(counters, expression):
-    if isinstance(expression.function_expression, conversion.CPSBuiltinExpression):
         return (
-            (),
-            (
-                CIRInstruction(
-                    instruction=generate_instruction_name_from_builtin(
-                        expression.function_expression.symbol,
-                    ),
-                    argument=expression.argument_count,
-                ),
-            )
+            self._unit_prefixed('__if${}__'.format(counter)),
+            self._unit_prefixed('__else${}__'.format(counter)),
+            self._unit_prefixed('__endif${}__'.format(counter)),
         )
 
-    referenced_entry_list, instruction_list = generate_expression(
-        counters,
-        expression.function_expression,
-    )
+    def begin_entry(self, label):
+        if self.in_main():
+            self._main_counters = (self._label_counters, self._if_counter)
+            self._label_counters = {}
+            self._if_counter = 0
+            self._unit_label = label
+
+        self._entry_stack.append((opcode_array(), argument_array()))
+        self.emit_label(LABEL, label)
+
+    def end_entry(self):
+        opcodes, arguments = self._entry_stack.pop()
+        self.referenced_opcodes.extend(opcodes)
+        self.referenced_arguments.extend(arguments)
+
+        if self.in_main():
+            self._label_counters, self._if_counter = self._main_counters
+            self._unit_label = None
+
+    # Returns the entries from start in the referenced entry list, which are a
+    # unit with the given label, as a program of their own. The labels in its
+    # table have the unit's label taken off the front, so that the block can
+    # be spliced in under another label.
+    def block(self, start, label):
+        symbols = InternTable()
+        strings = InternTable()
+        labels = InternTable()
+
+        tables = {
+            LABEL_ARGUMENT: (self.labels.values, labels),
+            STRING_ARGUMENT: (self.strings.values, strings),
+            SYMBOL_ARGUMENT: (self.symbols.values, symbols),
+        }
+        opcode_tables = tuple(tables.get(kind) for kind in ARGUMENT_KINDS)
+
+        opcodes = self.referenced_opcodes[start:]
+        arguments = argument_array()
+
+        for opcode, argument in zip(opcodes, self.referenced_arguments[start:]):
+            table = opcode_tables[opcode]
+
+            if table is None:
+                arguments.append(argument)
+            else:
+                values, block_table = table
+                arguments.append(block_table.index(values[argument]))
 
-    instruction_list += (
-        CIRInstruction(
-            instruction='call',
-            argument=expression.argument_count,
-        ),
-    )
+        assert all(block_label.startswith(label) for block_label in labels.values)
 
-    return referenced_entry_list, instruction_list
+        return CIRProgram(
+            opcodes=opcodes,
+            arguments=arguments,
+            symbols=tuple(symbols.values),
+            strings=tuple(strings.values),
+            labels=tuple(block_label[len(label):] for block_label in labels.values),
+        )
 
-def generate_integer_literal_expression(counters, expression):
-    referenced_entry_list = ()
-    instruction_list = (CIRInstruction(
-        instruction='push_integer',
-        argument=generate_integer_literal(expression.integer),
-    ),)
+    def emit_block(self, label, block):
+        assert self.in_main()
 
-    return referenced_entry_list, instruction_list
+        tables = {
+            LABEL_ARGUMENT: [self.labels.index(label + suffix) for suffix in block.labels],
+            STRING_ARGUMENT: [self.strings.index(string) for string in block.strings],
+            SYMBOL_ARGUMENT: [self.symbols.index(symbol) for symbol in block.symbols],
+        }
+        opcode_tables = tuple(tables.get(kind) for kind in ARGUMENT_KINDS)
 
-def escape_name(name):
-    return name.replace('$','$$').replace('_','$')
+        self.referenced_opcodes.extend(block.opcodes)
+        self.referenced_arguments.extend(
+            argument if opcode_tables[opcode] is None else opcode_tables[opcode][argument]
+            for opcode, argument in zip(block.opcodes, block.arguments)
+        )
 
-def generate_lambda_expression(counters, expression):
-    if expression.name is None:
-        name = '__lambda__'
-    else:
-        name = escape_name(expression.name)
+    def program(self):
+        assert len(self._entry_stack) == 1
 
-    name_counter = counters.get(name, 0)
-    counters[expression.name] = name_counter + 1
-    label = '{}${}'.format(name, name_counter)
+        main_opcodes, main_arguments = self._entry_stack[0]
 
-    referenced_entry_list_list = []
-    instruction_list_list = []
+        opcodes = self.referenced_opcodes
+        opcodes.append(LABEL)
+        opcodes.extend(main_opcodes)
+        opcodes.append(END)
 
-    for statement in expression.statement_list:
-        referenced_entry_list, instruction_list = generate_statement(counters, statement)
-        referenced_entry_list_list.append(referenced_entry_list)
-        instruction_list_list.append(instruction_list)
+        arguments = self.referenced_arguments
+        arguments.append(self.labels.index('__main__'))
+        arguments.extend(main_arguments)
+        arguments.append(0)
+
+        return CIRProgram(
+            opcodes=opcodes,
+            arguments=arguments,
+            symbols=tuple(self.symbols.values),
+            strings=tuple(self.strings.values),
+            labels=tuple(self.labels.values),
+        )
+
+def generate_function_call_expression(emitter, expression):
+    if isinstance(expression.function_expression, conversion.CPSBuiltinExpression):
+        emitter.emit(
+            OPCODES_BY_NAME[generate_instruction_name_from_builtin(expression.function_expression.symbol)],
+            expression.argument_count,
+        )
+        return
+
+    yield generate_expression(emitter, expression.function_expression)
+    emitter.emit(CALL, expression.argument_count)
+
+def generate_integer_literal_expression(emitter, expression):
+    emitter.emit(PUSH_INTEGER, generate_integer_literal(expression.integer))
+
+def _lambda_label_name(name):
+    if name is None:
+        return '__lambda__'
+
+    return escape_name(name)
+
+def generate_lambda_expression(emitter, expression):
+    label = emitter.allocate_label(_lambda_label_name(expression.name))
+
+    if emitter.unit_blocks is not None and emitter.in_main():
+        unit_start = len(emitter.referenced_opcodes)
+    else:
+        unit_start = None
+
+    emitter.begin_entry(label)
 
     # Pop from the stack in reversed order, because arguments were pushed onto
     # the stack in order
-    argument_bindings = tuple(
-        CIRInstruction(instruction='pop', argument='sym({})'.format(arg))
-        for arg in reversed(expression.argument_name_list)
-    )
+    for argument_name in reversed(expression.argument_name_list):
+        emitter.emit_symbol(POP, argument_name)
 
-    lambda_body = flatten(instruction_list_list)
-    assert lambda_body[-1].instruction == 'drop'
-    lambda_body = argument_bindings + lambda_body[:-1] + (CIRInstruction(instruction='return', argument=None),)
+    yield generate_statement_list(emitter, expression.statement_list)
 
-    referenced_entry_list_list.append(
-        (CIRLabel(label=label),) + lambda_body,
-    )
+    emitter.remove_trailing_drop()
+    emitter.emit(RETURN)
+    emitter.end_entry()
 
-    instruction_list = (
-        CIRInstruction(instruction='close', argument=label),
-    )
+    if unit_start is not None:
+        emitter.unit_blocks.append((expression, emitter.block(unit_start, label)))
 
-    return flatten(referenced_entry_list_list), instruction_list
-
-def generate_list_construct_expression(counters, expression):
-    referenced_entry_list = ()
-    instruction_list = (CIRInstruction(
-        instruction='list',
-        argument=2,
-    ),)
-    return referenced_entry_list, instruction_list
-
-def generate_string_literal_expression(counters, expression):
-    referenced_entry_list = ()
-    instruction_list = (CIRInstruction(
-        instruction='push_string',
-        argument=generate_string_literal(expression.string),
-    ),)
-
-    return referenced_entry_list, instruction_list
-
-def generate_structure_literal_expression(counters, expression):
-    referenced_entry_list = ()
-    instruction_list = (CIRInstruction(
-        instruction='structure',
-        argument=expression.field_count,
-    ),)
-
-    return referenced_entry_list, instruction_list
-
-def generate_symbol_expression(counters, expression):
-    referenced_entry_list = ()
-    instruction_list = (CIRInstruction(
-        instruction='push',
-        argument=generate_symbol_literal(expression.symbol),
-    ),)
-
-    return referenced_entry_list, instruction_list
-
-def generate_symbol_literal_expression(counters, expression):
-    referenced_entry_list = ()
-    instruction_list = (CIRInstruction(
-        instruction='push_symbol',
-        argument=generate_symbol_literal(expression.symbol),
-    ),)
-
-    return referenced_entry_list, instruction_list
-
-def generate_variable_expression(counters, expression):
-    referenced_entry_list = ()
-    instruction_list = (CIRInstruction(
-        instruction='push',
-        argument=generate_symbol_literal(expression.variable),
-    ),)
-
-    return referenced_entry_list, instruction_list
-
-def generate_expression(counters, expression):
-    return {
-        conversion.CPSFunctionCallExpression: generate_function_call_expression,
-        conversion.CPSIfElseExpression: generate_if_else_expression,
-        conversion.CPSIntegerLiteralExpression: generate_integer_literal_expression,
-        conversion.CPSLambdaExpression: generate_lambda_expression,
-        conversion.CPSListConstructExpression: generate_list_construct_expression,
-        conversion.CPSStringLiteralExpression: generate_string_literal_expression,
-        conversion.CPSStructureLiteralExpression: generate_structure_literal_expression,
-        conversion.CPSSymbolExpression: generate_symbol_expression,
-        conversion.CPSSymbolLiteralExpression: generate_symbol_literal_expression,
-        conversion.CPSVariableExpression: generate_variable_expression,
-    }[type(expression)](counters, expression)
-
-def generate_expression_statement(counters, statement):
-    referenced_entry_list, instruction_list = generate_expression(
-        counters,
-        statement.expression,
-    )
+    emitter.emit_label(CLOSE, label)
 
-    instruction_list += (
-        CIRInstruction(
-            instruction='drop',
-            argument=None,
-        ),
-    )
+def generate_precompiled_lambda_expression(emitter, expression):
+    label = emitter.allocate_label(_lambda_label_name(expression.name))
+    emitter.emit_block(label, expression.block)
+    emitter.emit_label(CLOSE, label)
 
-    return referenced_entry_list, instruction_list
+def generate_list_construct_expression(emitter, expression):
+    emitter.emit(LIST, 2)
 
-def generate_if_else_expression(counters, statement):
-    if_counter = counters['if']
-    counters['if'] += 1
+def generate_string_literal_expression(emitter, expression):
+    emitter.emit(PUSH_STRING, emitter.strings.index(expression.string))
 
-    referenced_entry_list_list = []
+def generate_structure_literal_expression(emitter, expression):
+    emitter.emit(STRUCTURE, expression.field_count)
 
-    condition_referenced_entry_list, condition_instruction_list = generate_expression(
-        counters,
-        statement.condition_expression,
-    )
+def generate_symbol_expression(emitter, expression):
+    emitter.emit_symbol(PUSH, expression.symbol)
 
-    if_instruction_list_list = []
-    for if_statement in statement.if_statement_list:
-        referenced_entry_list, instruction_list = generate_statement(counters, if_statement)
-        referenced_entry_list_list.append(referenced_entry_list)
-        if_instruction_list_list.append(instruction_list)
-
-    if_instruction_list = flatten(if_instruction_list_list)
-    assert if_instruction_list[-1].instruction == 'drop'
-    if_instruction_list = if_instruction_list[:-1]
-
-    else_instruction_list_list = []
-
-    for else_statement in statement.else_statement_list:
-        referenced_entry_list, instruction_list = generate_statement(counters, else_statement)
-        referenced_entry_list_list.append(referenced_entry_list)
-        else_instruction_list_list.append(instruction_list)
-
-    else_instruction_list = flatten(else_instruction_list_list)
-    assert else_instruction_list[-1].instruction == 'drop'
-    else_instruction_list = else_instruction_list[:-1]
-
-    if_label = '__if${}__'.format(if_counter)
-    else_label = '__else${}__'.format(if_counter)
-    endif_label = '__endif${}__'.format(if_counter)
-
-    instruction_list = condition_instruction_list + (
-        CIRInstruction(
-            instruction='jump_if_false',
-            argument=else_label,
-        ),
-        CIRInstruction(
-            instruction='jump',
-            argument=if_label,
-        ),
-        CIRLabel(label=if_label),
-    ) + if_instruction_list + (
-        CIRInstruction(
-            instruction='jump',
-            argument=endif_label,
-        ),
-        CIRLabel(label=else_label),
-    ) + else_instruction_list + (
-        CIRLabel(label=endif_label),
-    )
+def generate_symbol_literal_expression(emitter, expression):
+    emitter.emit_symbol(PUSH_SYMBOL, expression.symbol)
 
-    return (
-        condition_referenced_entry_list + flatten(referenced_entry_list_list),
-        instruction_list,
-    )
+def generate_variable_expression(emitter, expression):
+    emitter.emit_symbol(PUSH, expression.variable)
 
-def generate_assignment_statement(counters, statement):
-    referenced_entry_list, instruction_list = generate_expression(
-        counters,
-        statement.expression,
-    )
+def generate_if_else_expression(emitter, statement):
+    if_label, else_label, endif_label = emitter.allocate_if_labels()
 
-    instruction_list += (
-        CIRInstruction(
-            instruction='pop',
-            argument=generate_symbol_literal(statement.target),
-        ),
-    )
+    yield generate_expression(emitter, statement.condition_expression)
 
-    return referenced_entry_list, instruction_list
+    emitter.emit_label(JUMP_IF_FALSE, else_label)
+    emitter.emit_label(JUMP, if_label)
+    emitter.emit_label(LABEL, if_label)
 
-def generate_push_statement(counters, statement):
-    return generate_expression(counters, statement.expression)
+    yield generate_statement_list(emitter, statement.if_statement_list)
+    emitter.remove_trailing_drop()
 
-def generate_variable_initialization_statement(counters, statement):
-    referenced_entry_list, instruction_list = generate_expression(
-        counters,
-        statement.expression,
-    )
+    emitter.emit_label(JUMP, endif_label)
+    emitter.emit_label(LABEL, else_label)
 
-    instruction_list += (
-        CIRInstruction(
-            instruction='pop',
-            argument=generate_symbol_literal(statement.variable),
-        ),
-    )
+    yield generate_statement_list(emitter, statement.else_statement_list)
+    emitter.remove_trailing_drop()
 
-    return referenced_entry_list, instruction_list
-
-def generate_statement(counters, statement):
-    return {
-        conversion.CPSAssignmentStatement: generate_assignment_statement,
-        conversion.CPSExpressionStatement: generate_expression_statement,
-        conversion.CPSPushStatement: generate_push_statement,
-        conversion.CPSVariableInitializationStatement: generate_variable_initialization_statement,
-    }[type(statement)](counters, statement)
-
-def generate(converted):
-    referenced_entry_list_list = []
-    instruction_list_list = []
-    counters = {
-        'if': 0,
-    }
+    emitter.emit_label(LABEL, endif_label)
+
+# As in the earlier passes, the generate_* functions that contain
+# subexpressions are generators run by util.trampoline, and the ones for
+# leaves are plain functions
+_EXPRESSION_GENERATORS = {
+    conversion.CPSFunctionCallExpression: generate_function_call_expression,
+    conversion.CPSIfElseExpression: generate_if_else_expression,
+    conversion.CPSIntegerLiteralExpression: generate_integer_literal_expression,
+    conversion.CPSLambdaExpression: generate_lambda_expression,
+    conversion.CPSListConstructExpression: generate_list_construct_expression,
+    PrecompiledLambdaExpression: generate_precompiled_lambda_expression,
+    conversion.CPSStringLiteralExpression: generate_string_literal_expression,
+    conversion.CPSStructureLiteralExpression: generate_structure_literal_expression,
+    conversion.CPSSymbolExpression: generate_symbol_expression,
+    conversion.CPSSymbolLiteralExpression: generate_symbol_literal_expression,
+    conversion.CPSVariableExpression: generate_variable_expression,
+}
+
+def generate_expression(emitter, expression):
+    return _EXPRESSION_GENERATORS[type(expression)](emitter, expression)
+
+def generate_expression_statement(emitter, statement):
+    yield generate_expression(emitter, statement.expression)
+    emitter.emit(DROP)
+
+def generate_assignment_statement(emitter, statement):
+    yield generate_expression(emitter, statement.expression)
+    emitter.emit_symbol(POP, statement.target)
+
+def generate_push_statement(emitter, statement):
+    return generate_expression(emitter, statement.expression)
+
+def generate_variable_initialization_statement(emitter, statement):
+    yield generate_expression(emitter, statement.expression)
+    emitter.emit_symbol(POP, statement.variable)
+
+_STATEMENT_GENERATORS = {
+    conversion.CPSAssignmentStatement: generate_assignment_statement,
+    conversion.CPSExpressionStatement: generate_expression_statement,
+    conversion.CPSPushStatement: generate_push_statement,
+    conversion.CPSVariableInitializationStatement: generate_variable_initialization_statement,
+}
+
+def generate_statement(emitter, statement):
+    return _STATEMENT_GENERATORS[type(statement)](emitter, statement)
+
+def generate_statement_list(emitter, statement_list):
+    for statement in statement_list:
+        yield generate_statement(emitter, statement)
+
+def generate(converted, unit_blocks=None):
+    emitter = CIREmitter(unit_blocks)
+    util.trampoline(generate_statement_list(emitter, converted.statement_list))
+    return emitter.program()
 
-    for statement in converted.statement_list:
-        referenced_entry_list, instruction_list = generate_statement(counters, statement)
-        referenced_entry_list_list.append(referenced_entry_list)
-        instruction_list_list.append(instruction_list)
+def unpack_argument(program, opcode, argument):
+    kind = ARGUMENT_KINDS[opcode]
+
+    if kind == SYMBOL_ARGUMENT:
+        return generate_symbol_literal(program.symbols[argument])
+
+    if kind == STRING_ARGUMENT:
+        return generate_string_literal(program.strings[argument])
+
+    if kind == LABEL_ARGUMENT:
+        return program.labels[argument]
+
+    if kind == INTEGER_ARGUMENT:
+        return argument
+
+    if kind == SYMBOL_AND_INTEGER_ARGUMENT:
+        symbol, integer = unpack_symbol_and_integer(argument)
+        return generate_symbol_literal(program.symbols[symbol]), integer
+
+    return None
+
+def unpack(program):
+    entry_list = []
+
+    for opcode, argument in zip(program.opcodes, program.arguments):
+        if opcode == LABEL:
+            entry_list.append(CIRLabel(label=program.labels[argument]))
+        else:
+            entry_list.append(CIRInstruction(
+                instruction=OPCODES[opcode],
+                argument=unpack_argument(program, opcode, argument),
+            ))
+
+    return tuple(entry_list)
+
+def pack(entry_list):
+    symbols = InternTable()
+    strings = InternTable()
+    labels = InternTable()
+    opcodes = opcode_array()
+    arguments = argument_array()
+
+    for entry in entry_list:
+        if isinstance(entry, CIRLabel):
+            opcodes.append(LABEL)
+            arguments.append(labels.index(entry.label))
+            continue
+
+        opcode = OPCODES_BY_NAME[entry.instruction]
+        kind = ARGUMENT_KINDS[opcode]
+        opcodes.append(opcode)
+
+        if kind == SYMBOL_ARGUMENT:
+            assert entry.argument.startswith('sym(') and entry.argument.endswith(')')
+            arguments.append(symbols.index(entry.argument[4:-1]))
+        elif kind == STRING_ARGUMENT:
+            assert entry.argument.startswith('"') and entry.argument.endswith('"')
+            arguments.append(strings.index(entry.argument[1:-1]))
+        elif kind == LABEL_ARGUMENT:
+            arguments.append(labels.index(entry.argument))
+        elif kind == INTEGER_ARGUMENT:
+            arguments.append(entry.argument)
+        elif kind == SYMBOL_AND_INTEGER_ARGUMENT:
+            symbol, integer = entry.argument
+            assert symbol.startswith('sym(') and symbol.endswith(')')
+            arguments.append(pack_symbol_and_integer(symbols.index(symbol[4:-1]), integer))
+        else:
+            assert entry.argument is None
+            arguments.append(0)
 
     return CIRProgram(
-        entry_list=flatten(referenced_entry_list_list) + (
-            CIRLabel(label='__main__'),
-        ) + flatten(instruction_list_list) + (
-            CIRInstruction(instruction='end', argument=None),
-        )
+        opcodes=opcodes,
+        arguments=arguments,
+        symbols=tuple(symbols.values),
+        strings=tuple(strings.values),
+        labels=tuple(labels.values),
     )
 
 NO_ARGUMENT_INSTRUCTIONS = set([
     'drop',
+    'dup',
     'return',
+    'rot',
+    'swap',
 ])
 
-def format_argument(arg):
-    if arg is None:
-        return 'nil'
-    return arg
+def _output_formats():
+    # One format string per opcode, so output doesn't have to work out how to
+    # print each instruction as it goes
+    formats = []
+
+    for opcode, (name, kind) in enumerate(_OPCODE_DEFINITIONS):
+        if opcode == LABEL:
+            formats.append('\n{}:')
+        elif kind == NO_ARGUMENT:
+            formats.append('    {}'.format(name) if name in NO_ARGUMENT_INSTRUCTIONS else '    {} nil'.format(name))
+        elif kind == SYMBOL_ARGUMENT:
+            formats.append('    {} sym({{}})'.format(name))
+        elif kind == STRING_ARGUMENT:
+            formats.append('    {} "{{}}"'.format(name))
+        elif kind == SYMBOL_AND_INTEGER_ARGUMENT:
+            formats.append('    {} sym({{}}) {{}}'.format(name))
+        else:
+            formats.append('    {} {{}}'.format(name))
+
+    return tuple(formats)
+
+_OUTPUT_FORMATS = _output_formats()
 
 def output(program):
+    tables = {
+        LABEL_ARGUMENT: program.labels,
+        STRING_ARGUMENT: program.strings,
+        SYMBOL_ARGUMENT: program.symbols,
+    }
+    opcode_tables = tuple(tables.get(kind) for kind in ARGUMENT_KINDS)
+
     lines = []
 
-    for entry in program.entry_list:
-        if isinstance(entry, CIRInstruction):
-            if entry.instruction in NO_ARGUMENT_INSTRUCTIONS and entry.argument is None:
-                lines.append('    {}'.format(entry.instruction))
-            else:
-                lines.append('    {} {}'.format(entry.instruction, format_argument(entry.argument)))
+    for opcode, argument in zip(program.opcodes, program.arguments):
+        table = opcode_tables[opcode]
 
-        if isinstance(entry, CIRLabel):
-            lines.append('\n{}:'.format(entry.label))
+        if table is not None:
+            lines.append(_OUTPUT_FORMATS[opcode].format(table[argument]))
+        elif ARGUMENT_KINDS[opcode] == SYMBOL_AND_INTEGER_ARGUMENT:
+            symbol, integer = unpack_symbol_and_integer(argument)
+            lines.append(_OUTPUT_FORMATS[opcode].format(program.symbols[symbol], integer))
+        else:
+            lines.append(_OUTPUT_FORMATS[opcode].format(argument))
 
     return '\n'.join(lines).lstrip()
+
+if __name__ == '__main__':
+    import unittest
+
+    import lowering
+    import parsing
+    import tokenization
+
+    def generate_source(source):
+        return generate(lowering.lower(parsing.parse(tokenization.tokenize(source))))
+
+    def labels_in_order(program):
+        return [program.labels[argument] for opcode, argument in zip(program.opcodes, program.arguments) if opcode == LABEL]
+
+    class GenerateTests(unittest.TestCase):
+        def test_gives_lambdas_with_the_same_name_different_labels(self):
+            program = generate_source(
+                'f = lambda() do\n  1\nend\n'
+                'g = lambda() do\n  2\nend\n'
+                'def add_one(x) do\n  x + 1\nend\n'
+                'def add_one(x) do\n  x + 1\nend\n'
+            )
+
+            self.assertEqual(
+                labels_in_order(program),
+                ['__lambda__$0', '__lambda__$1', 'add$one$0', 'add$one$1', '__main__'],
+            )
+
+        def test_puts_nested_lambdas_before_the_lambdas_containing_them(self):
+            program = generate_source(
+                'def outer() do\n'
+                '  def inner() do\n    1\n  end\n'
+                '  inner\n'
+                'end\n'
+            )
+
+            self.assertEqual(labels_in_order(program), ['outer$0$$inner$0', 'outer$0', '__main__'])
+
+    class PackTests(unittest.TestCase):
+        source = "x = 'a'\ndef f(a) do\n  if a < 2 do\n    x\n  else\n    -a\n  end\nend\nprint(f(1))\n"
+
+        def test_packs_unpacked_programs_to_the_same_entries(self):
+            # The tables may come out in a different order, so compare entries
+            entry_list = unpack(generate_source(self.source))
+            self.assertEqual(unpack(pack(entry_list)), entry_list)
+
+        def test_outputs_the_unpacked_form(self):
+            program = generate_source(self.source)
+            lines = []
+
+            for entry in unpack(program):
+                if isinstance(entry, CIRLabel):
+                    lines.append('\n{}:'.format(entry.label))
+                elif entry.instruction in NO_ARGUMENT_INSTRUCTIONS and entry.argument is None:
+                    lines.append('    {}'.format(entry.instruction))
+                else:
+                    lines.append('    {} {}'.format(entry.instruction, 'nil' if entry.argument is None else entry.argument))
+
+            self.assertEqual(output(program), '\n'.join(lines).lstrip())
+
+        def test_packs_symbols_with_integers(self):
+            for integer in (0, 1, -1, INTEGER_MINIMUM, INTEGER_MAXIMUM):
+                self.assertEqual(unpack_symbol_and_integer(pack_symbol_and_integer(3, integer)), (3, integer))
+
+        def test_outputs_symbols_with_integers(self):
+            entry_list = (
+                CIRInstruction(instruction='sub_symbol_integer', argument=('sym(n)', -2)),
+                CIRInstruction(instruction='call_symbol', argument=('sym(print)', 1)),
+            )
+            program = pack(entry_list)
+
+            self.assertEqual(unpack(program), entry_list)
+            self.assertEqual(output(program), 'sub_symbol_integer sym(n) -2\n    call_symbol sym(print) 1')
+
+    unittest.main()
@@ -1,8 +1,7 @@
-import collections
-
 import parsing
+import util
 
-DesugaredBuiltinExpression = collections.namedtuple(
+DesugaredBuiltinExpression = util.node_type(
     'DesugaredBuiltinExpression',
     (
         'metadata',
@@ -10,7 +9,7 @@ DesugaredBuiltinExpression = collections.namedtuple(
     ),
 )
 
-DesugaredFunctionCallExpression = collections.namedtuple(
+DesugaredFunctionCallExpression = util.node_type(
     'DesugaredFunctionCallExpression',
     (
         'metadata',
@@ -19,7 +18,7 @@ DesugaredFunctionCallExpression = collections.namedtuple(
     ),
 )
 
-DesugaredIfExpression = collections.namedtuple(
+DesugaredIfExpression = util.node_type(
     'DesugaredIfExpression',
     (
         'condition_expression',
@@ -28,14 +27,14 @@ DesugaredIfExpression = collections.namedtuple(
     ),
 )
 
-DesugaredIntegerLiteralExpression = collections.namedtuple(
+DesugaredIntegerLiteralExpression = util.node_type(
     'DesugaredIntegerLiteralExpression',
     (
         'integer',
     ),
 )
 
-_DesugaredLambdaExpression = collections.namedtuple(
+_DesugaredLambdaExpression = util.node_type(
     'DesugaredLambdaExpression',
     (
         'name',
@@ -45,27 +44,29 @@ _DesugaredLambdaExpression = collections.namedtuple(
 )
 
 class DesugaredLambdaExpression(_DesugaredLambdaExpression):
-    def __new__(cls, *args, **kwargs):
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
         if 'name' not in kwargs:
             kwargs['name'] = None
 
-        return super(DesugaredLambdaExpression, cls).__new__(cls, *args, **kwargs)
+        super(DesugaredLambdaExpression, self).__init__(*args, **kwargs)
 
-DesugaredListLiteralExpression = collections.namedtuple(
+DesugaredListLiteralExpression = util.node_type(
     'DesugaredListLiteralExpression',
     (
         'item_expression_list',
     ),
 )
 
-DesugaredStringLiteralExpression = collections.namedtuple(
+DesugaredStringLiteralExpression = util.node_type(
     'DesugaredStringLiteralExpression',
     (
         'string',
     ),
 )
 
-DesugaredSymbolExpressionPair = collections.namedtuple(
+DesugaredSymbolExpressionPair = util.node_type(
     'DesugaredSymbolExpressionPair',
     (
         'symbol',
@@ -73,14 +74,14 @@ DesugaredSymbolExpressionPair = collections.namedtuple(
     ),
 )
 
-DesugaredStructureLiteralExpression = collections.namedtuple(
+DesugaredStructureLiteralExpression = util.node_type(
     'DesugaredStructureLiteralExpression',
     (
         'fields',
     ),
 )
 
-DesugaredSymbolExpression = collections.namedtuple(
+DesugaredSymbolExpression = util.node_type(
     'DesugaredSymbolExpression',
     (
         'metadata',
@@ -88,7 +89,7 @@ DesugaredSymbolExpression = collections.namedtuple(
     ),
 )
 
-DesugaredAssignmentStatement = collections.namedtuple(
+DesugaredAssignmentStatement = util.node_type(
     'DesugaredAssignmentStatement',
     (
         'target',
@@ -96,14 +97,14 @@ DesugaredAssignmentStatement = collections.namedtuple(
     ),
 )
 
-DesugaredExpressionStatement = collections.namedtuple(
+DesugaredExpressionStatement = util.node_type(
     'DesugaredExpressionStatement',
     (
         'expression',
     ),
 )
 
-DesugaredProgram = collections.namedtuple(
+DesugaredProgram = util.node_type(
     'DesugaredProgram',
     (
         'statement_list',
@@ -111,25 +112,32 @@ DesugaredProgram = collections.namedtuple(
 )
 
 def desugar_function_call_expression(expression):
+    function = yield desugar_expression(expression.function)
+    argument_list = yield desugar_expression_list(expression.arguments)
+
     return DesugaredFunctionCallExpression(
         metadata=expression.metadata,
-        function=desugar_expression(expression.function),
-        argument_list=tuple(desugar_expression(e) for e in expression.arguments),
+        function=function,
+        argument_list=argument_list,
     )
 
 def desugar_if_expression(expression):
+    condition_expression = yield desugar_expression(expression.condition_expression)
+    if_statement_list = yield desugar_statement_list(expression.if_statement_list)
+    else_statement_list = yield desugar_statement_list(expression.else_statement_list)
+
     return DesugaredIfExpression(
-        condition_expression=desugar_expression(expression.condition_expression),
-        if_statement_list=tuple(desugar_statement(s) for s in expression.if_statement_list),
-        else_statement_list=tuple(desugar_statement(s) for s in expression.else_statement_list),
+        condition_expression=condition_expression,
+        if_statement_list=if_statement_list,
+        else_statement_list=else_statement_list,
     )
 
 def desugar_infix_expression(expression):
     if expression.operator == 'and':
         return DesugaredIfExpression(
-            condition_expression=desugar_expression(expression.left),
+            condition_expression=(yield desugar_expression(expression.left)),
             if_statement_list=(
-                DesugaredExpressionStatement(expression=desugar_expression(expression.right)),
+                DesugaredExpressionStatement(expression=(yield desugar_expression(expression.right))),
             ),
             else_statement_list=(
                 DesugaredExpressionStatement(
@@ -143,7 +151,7 @@ def desugar_infix_expression(expression):
 
     if expression.operator == 'or':
         return DesugaredIfExpression(
-            condition_expression=desugar_expression(expression.left),
+            condition_expression=(yield desugar_expression(expression.left)),
             if_statement_list=(
                 DesugaredExpressionStatement(
                     expression=DesugaredSymbolExpression(
@@ -153,7 +161,7 @@ def desugar_infix_expression(expression):
                 ),
             ),
             else_statement_list=(
-                DesugaredExpressionStatement(expression=desugar_expression(expression.right)),
+                DesugaredExpressionStatement(expression=(yield desugar_expression(expression.right))),
             ),
         )
 
@@ -165,7 +173,7 @@ def desugar_infix_expression(expression):
                 symbol='__field__',
             ),
             argument_list=(
-                desugar_expression(expression.left),
+                (yield desugar_expression(expression.left)),
                 DesugaredStringLiteralExpression(string=expression.right.symbol),
             ),
         )
@@ -192,8 +200,8 @@ def desugar_infix_expression(expression):
             symbol=function,
         ),
         argument_list=(
-            desugar_expression(expression.left),
-            desugar_expression(expression.right),
+            (yield desugar_expression(expression.left)),
+            (yield desugar_expression(expression.right)),
         ),
     )
 
@@ -205,7 +213,7 @@ def desugar_integer_literal_expression(expression):
 def desugar_lambda_expression(expression):
     return DesugaredLambdaExpression(
         argument_name_list=expression.argument_name_list,
-        statement_list=tuple(desugar_statement(s) for s in expression.statement_list),
+        statement_list=(yield desugar_statement_list(expression.statement_list)),
     )
 
 def desugar_list_item_expression(expression):
@@ -216,14 +224,14 @@ def desugar_list_item_expression(expression):
             symbol='__get__',
         ),
         argument_list=(
-            desugar_expression(expression.list_expression),
-            desugar_expression(expression.index_expression),
+            (yield desugar_expression(expression.list_expression)),
+            (yield desugar_expression(expression.index_expression)),
         ),
     )
 
 def desugar_list_literal_expression(expression):
     return DesugaredListLiteralExpression(
-        item_expression_list=tuple(desugar_expression(i) for i in expression.item_expression_list),
+        item_expression_list=(yield desugar_expression_list(expression.item_expression_list)),
     )
 
 def desugar_negation_expression(expression):
@@ -234,7 +242,7 @@ def desugar_negation_expression(expression):
             symbol='__negate__',
         ),
         argument_list=(
-            desugar_expression(expression.value),
+            (yield desugar_expression(expression.value)),
         ),
     )
 
@@ -244,13 +252,16 @@ def desugar_string_literal_expression(expression):
     )
 
 def desugar_structure_literal_expression(expression):
+    fields = []
+
+    for p in expression.fields:
+        fields.append(DesugaredSymbolExpressionPair(
+            symbol=p.symbol,
+            expression=(yield desugar_expression(p.expression)),
+        ))
+
     return DesugaredStructureLiteralExpression(
-        fields=tuple(
-            DesugaredSymbolExpressionPair(
-                symbol=p.symbol,
-                expression=desugar_expression(p.expression),
-            ) for p in expression.fields
-        ),
+        fields=tuple(fields),
     )
 
 def desugar_symbol_expression(expression):
@@ -259,30 +270,43 @@ def desugar_symbol_expression(expression):
         symbol=expression.symbol,
     )
 
+# The desugar_* functions that contain subexpressions are generators, which
+# util.trampoline runs without recursing on the Python stack. The ones for
+# leaves are plain functions, which the trampoline passes straight through.
+_EXPRESSION_DESUGARERS = {
+    parsing.FurFunctionCallExpression: desugar_function_call_expression,
+    parsing.FurIfExpression: desugar_if_expression,
+    parsing.FurInfixExpression: desugar_infix_expression,
+    parsing.FurIntegerLiteralExpression: desugar_integer_literal_expression,
+    parsing.FurLambdaExpression: desugar_lambda_expression,
+    parsing.FurListItemExpression: desugar_list_item_expression,
+    parsing.FurListLiteralExpression: desugar_list_literal_expression,
+    parsing.FurNegationExpression: desugar_negation_expression,
+    parsing.FurStringLiteralExpression: desugar_string_literal_expression,
+    parsing.FurStructureLiteralExpression: desugar_structure_literal_expression,
+    parsing.FurSymbolExpression: desugar_symbol_expression,
+}
+
 def desugar_expression(expression):
-    return {
-        parsing.FurFunctionCallExpression: desugar_function_call_expression,
-        parsing.FurIfExpression: desugar_if_expression,
-        parsing.FurInfixExpression: desugar_infix_expression,
-        parsing.FurIntegerLiteralExpression: desugar_integer_literal_expression,
-        parsing.FurLambdaExpression: desugar_lambda_expression,
-        parsing.FurListItemExpression: desugar_list_item_expression,
-        parsing.FurListLiteralExpression: desugar_list_literal_expression,
-        parsing.FurNegationExpression: desugar_negation_expression,
-        parsing.FurStringLiteralExpression: desugar_string_literal_expression,
-        parsing.FurStructureLiteralExpression: desugar_structure_literal_expression,
-        parsing.FurSymbolExpression: desugar_symbol_expression,
-    }[type(expression)](expression)
+    return _EXPRESSION_DESUGARERS[type(expression)](expression)
+
+def desugar_expression_list(expression_list):
+    result = []
+
+    for expression in expression_list:
+        result.append((yield desugar_expression(expression)))
+
+    return tuple(result)
 
 def desugar_assignment_statement(statement):
     return DesugaredAssignmentStatement(
         target=statement.target,
-        expression=desugar_expression(statement.expression),
+        expression=(yield desugar_expression(statement.expression)),
     )
 
 def desugar_expression_statement(statement):
     return DesugaredExpressionStatement(
-        expression=desugar_expression(statement.expression),
+        expression=(yield desugar_expression(statement.expression)),
     )
 
 def desugar_function_definition_statement(statement):
@@ -291,18 +315,36 @@ def desugar_function_definition_statement(statement):
         expression=DesugaredLambdaExpression(
             name=statement.name,
             argument_name_list=statement.argument_name_list,
-            statement_list=tuple(desugar_statement(s) for s in statement.statement_list),
+            statement_list=(yield desugar_statement_list(statement.statement_list)),
         ),
     )
 
+_STATEMENT_DESUGARERS = {
+    parsing.FurAssignmentStatement: desugar_assignment_statement,
+    parsing.FurExpressionStatement: desugar_expression_statement,
+    parsing.FurFunctionDefinitionStatement: desugar_function_definition_statement,
+}
+
 def desugar_statement(statement):
-    return {
-        parsing.FurAssignmentStatement: desugar_assignment_statement,
-        parsing.FurExpressionStatement: desugar_expression_statement,
-        parsing.FurFunctionDefinitionStatement: desugar_function_definition_statement,
-    }[type(statement)](statement)
+    return _STATEMENT_DESUGARERS[type(statement)](statement)
+
+def desugar_statement_list(statement_list):
+    result = []
+
+    for statement in statement_list:
+        result.append((yield desugar_statement(statement)))
+
+    return tuple(result)
+
+def _desugar_program(program):
+    statement_list = []
+
+    for statement in program.statement_list:
+        statement_list.append((yield desugar_statement(statement)))
 
-def desugar(program):
     return DesugaredProgram(
-        statement_list=[desugar_statement(s) for s in program.statement_list],
+        statement_list=statement_list,
     )
+
+def desugar(program):
+    return util.trampoline(_desugar_program(program))
@@ -0,0 +1,233 @@
+import collections
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+import benchmark_suite
+import c_generation
+import compilation
+import crossplatform_ir_generation
+import optimization
+import program_generation
+import runtime_benchmarks
+
+# Usage:
+#     python instruction_traces.py                          traces every benchmark program
+#     python instruction_traces.py calls nesting            traces some of them
+#     python instruction_traces.py examples/04_math.fur     also traces any .fur file
+#     python instruction_traces.py --unfused                traces without superinstructions
+#     python instruction_traces.py --length=3 --top=20      longest sequence and rows reported
+#     python instruction_traces.py --limit=100000           instructions traced per program
+#
+# Mines candidate superinstructions. Each program is compiled, built with
+# -DTRACE, which makes program2.c print the index of each instruction it
+# runs, and run. The sequences of up to --length instructions which ran one
+# after another are counted over all the programs, and reported by how many
+# dispatches fusing each would have saved. A sequence never spans a jump, a
+# call or a return, or starts partway into one which does, and never runs
+# into a label, since a superinstruction can't be jumped into the middle of.
+#
+# The programs are the workloads in runtime_benchmarks.py and the shapes in
+# TRACED_SHAPES, at their small size in benchmark_suite.py. With --unfused
+# they are optimized without superinstruction_fusion, which shows the
+# sequences a superinstruction would replace rather than those left over.
+#
+# Sequences overlap, so the savings of two which share instructions can't
+# both be had, and a program which aborts is traced up to where it aborted.
+
+# Go to the directory of the current file so we know where we are in the filesystem
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_LENGTH = 4
+DEFAULT_TOP = 30
+DEFAULT_LIMIT = 1000000
+TIMEOUT = 60
+
+TRACE_PREFIX = b'trace '
+
+# A call to a builtin goes on to the next instruction, but a call to a
+# closure doesn't, so nothing can be fused after a call any more than after
+# a jump or a return, or a superinstruction which ends in one
+_TRANSFERRING_INSTRUCTIONS = set(('call', 'jump', 'jump_if_false', 'return'))
+
+# The shapes which run to completion. The runtime can't yet pass arguments
+# to a closure, which the other shapes which compile to C do, so they abort
+# after a few instructions and would add nothing to the counts.
+TRACED_SHAPES = ('nesting', 'operators')
+
+CONTROL_INSTRUCTIONS = _TRANSFERRING_INSTRUCTIONS | set(
+    name
+    for name, pattern, _ in optimization.SUPERINSTRUCTIONS
+    if crossplatform_ir_generation.OPCODES[pattern[-1]] in _TRANSFERRING_INSTRUCTIONS
+)
+
+def benchmark_programs():
+    programs = {name: source for name, (source, _) in runtime_benchmarks.WORKLOADS.items()}
+
+    for shape, small_size, _, _ in benchmark_suite.SUITE:
+        if shape in TRACED_SHAPES:
+            programs[shape] = program_generation.SHAPES[shape](small_size)
+
+    return programs
+
+def compile_traced(source, directory, optimizations):
+    program = optimization.optimize(compilation.generate_cir(source), optimizations=optimizations)
+    labels_to_instruction_indices, instruction_list = c_generation.separate_labels_and_instructions(program)
+
+    source_path = os.path.join(directory, 'traced.c')
+    executable_path = os.path.join(directory, 'traced')
+
+    with open(source_path, 'w') as f:
+        f.write(c_generation.generate(program))
+
+    subprocess.run(
+        ['gcc', '-DTRACE', '-o', executable_path, source_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        timeout=TIMEOUT,
+        check=True,
+    )
+
+    names = tuple(name for name, _ in instruction_list)
+    return executable_path, names, set(labels_to_instruction_indices.values())
+
+# Counts each sequence of up to length instructions in the trace of the
+# executable into counts, and returns how many instructions ran and how the
+# run ended
+def count_sequences(executable_path, names, labelled, length, limit, counts):
+    process = subprocess.Popen(
+        [executable_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    timer = threading.Timer(TIMEOUT, process.kill)
+    timer.start()
+
+    # The instructions which ran one after another, up to the one which ran last
+    window = collections.deque(maxlen=length)
+    previous = None
+    traced = 0
+
+    try:
+        for line in process.stderr:
+            if not line.startswith(TRACE_PREFIX):
+                continue
+
+            index = int(line[len(TRACE_PREFIX):])
+
+            if previous is None or index != previous + 1 or index in labelled or names[previous] in CONTROL_INSTRUCTIONS:
+                window.clear()
+
+            previous = index
+            window.append(names[index])
+            sequence = tuple(window)
+
+            for start in range(len(sequence) - 1):
+                counts[sequence[start:]] += 1
+
+            traced += 1
+
+            if traced == limit:
+                process.kill()
+                break
+
+        process.wait()
+
+    finally:
+        timer.cancel()
+        process.stderr.close()
+
+    if traced == limit:
+        return traced, 'stopped at --limit'
+
+    if process.returncode == 0:
+        return traced, 'ok'
+
+    return traced, 'exited with {}'.format(process.returncode)
+
+def print_counts(counts, total, top):
+    print('{:>12} {:>10} {:>8}  {}'.format('saved', 'count', 'share', 'sequence'))
+
+    ranked = sorted(
+        counts.items(),
+        key=lambda item: (-item[1] * (len(item[0]) - 1), item[0]),
+    )
+
+    for sequence, count in ranked[:top]:
+        print('{:>12} {:>10} {:>7.1%}  {}'.format(
+            count * (len(sequence) - 1),
+            count,
+            count * len(sequence) / total,
+            '; '.join(sequence),
+        ))
+
+def main(arguments):
+    flags = [argument for argument in arguments if argument.startswith('--')]
+    names = [argument for argument in arguments if not argument.startswith('--')]
+
+    programs = benchmark_programs()
+    names = names or sorted(programs)
+
+    length = DEFAULT_LENGTH
+    top = DEFAULT_TOP
+    limit = DEFAULT_LIMIT
+    optimizations = optimization.OPTIMIZATIONS
+
+    for flag in flags:
+        if flag.startswith('--length='):
+            length = int(flag[len('--length='):])
+        elif flag.startswith('--top='):
+            top = int(flag[len('--top='):])
+        elif flag.startswith('--limit='):
+            limit = int(flag[len('--limit='):])
+        elif flag == '--unfused':
+            optimizations = tuple(
+                optimizer
+                for optimizer in optimization.OPTIMIZATIONS
+                if optimizer is not optimization.superinstruction_fusion
+            )
+        else:
+            raise Exception('Unknown flag "{}"'.format(flag))
+
+    counts = collections.Counter()
+    total = 0
+
+    print('{:>10}  {:<24} {}'.format('traced', 'status', 'program'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            if name.endswith('.fur'):
+                with open(name, 'r') as f:
+                    source = f.read()
+            elif name in programs:
+                source = programs[name]
+            else:
+                raise Exception('Unknown program "{}"'.format(name))
+
+            try:
+                executable_path, instruction_names, labelled = compile_traced(source, directory, optimizations)
+            # C generation can't generate every instruction yet
+            except Exception as e:
+                print('{:>10}  {:<24} {}'.format('-', 'did not compile', name))
+                print('{:>10}  {}'.format('', e))
+                continue
+
+            traced, status = count_sequences(executable_path, instruction_names, labelled, length, limit, counts)
+            total += traced
+            print('{:>10}  {:<24} {}'.format(traced, status, name))
+
+    print()
+
+    if total == 0:
+        print('Nothing was traced')
+        return 1
+
+    print_counts(counts, total, top)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,128 +1,217 @@
+import concurrent.futures
 import os
 import os.path
+import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 # Go to the directory of the current file so we know where we are in the filesystem
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
-class OutputTests(unittest.TestCase):
-    pass
+# Each example is compiled once, into its own directory, and the one binary is
+# used by both its output test and its memory leak test. Each test case class
+# starts its checks in a pool of threads, one per CPU, when it is set up, and
+# each test waits for its own check, so the tests run concurrently even though
+# unittest reports them one at a time. Every check's wall time is printed at
+# the end.
 
-def add_example_output_test(filename):
-    def test(self):
-        compile_fur_to_c_result = subprocess.call([
-            'python',
-            'main.py',
-            os.path.join('examples', filename),
-        ])
+# No example takes anywhere near this long, even under valgrind, so one that
+# does has hung
+TIMEOUT = 60
 
-        if compile_fur_to_c_result != 0:
-            raise Exception('Example "{}" did not compile'.format(filename))
+filenames = sorted(
+    entry.name
+    for entry in os.scandir('examples')
+    if entry.is_file()
+    if entry.name.endswith('.fur')
+)
 
-        compile_c_to_executable_result = subprocess.call([
-            'gcc',
-            os.path.join('examples', filename + '.c'),
-        ])
+_directory = None
+_executor = None
+_builds = {}
+_build_locks = {filename: threading.Lock() for filename in filenames}
+_checks = {}
+_timings = []
+_failed = set()
+
+def _timed(kind, filename, function, *args):
+    start = time.perf_counter()
+
+    try:
+        return function(*args)
+    finally:
+        _timings.append((time.perf_counter() - start, kind, filename))
+
+def _example_directory(filename):
+    return os.path.join(_directory, filename)
+
+def _compile(filename):
+    directory = _example_directory(filename)
+    os.mkdir(directory)
+    source_path = os.path.join(directory, filename)
+    shutil.copyfile(os.path.join('examples', filename), source_path)
+
+    compile_fur_to_c_result = subprocess.call(
+        ['python', 'main.py', source_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        timeout=TIMEOUT,
+    )
+
+    if compile_fur_to_c_result != 0:
+        raise Exception('Example "{}" did not compile'.format(filename))
+
+    executable_path = os.path.join(directory, 'a.out')
+
+    compile_c_to_executable_result = subprocess.call(
+        ['gcc', '-ggdb3', '-o', executable_path, source_path + '.c'],
+        timeout=TIMEOUT,
+    )
+
+    if compile_c_to_executable_result != 0:
+        raise Exception('Example output "{}" did not compile'.format(filename + '.c'))
+
+    return executable_path
+
+# The first check of an example to get here compiles it, and the other waits
+# for it; a failed compile fails both
+def _build(filename):
+    with _build_locks[filename]:
+        if filename not in _builds:
+            try:
+                _builds[filename] = (_timed('build', filename, _compile, filename), None)
+            except Exception as e:
+                _builds[filename] = (None, e)
+
+    executable_path, error = _builds[filename]
+
+    if error is not None:
+        raise error
+
+    return executable_path
+
+def _run_output_check(filename):
+    executable_path = _build(filename)
+
+    p = subprocess.run(
+        [executable_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=TIMEOUT,
+    )
+
+    return p.stdout, p.stderr
+
+def _run_memory_leak_check(filename):
+    executable_path = _build(filename)
+
+    return subprocess.call(
+        [
+            'valgrind',
+            '--tool=memcheck',
+            '--leak-check=yes',
+            '--show-reachable=yes',
+            '--num-callers=20',
+            '--track-fds=yes',
+            '--error-exitcode=42',
+            '-q',
+            executable_path,
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        timeout=TIMEOUT,
+    )
+
+def setUpModule():
+    global _directory, _executor
+
+    _directory = tempfile.mkdtemp(prefix='fur-integration-tests-')
+    _executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def _start_checks(kind, check):
+    for filename in filenames:
+        _checks[kind, filename] = _executor.submit(_timed, kind, filename, check, filename)
+
+def tearDownModule():
+    _executor.shutdown(wait=True, cancel_futures=True)
+
+    for seconds, kind, filename in sorted(_timings, reverse=True):
+        print('{:>8.3f}s  {:<12} {}'.format(seconds, kind, filename), file=sys.stderr)
+
+    # Keep what failing examples compiled to, since it can be useful to have
+    for filename in filenames:
+        if filename in _failed:
+            print('Kept {}'.format(_example_directory(filename)), file=sys.stderr)
+        else:
+            shutil.rmtree(_example_directory(filename), ignore_errors=True)
+
+    if not _failed:
+        shutil.rmtree(_directory, ignore_errors=True)
+
+def _check_result(kind, filename):
+    try:
+        return _checks[kind, filename].result()
+    except BaseException:
+        _failed.add(filename)
+        raise
 
-        if compile_c_to_executable_result != 0:
-            raise Exception('Example output "{}" did not compile'.format(filename + '.c'))
+class OutputTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        _start_checks('output', _run_output_check)
 
-        try:
-            p = subprocess.Popen('./a.out', stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            actual_stdout, actual_stderr = p.communicate()
+def add_example_output_test(filename):
+    def test(self):
+        actual_stdout, actual_stderr = _check_result('output', filename)
 
-            expected_stdout_path = os.path.join('examples', filename + '.stdout.txt')
+        expected_stdout_path = os.path.join('examples', filename + '.stdout.txt')
 
-            if os.path.isfile(expected_stdout_path):
-                with open(expected_stdout_path, 'rb') as f:
-                    expected_stdout = f.read()
-            else:
-                expected_stdout = b''
+        if os.path.isfile(expected_stdout_path):
+            with open(expected_stdout_path, 'rb') as f:
+                expected_stdout = f.read()
+        else:
+            expected_stdout = b''
 
-            expected_stderr_path = os.path.join('examples', filename + '.stderr.txt')
+        expected_stderr_path = os.path.join('examples', filename + '.stderr.txt')
 
-            if os.path.isfile(expected_stderr_path):
-                with open(expected_stderr_path, 'rb') as f:
-                    expected_stderr = f.read()
-            else:
-                expected_stderr = b''
+        if os.path.isfile(expected_stderr_path):
+            with open(expected_stderr_path, 'rb') as f:
+                expected_stderr = f.read()
+        else:
+            expected_stderr = b''
 
+        try:
             self.assertEqual(expected_stderr, actual_stderr)
-
-            # We don't clean up the C file in the finally clause because it can be useful to have in case of errors
-            os.remove(os.path.join('examples', filename + '.c'))
-
-        finally:
-            try:
-                os.remove('a.out')
-            except OSError:
-                pass
+        except AssertionError:
+            _failed.add(filename)
+            raise
 
     setattr(OutputTests, 'test_' + filename, test)
 
 class MemoryLeakTests(unittest.TestCase):
-    pass
+    @classmethod
+    def setUpClass(cls):
+        _start_checks('memory leak', _run_memory_leak_check)
 
 def add_example_memory_leak_test(filename):
     def test(self):
-        compile_fur_to_c_result = subprocess.call([
-            'python',
-            'main.py',
-            os.path.join('examples', filename),
-        ])
-
-        if compile_fur_to_c_result != 0:
-            raise Exception('Example "{}" did not compile'.format(filename))
-
-        compile_c_to_executable_result = subprocess.call([
-            'gcc',
-            '-ggdb3',
-            os.path.join('examples', filename + '.c'),
-        ])
-
-        if compile_c_to_executable_result != 0:
-            raise Exception('Example output "{}" did not compile'.format(filename + '.c'))
+        expected_return = 0
+        actual_return = _check_result('memory leak', filename)
 
         try:
-            with open(os.devnull, 'w') as devnull:
-                expected_return = 0
-                actual_return = subprocess.call(
-                    [
-                        'valgrind',
-                        '--tool=memcheck',
-                        '--leak-check=yes',
-                        '--show-reachable=yes',
-                        '--num-callers=20',
-                        '--track-fds=yes',
-                        '--error-exitcode=42',
-                        '-q',
-                        './a.out',
-                    ],
-                    stdout=devnull,
-                    stderr=devnull,
-                )
-
-                self.assertEqual(expected_return, actual_return)
-
-                # We don't clean up the C file in the finally clause because it can be useful to have in case of errors
-                os.remove(os.path.join('examples', filename + '.c'))
-
-        finally:
-            try:
-                os.remove('a.out')
-            except OSError:
-                pass
+            self.assertEqual(expected_return, actual_return)
+        except AssertionError:
+            _failed.add(filename)
+            raise
 
     setattr(MemoryLeakTests, 'test_' + filename, test)
 
-filenames = (
-    entry.name
-    for entry in os.scandir('examples')
-    if entry.is_file()
-    if entry.name.endswith('.fur')
-)
-
 for filename in filenames:
     add_example_output_test(filename)
     add_example_memory_leak_test(filename)
@@ -0,0 +1,381 @@
+import conversion
+import desugaring
+import parsing
+import util
+
+# Lowers the parsed tree straight to the CPS tree, doing the work of
+# desugaring, normalization and conversion in a single traversal. It builds
+# the same tree as conversion.convert(normalization.normalize(desugaring.desugar(program))),
+# without building the two trees in between. Those passes are still there,
+# and running them separately is the easier way to see what each step does.
+#
+# As in normalization, the lower_* functions thread the counter for temporary
+# variables and append the statements which have to run before an expression
+# to the prestatements list they are given.
+
+_INFIX_OPERATOR_BUILTINS = {
+    '++': '__concat__',
+    '+': '__add__',
+    '-': '__subtract__',
+    '*': '__multiply__',
+    '//': '__integer_divide__',
+    '%': '__modular_divide__',
+    '<': '__lt__',
+    '>': '__gt__',
+    '<=': '__lte__',
+    '>=': '__gte__',
+    '==': '__eq__',
+    '!=': '__neq__',
+}
+
+def _lower_function_call(counter, prestatements, metadata, function, argument_list):
+    for argument in argument_list:
+        counter, lowered_argument = yield lower_expression(counter, prestatements, argument)
+
+        prestatements.append(
+            conversion.CPSPushStatement(
+                expression=lowered_argument,
+            ),
+        )
+
+    counter, function_expression = yield lower_expression(counter, prestatements, function)
+
+    return (
+        counter,
+        conversion.CPSFunctionCallExpression(
+            metadata=metadata,
+            function_expression=function_expression,
+            argument_count=len(argument_list),
+        ),
+    )
+
+def _lower_if(counter, prestatements, condition_expression, if_statement_list, else_statement_list):
+    counter, condition_expression = yield lower_expression(
+        counter,
+        prestatements,
+        condition_expression,
+    )
+
+    counter, if_statement_list = yield lower_statement_list(counter, if_statement_list)
+    counter, else_statement_list = yield lower_statement_list(counter, else_statement_list)
+
+    return (
+        counter,
+        conversion.CPSIfElseExpression(
+            condition_expression=condition_expression,
+            if_statement_list=if_statement_list,
+            else_statement_list=else_statement_list,
+        ),
+    )
+
+def _lower_lambda(counter, prestatements, name, argument_name_list, statement_list):
+    variable = '${}'.format(counter)
+
+    _, statement_list = yield lower_statement_list(0, statement_list)
+
+    prestatements.append(
+        conversion.CPSVariableInitializationStatement(
+            variable=variable,
+            expression=conversion.CPSLambdaExpression(
+                name=name,
+                argument_name_list=argument_name_list,
+                statement_list=statement_list,
+            ),
+        ),
+    )
+
+    return (
+        counter + 1,
+        conversion.CPSVariableExpression(variable=variable),
+    )
+
+def lower_builtin_expression(counter, prestatements, expression):
+    return (
+        counter,
+        conversion.CPSBuiltinExpression(symbol=expression.symbol),
+    )
+
+def lower_function_call_expression(counter, prestatements, expression):
+    return _lower_function_call(
+        counter,
+        prestatements,
+        expression.metadata,
+        expression.function,
+        expression.arguments,
+    )
+
+def lower_if_expression(counter, prestatements, expression):
+    return _lower_if(
+        counter,
+        prestatements,
+        expression.condition_expression,
+        expression.if_statement_list,
+        expression.else_statement_list,
+    )
+
+def lower_infix_expression(counter, prestatements, expression):
+    if expression.operator == 'and':
+        return _lower_if(
+            counter,
+            prestatements,
+            expression.left,
+            (parsing.FurExpressionStatement(expression=expression.right),),
+            (
+                parsing.FurExpressionStatement(
+                    expression=parsing.FurSymbolExpression(
+                        metadata=expression.metadata,
+                        symbol='false',
+                    ),
+                ),
+            ),
+        )
+
+    if expression.operator == 'or':
+        return _lower_if(
+            counter,
+            prestatements,
+            expression.left,
+            (
+                parsing.FurExpressionStatement(
+                    expression=parsing.FurSymbolExpression(
+                        metadata=expression.metadata,
+                        symbol='true',
+                    ),
+                ),
+            ),
+            (parsing.FurExpressionStatement(expression=expression.right),),
+        )
+
+    if expression.operator == '.':
+        return _lower_function_call(
+            counter,
+            prestatements,
+            expression.metadata,
+            parsing.FurSymbolExpression(
+                metadata=expression.metadata,
+                symbol='__field__',
+            ),
+            (
+                expression.left,
+                parsing.FurStringLiteralExpression(string=expression.right.symbol),
+            ),
+        )
+
+    return _lower_function_call(
+        counter,
+        prestatements,
+        expression.metadata,
+        desugaring.DesugaredBuiltinExpression(
+            metadata=expression.metadata,
+            symbol=_INFIX_OPERATOR_BUILTINS[expression.operator],
+        ),
+        (expression.left, expression.right),
+    )
+
+def lower_integer_literal_expression(counter, prestatements, expression):
+    return (
+        counter,
+        conversion.CPSIntegerLiteralExpression(integer=expression.integer),
+    )
+
+def lower_lambda_expression(counter, prestatements, expression):
+    return _lower_lambda(
+        counter,
+        prestatements,
+        None,
+        expression.argument_name_list,
+        expression.statement_list,
+    )
+
+def lower_list_item_expression(counter, prestatements, expression):
+    return _lower_function_call(
+        counter,
+        prestatements,
+        expression.metadata,
+        desugaring.DesugaredBuiltinExpression(
+            metadata=expression.metadata,
+            symbol='__get__',
+        ),
+        (expression.list_expression, expression.index_expression),
+    )
+
+def lower_list_literal_expression(counter, prestatements, expression):
+    # Normalization reserves a variable for the list, although it never uses
+    # it, and we have to number the variables after it the same way
+    counter += 1
+
+    for item_expression in expression.item_expression_list:
+        counter, lowered = yield lower_expression(counter, prestatements, item_expression)
+
+        prestatements.append(
+            conversion.CPSPushStatement(
+                expression=lowered,
+            ),
+        )
+
+    return (
+        counter,
+        conversion.CPSListConstructExpression(allocate=len(expression.item_expression_list)),
+    )
+
+def lower_negation_expression(counter, prestatements, expression):
+    return _lower_function_call(
+        counter,
+        prestatements,
+        expression.metadata,
+        desugaring.DesugaredBuiltinExpression(
+            metadata=expression.metadata,
+            symbol='__negate__',
+        ),
+        (expression.value,),
+    )
+
+def lower_string_literal_expression(counter, prestatements, expression):
+    return (
+        counter,
+        conversion.CPSStringLiteralExpression(string=expression.string),
+    )
+
+def lower_structure_literal_expression(counter, prestatements, expression):
+    for field in expression.fields:
+        counter, field_expression = yield lower_expression(
+            counter,
+            prestatements,
+            field.expression,
+        )
+
+        prestatements.append(conversion.CPSPushStatement(
+            expression=field_expression,
+        ))
+
+        prestatements.append(conversion.CPSPushStatement(
+            expression=conversion.CPSSymbolLiteralExpression(
+                symbol=field.symbol,
+            ),
+        ))
+
+    return (
+        counter,
+        conversion.CPSStructureLiteralExpression(
+            field_count=len(expression.fields),
+        ),
+    )
+
+def lower_symbol_expression(counter, prestatements, expression):
+    return (
+        counter,
+        conversion.CPSSymbolExpression(symbol=expression.symbol),
+    )
+
+# The lower_* functions that contain subexpressions return generators, which
+# util.trampoline runs, and the ones for leaves return their result directly.
+# Builtins never appear in the parsed tree, but the lowerings above make them
+# for operators, the way desugaring does.
+_EXPRESSION_LOWERERS = {
+    desugaring.DesugaredBuiltinExpression: lower_builtin_expression,
+    parsing.FurFunctionCallExpression: lower_function_call_expression,
+    parsing.FurIfExpression: lower_if_expression,
+    parsing.FurInfixExpression: lower_infix_expression,
+    parsing.FurIntegerLiteralExpression: lower_integer_literal_expression,
+    parsing.FurLambdaExpression: lower_lambda_expression,
+    parsing.FurListItemExpression: lower_list_item_expression,
+    parsing.FurListLiteralExpression: lower_list_literal_expression,
+    parsing.FurNegationExpression: lower_negation_expression,
+    parsing.FurStringLiteralExpression: lower_string_literal_expression,
+    parsing.FurStructureLiteralExpression: lower_structure_literal_expression,
+    parsing.FurSymbolExpression: lower_symbol_expression,
+}
+
+def lower_expression(counter, prestatements, expression):
+    return _EXPRESSION_LOWERERS[type(expression)](counter, prestatements, expression)
+
+def lower_assignment_statement(counter, prestatements, statement):
+    counter, lowered_expression = yield lower_expression(counter, prestatements, statement.expression)
+
+    return (
+        counter,
+        conversion.CPSAssignmentStatement(
+            target=statement.target,
+            expression=lowered_expression,
+        ),
+    )
+
+def lower_expression_statement(counter, prestatements, statement):
+    counter, lowered_expression = yield lower_expression(counter, prestatements, statement.expression)
+
+    return (
+        counter,
+        conversion.CPSExpressionStatement(expression=lowered_expression),
+    )
+
+def lower_function_definition_statement(counter, prestatements, statement):
+    counter, lambda_expression = yield _lower_lambda(
+        counter,
+        prestatements,
+        statement.name,
+        statement.argument_name_list,
+        statement.statement_list,
+    )
+
+    return (
+        counter,
+        conversion.CPSAssignmentStatement(
+            target=statement.name,
+            expression=lambda_expression,
+        ),
+    )
+
+_STATEMENT_LOWERERS = {
+    parsing.FurAssignmentStatement: lower_assignment_statement,
+    parsing.FurExpressionStatement: lower_expression_statement,
+    parsing.FurFunctionDefinitionStatement: lower_function_definition_statement,
+}
+
+def lower_statement(counter, prestatements, statement):
+    return _STATEMENT_LOWERERS[type(statement)](counter, prestatements, statement)
+
+def lower_statement_list(counter, statement_list):
+    result_statement_list = []
+
+    for statement in statement_list:
+        # The prestatements of a statement go directly before it in the list
+        counter, lowered = yield lower_statement(counter, result_statement_list, statement)
+        result_statement_list.append(lowered)
+
+    return (
+        counter,
+        tuple(result_statement_list),
+    )
+
+def lower(program):
+    _, statement_list = util.trampoline(lower_statement_list(0, program.statement_list))
+
+    return conversion.CPSProgram(
+        statement_list=statement_list,
+    )
+
+if __name__ == '__main__':
+    import os
+    import unittest
+
+    import normalization
+    import tokenization
+
+    class LowerTests(unittest.TestCase):
+        def test_lowers_examples_like_the_separate_passes(self):
+            examples_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
+
+            for entry in sorted(os.scandir(examples_directory), key=lambda entry: entry.name):
+                if not entry.name.endswith('.fur'):
+                    continue
+
+                with open(entry.path, 'r') as f:
+                    program = parsing.parse(tokenization.tokenize(f.read()))
+
+                with self.subTest(example=entry.name):
+                    self.assertEqual(
+                        lower(program),
+                        conversion.convert(normalization.normalize(desugaring.desugar(program))),
+                    )
+
+    unittest.main()
@@ -1,34 +1,124 @@
+import collections
+import os
 import sys
+import time
 
-import conversion
-import crossplatform_ir_generation
-import desugaring
-import c_generation
-import normalization
+import compilation
 import optimization
-import parsing
-import tokenization
+import profiling
 
-source_path = sys.argv[1]
+# Usage:
+#     python main.py program.fur            compiles program.fur to program.fur.c
+#     python main.py program.fur --furc     also saves the CIR to program.furc
+#     python main.py program.furc           compiles saved CIR to program.furc.c
+#     python main.py examples/ other.fur    compiles every .fur file in examples/,
+#                                           and other.fur, in parallel
+#
+# Compiling a .fur file goes through the cache in compilation.py, unless
+# --no-cache is given. The cache is in FUR_CACHE_DIRECTORY, and is kept under
+# FUR_CACHE_MAX_SIZE bytes. --cache-stats prints its hits and misses to
+# stderr.
+#
+# Given more than one file, or a directory, main.py compiles them in worker
+# processes, --jobs=N of them (by default one per CPU). It prints a line for
+# each file rather than the CIR, and exits with status 1 if any failed.
+#
+# --optimization-stats compiles one file without the cache and prints how
+# many times each optimization in optimization.py applied to stderr.
+#
+# --profile, or --profile=json, compiles one .fur file a pass at a time,
+# bypassing the cache, and prints the time, memory, and input and output size
+# of each pass to stderr as a table or as JSON. --profile-directory=DIR also
+# dumps a cProfile of each pass to DIR/<pass>.prof (see profiling.py).
+#
+# compile_server.py runs the same command line, with paths relative to the
+# client's directory, and compiles batches in its own process.
+def run(arguments, stdout, stderr, directory=None, in_process=False):
+    paths = [argument for argument in arguments if not argument.startswith('--')]
+    flags = [argument for argument in arguments if argument.startswith('--')]
 
-with open(source_path, 'r') as f:
-    source = f.read()
+    if directory is not None:
+        paths = [os.path.join(directory, path) for path in paths]
 
-tokens = tokenization.tokenize(source)
-parsed = parsing.parse(tokens)
-desugared = desugaring.desugar(parsed)
-normalized = normalization.normalize(desugared)
-converted = conversion.convert(normalized)
+    use_cache = '--no-cache' not in flags
+    save_furc = '--furc' in flags
+    profile_format = None
+    profile_directory = None
 
-crossplatform_ir = crossplatform_ir_generation.generate(converted)
-optimized = optimization.optimize(crossplatform_ir)
-outputted = crossplatform_ir_generation.output(optimized)
-print(outputted)
+    for flag in flags:
+        if flag == '--profile':
+            profile_format = 'table'
+        elif flag.startswith('--profile='):
+            profile_format = flag[len('--profile='):]
+        elif flag.startswith('--profile-directory='):
+            profile_directory = flag[len('--profile-directory='):]
 
-generated = c_generation.generate(optimized)
+            if directory is not None:
+                profile_directory = os.path.join(directory, profile_directory)
 
-assert source_path.endswith('.fur')
-destination_path = source_path + '.c'
+    if profile_format is not None:
+        if len(paths) != 1 or not paths[0].endswith('.fur'):
+            raise Exception('--profile expects one .fur file, got {}'.format(paths))
 
-with open(destination_path, 'w') as f:
-    f.write(generated)
+        if profile_format not in profiling.FORMATTERS:
+            raise Exception('Unknown profile format "{}"'.format(profile_format))
+
+        with open(paths[0], 'r') as f:
+            outputted, generated, profiles = profiling.profile_source(f.read(), profile_directory)
+
+        with open(paths[0] + '.c', 'w') as f:
+            f.write(generated)
+
+        print(outputted, file=stdout)
+        print(profiling.FORMATTERS[profile_format](profiles), file=stderr)
+        return 0
+
+    if len(paths) == 1 and not os.path.isdir(paths[0]):
+        counters = None
+
+        if '--optimization-stats' in flags:
+            counters = collections.Counter()
+            use_cache = False
+
+        cache = compilation.open_cache() if use_cache else None
+        outputted = compilation.compile_file(paths[0], cache, save_furc, counters)
+
+        if counters is not None:
+            print(optimization.format_counters(counters) or 'No optimizations applied', file=stderr)
+
+        if cache is not None:
+            cache.evict()
+
+            if '--cache-stats' in flags:
+                print(cache.report(), file=stderr)
+
+        print(outputted, file=stdout)
+        return 0
+
+    workers = 0 if in_process else None
+
+    for flag in flags:
+        if flag.startswith('--jobs=') and not in_process:
+            workers = int(flag[len('--jobs='):])
+
+    source_paths = compilation.find_source_files(paths)
+    failures = 0
+    start = time.perf_counter()
+
+    for result in compilation.compile_files(source_paths, workers, use_cache, save_furc):
+        if result.error is None:
+            print('ok     {:>8.3f}s  {}'.format(result.seconds, result.source_path), file=stdout)
+        else:
+            failures += 1
+            print('FAILED {:>8.3f}s  {}  {}'.format(result.seconds, result.source_path, result.error), file=stdout)
+
+    print('{} compiled, {} failed in {:.3f}s'.format(
+        len(source_paths) - failures,
+        failures,
+        time.perf_counter() - start,
+    ), file=stdout)
+
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(run(sys.argv[1:], sys.stdout, sys.stderr))
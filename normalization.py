@@ -1,30 +1,28 @@
-import collections
-
 import desugaring
 import util
 
-NormalBuiltinExpression = collections.namedtuple(
+NormalBuiltinExpression = util.node_type(
     'NormalBuiltinExpression',
     (
         'symbol',
     ),
 )
 
-NormalVariableExpression = collections.namedtuple(
+NormalVariableExpression = util.node_type(
     'NormalVariableExpression',
     [
         'variable',
     ],
 )
 
-NormalIntegerLiteralExpression = collections.namedtuple(
+NormalIntegerLiteralExpression = util.node_type(
     'NormalIntegerLiteralExpression',
     [
         'integer',
     ],
 )
 
-NormalLambdaExpression = collections.namedtuple(
+NormalLambdaExpression = util.node_type(
     'NormalLambdaExpression',
     (
         'name',
@@ -33,35 +31,35 @@ NormalLambdaExpression = collections.namedtuple(
     ),
 )
 
-NormalStringLiteralExpression = collections.namedtuple(
+NormalStringLiteralExpression = util.node_type(
     'NormalStringLiteralExpression',
     [
         'string',
     ],
 )
 
-NormalSymbolExpression = collections.namedtuple(
+NormalSymbolExpression = util.node_type(
     'NormalSymbolExpression',
     (
         'symbol',
     ),
 )
 
-NormalSymbolLiteralExpression = collections.namedtuple(
+NormalSymbolLiteralExpression = util.node_type(
     'NormalSymbolLiteralExpression',
     (
         'symbol',
     ),
 )
 
-NormalPushStatement = collections.namedtuple(
+NormalPushStatement = util.node_type(
     'NormalPushStatement',
     (
         'expression',
     ),
 )
 
-NormalFunctionCallExpression = collections.namedtuple(
+NormalFunctionCallExpression = util.node_type(
     'NormalFunctionCallExpression',
     [
         'metadata',
@@ -70,7 +68,7 @@ NormalFunctionCallExpression = collections.namedtuple(
     ],
 )
 
-NormalVariableInitializationStatement = collections.namedtuple(
+NormalVariableInitializationStatement = util.node_type(
     'NormalVariableInitializationStatement',
     [
         'variable',
@@ -78,14 +76,14 @@ NormalVariableInitializationStatement = collections.namedtuple(
     ],
 )
 
-NormalExpressionStatement = collections.namedtuple(
+NormalExpressionStatement = util.node_type(
     'NormalExpressionStatement',
     [
         'expression',
     ],
 )
 
-NormalAssignmentStatement = collections.namedtuple(
+NormalAssignmentStatement = util.node_type(
     'NormalAssignmentStatement',
     [
         'target',
@@ -93,7 +91,7 @@ NormalAssignmentStatement = collections.namedtuple(
     ],
 )
 
-NormalIfElseExpression = collections.namedtuple(
+NormalIfElseExpression = util.node_type(
     'NormalIfElseExpression',
     [
         'condition_expression',
@@ -102,72 +100,71 @@ NormalIfElseExpression = collections.namedtuple(
     ],
 )
 
-NormalProgram = collections.namedtuple(
+NormalProgram = util.node_type(
     'NormalProgram',
     [
         'statement_list',
     ],
 )
 
-def normalize_builtin_expression(counter, expression):
+# The normalize_* functions append the statements which have to run before an
+# expression to the prestatements list they are given, rather than returning
+# them. Returning them meant every level of nesting copied the prestatements
+# of the levels below it, which is quadratic in the depth.
+def normalize_builtin_expression(counter, prestatements, expression):
     return (
         counter,
-        (),
         NormalBuiltinExpression(symbol=expression.symbol),
     )
 
-def normalize_integer_literal_expression(counter, expression):
+def normalize_integer_literal_expression(counter, prestatements, expression):
     return (
         counter,
-        (),
         NormalIntegerLiteralExpression(integer=expression.integer),
     )
 
-def normalize_lambda_expression(counter, expression):
+def normalize_lambda_expression(counter, prestatements, expression):
     variable = '${}'.format(counter)
 
-    _, statement_list = normalize_statement_list(
+    _, statement_list = yield normalize_statement_list(
         0,
         expression.statement_list,
     )
 
-    return (
-        counter + 1,
-        (
-            NormalVariableInitializationStatement(
-                variable=variable,
-                expression=NormalLambdaExpression(
-                    name=expression.name,
-                    argument_name_list=expression.argument_name_list,
-                    statement_list=statement_list,
-                ),
+    prestatements.append(
+        NormalVariableInitializationStatement(
+            variable=variable,
+            expression=NormalLambdaExpression(
+                name=expression.name,
+                argument_name_list=expression.argument_name_list,
+                statement_list=statement_list,
             ),
         ),
+    )
+
+    return (
+        counter + 1,
         NormalVariableExpression(variable=variable),
     )
 
-NormalListConstructExpression = collections.namedtuple(
+NormalListConstructExpression = util.node_type(
     'NormalListConstructExpression',
     [
         'allocate',
     ],
 )
 
-def normalize_list_literal_expression(counter, expression):
+def normalize_list_literal_expression(counter, prestatements, expression):
     list_variable = '${}'.format(counter)
     counter += 1
 
-    prestatements = []
-
     for item_expression in expression.item_expression_list:
-        counter, item_expression_prestatements, normalized = normalize_expression(
+        counter, normalized = yield normalize_expression(
             counter,
+            prestatements,
             item_expression,
         )
 
-        for p in item_expression_prestatements:
-            prestatements.append(p)
-
         prestatements.append(
             NormalPushStatement(
                 expression=normalized,
@@ -176,36 +173,30 @@ def normalize_list_literal_expression(counter, expression):
 
     return (
         counter,
-        tuple(prestatements),
         NormalListConstructExpression(allocate=len(expression.item_expression_list)),
     )
 
-def normalize_string_literal_expression(counter, expression):
+def normalize_string_literal_expression(counter, prestatements, expression):
     return (
         counter,
-        (),
         NormalStringLiteralExpression(string=expression.string),
     )
 
-NormalStructureLiteralExpression = collections.namedtuple(
+NormalStructureLiteralExpression = util.node_type(
     'NormalStructureLiteralExpression',
     (
         'field_count',
     ),
 )
 
-def normalize_structure_literal_expression(counter, expression):
-    prestatements = []
-
+def normalize_structure_literal_expression(counter, prestatements, expression):
     for field in expression.fields:
-        counter, field_expression_prestatements, field_expression = normalize_expression(
+        counter, field_expression = yield normalize_expression(
             counter,
+            prestatements,
             field.expression,
         )
 
-        for p in field_expression_prestatements:
-            prestatements.append(p)
-
         prestatements.append(NormalPushStatement(
             expression=field_expression,
         ))
@@ -218,27 +209,20 @@ def normalize_structure_literal_expression(counter, expression):
 
     return (
         counter,
-        tuple(prestatements),
         NormalStructureLiteralExpression(
             field_count=len(expression.fields),
         ),
     )
 
-def normalize_symbol_expression(counter, expression):
+def normalize_symbol_expression(counter, prestatements, expression):
     return (
         counter,
-        (),
         NormalSymbolExpression(symbol=expression.symbol),
     )
 
-def normalize_function_call_expression(counter, expression):
-    prestatements = []
-
+def normalize_function_call_expression(counter, prestatements, expression):
     for argument in expression.argument_list:
-        counter, argument_prestatements, normalized_argument = normalize_expression(counter, argument)
-
-        for s in argument_prestatements:
-            prestatements.append(s)
+        counter, normalized_argument = yield normalize_expression(counter, prestatements, argument)
 
         prestatements.append(
             NormalPushStatement(
@@ -246,17 +230,14 @@ def normalize_function_call_expression(counter, expression):
             ),
         )
 
-    counter, function_prestatements, function_expression = normalize_expression(
+    counter, function_expression = yield normalize_expression(
         counter,
+        prestatements,
         expression.function,
     )
 
-    for ps in function_prestatements:
-        prestatements.append(ps)
-
     return (
         counter,
-        tuple(prestatements),
         NormalFunctionCallExpression(
             metadata=expression.metadata,
             function_expression=function_expression,
@@ -264,24 +245,24 @@ def normalize_function_call_expression(counter, expression):
         ),
     )
 
-def normalize_if_expression(counter, expression):
-    counter, condition_prestatements, condition_expression = normalize_expression(
+def normalize_if_expression(counter, prestatements, expression):
+    counter, condition_expression = yield normalize_expression(
         counter,
+        prestatements,
         expression.condition_expression,
     )
 
-    counter, if_statement_list = normalize_statement_list(
+    counter, if_statement_list = yield normalize_statement_list(
         counter,
         expression.if_statement_list,
     )
-    counter, else_statement_list = normalize_statement_list(
+    counter, else_statement_list = yield normalize_statement_list(
         counter,
         expression.else_statement_list,
     )
 
     return (
         counter,
-        condition_prestatements,
         NormalIfElseExpression(
             condition_expression=condition_expression,
             if_statement_list=if_statement_list,
@@ -289,57 +270,59 @@ def normalize_if_expression(counter, expression):
         ),
     )
 
-def normalize_expression(counter, expression):
-    return {
-        desugaring.DesugaredBuiltinExpression: normalize_builtin_expression,
-        desugaring.DesugaredFunctionCallExpression: normalize_function_call_expression,
-        desugaring.DesugaredIfExpression: normalize_if_expression,
-        desugaring.DesugaredIntegerLiteralExpression: normalize_integer_literal_expression,
-        desugaring.DesugaredLambdaExpression: normalize_lambda_expression,
-        desugaring.DesugaredListLiteralExpression: normalize_list_literal_expression,
-        desugaring.DesugaredStringLiteralExpression: normalize_string_literal_expression,
-        desugaring.DesugaredStructureLiteralExpression: normalize_structure_literal_expression,
-        desugaring.DesugaredSymbolExpression: normalize_symbol_expression,
-    }[type(expression)](counter, expression)
-
-def normalize_expression_statement(counter, statement):
+# As in desugaring, the normalize_* functions that contain subexpressions are
+# generators run by util.trampoline, and the ones for leaves are plain functions
+_EXPRESSION_NORMALIZERS = {
+    desugaring.DesugaredBuiltinExpression: normalize_builtin_expression,
+    desugaring.DesugaredFunctionCallExpression: normalize_function_call_expression,
+    desugaring.DesugaredIfExpression: normalize_if_expression,
+    desugaring.DesugaredIntegerLiteralExpression: normalize_integer_literal_expression,
+    desugaring.DesugaredLambdaExpression: normalize_lambda_expression,
+    desugaring.DesugaredListLiteralExpression: normalize_list_literal_expression,
+    desugaring.DesugaredStringLiteralExpression: normalize_string_literal_expression,
+    desugaring.DesugaredStructureLiteralExpression: normalize_structure_literal_expression,
+    desugaring.DesugaredSymbolExpression: normalize_symbol_expression,
+}
+
+def normalize_expression(counter, prestatements, expression):
+    return _EXPRESSION_NORMALIZERS[type(expression)](counter, prestatements, expression)
+
+def normalize_expression_statement(counter, prestatements, statement):
     # TODO Normalized will be a NormalVariableExpression, which will go unused
     # for expression statements in every case except when it's a return
     # statement. This cases warnings on C compilation. We should only generate
     # this variable when it will be used on return.
-    counter, prestatements, normalized = normalize_expression(counter, statement.expression)
+    counter, normalized = yield normalize_expression(counter, prestatements, statement.expression)
 
     return (
         counter,
-        prestatements,
         NormalExpressionStatement(expression=normalized),
     )
 
-def normalize_assignment_statement(counter, statement):
-    counter, prestatements, normalized_expression = normalize_expression(counter, statement.expression)
+def normalize_assignment_statement(counter, prestatements, statement):
+    counter, normalized_expression = yield normalize_expression(counter, prestatements, statement.expression)
     return (
         counter,
-        prestatements,
         NormalAssignmentStatement(
             target=statement.target,
             expression=normalized_expression,
         ),
     )
 
-def normalize_statement(counter, statement):
-    return {
-        desugaring.DesugaredAssignmentStatement: normalize_assignment_statement,
-        desugaring.DesugaredExpressionStatement: normalize_expression_statement,
-    }[type(statement)](counter, statement)
+_STATEMENT_NORMALIZERS = {
+    desugaring.DesugaredAssignmentStatement: normalize_assignment_statement,
+    desugaring.DesugaredExpressionStatement: normalize_expression_statement,
+}
+
+def normalize_statement(counter, prestatements, statement):
+    return _STATEMENT_NORMALIZERS[type(statement)](counter, prestatements, statement)
 
-@util.force_generator(tuple)
 def normalize_statement_list(counter, statement_list):
     result_statement_list = []
 
     for statement in statement_list:
-        counter, prestatements, normalized = normalize_statement(counter, statement)
-        for s in prestatements:
-            result_statement_list.append(s)
+        # The prestatements of a statement go directly before it in the list
+        counter, normalized = yield normalize_statement(counter, result_statement_list, statement)
         result_statement_list.append(normalized)
 
     return (
@@ -348,7 +331,7 @@ def normalize_statement_list(counter, statement_list):
     )
 
 def normalize(program):
-    _, statement_list = normalize_statement_list(0, program.statement_list)
+    _, statement_list = util.trampoline(normalize_statement_list(0, program.statement_list))
 
     return NormalProgram(
         statement_list=statement_list,
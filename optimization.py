@@ -1,50 +1,1981 @@
-from crossplatform_ir_generation import CIRProgram, CIRInstruction, CIRLabel
+import bisect
+import collections
+
+from crossplatform_ir_generation import (
+    CALL,
+    CIRProgram,
+    CLOSE,
+    DROP,
+    DUP,
+    END,
+    INTEGER_MAXIMUM,
+    INTEGER_MINIMUM,
+    InternTable,
+    JUMP,
+    JUMP_IF_FALSE,
+    LABEL,
+    OPCODES_BY_NAME,
+    POP,
+    PUSH,
+    PUSH_INTEGER,
+    PUSH_STRING,
+    PUSH_SYMBOL,
+    RETURN,
+    ROT,
+    SWAP,
+    argument_array,
+    opcode_array,
+    pack_symbol_and_integer,
+)
+
+# The label the main program starts at
+MAIN_LABEL = '__main__'
 
 PUSHING_INSTRUCTIONS_WITHOUT_SIDE_EFFECTS = set(
-    ('push',),
+    (CLOSE, PUSH, PUSH_INTEGER, PUSH_STRING, PUSH_SYMBOL),
 )
 
-# TODO Some instructions may not touch the stack, so if these occur between a push and a drop we could still optimize
-def push_drop_optimization(ir):
-    ir = tuple(ir)
+# Instructions which read a symbol, so that a pop into it before has to stay
+SYMBOL_USING_INSTRUCTIONS = set(
+    (PUSH, PUSH_SYMBOL),
+)
 
-    i = 0
+# The optimizations take the opcode and argument arrays of a program and
+# return new ones. They also get the program's symbols as an InternTable, to
+# which they may add, for example when folding a comparison into true or
+# false, and its labels; the string and label tables never change. The arrays may also be
+# memoryviews over a .furc file, which is why they are copied as raw bytes
+# rather than with array.extend.
+#
+# Each optimization counts what it did in counters, a collections.Counter,
+# if it is given one.
+
+def _extend(result, items):
+    result.frombytes(memoryview(items).cast('B'))
+
+# A peephole rule matches a window of consecutive opcodes, and its rewrite
+# takes the arguments of the window and the symbols, and returns the (opcode,
+# argument) pairs to replace it with, or None if the window doesn't match
+# after all. Labels are instructions too, so a window never spans a jump
+# target.
+PeepholeRule = collections.namedtuple(
+    'PeepholeRule',
+    (
+        'name',
+        'pattern',
+        'rewrite',
+    ),
+)
+
+def _remove(arguments, symbols):
+    return ()
+
+def _remove_if_same_symbol(arguments, symbols):
+    push_argument, pop_argument = arguments
+    return () if push_argument == pop_argument else None
+
+# Integers in the runtime are 32 bits, from INTEGER_MINIMUM to
+# INTEGER_MAXIMUM, and overflow differently or not at all, so results outside
+# that are left for the runtime to compute
+
+# C division rounds towards zero, where Python's rounds down. Division by
+# zero is left for the runtime, so that it fails there as it always has.
+def _c_division(dividend, divisor):
+    if divisor == 0:
+        return None
+
+    quotient = abs(dividend) // abs(divisor)
+    return quotient if (dividend < 0) == (divisor < 0) else -quotient
+
+def _c_modulo(dividend, divisor):
+    quotient = _c_division(dividend, divisor)
+    return None if quotient is None else dividend - divisor * quotient
+
+INTEGER_OPERATIONS = {
+    'add': lambda left, right: left + right,
+    'idiv': _c_division,
+    'mod': _c_modulo,
+    'mul': lambda left, right: left * right,
+    'sub': lambda left, right: left - right,
+}
+
+COMPARISON_OPERATIONS = {
+    'eq': lambda left, right: left == right,
+    'gt': lambda left, right: left > right,
+    'gte': lambda left, right: left >= right,
+    'lt': lambda left, right: left < right,
+    'lte': lambda left, right: left <= right,
+    'neq': lambda left, right: left != right,
+}
+
+def _fold_integer_operation(operation):
+    def rewrite(arguments, symbols):
+        left, right, _ = arguments
+        result = operation(left, right)
+
+        if result is None or not INTEGER_MINIMUM <= result <= INTEGER_MAXIMUM:
+            return None
+
+        return ((PUSH_INTEGER, result),)
+
+    return rewrite
+
+def _fold_negation(arguments, symbols):
+    integer, _ = arguments
+
+    if not INTEGER_MINIMUM <= -integer <= INTEGER_MAXIMUM:
+        return None
+
+    return ((PUSH_INTEGER, -integer),)
+
+# true and false are always the booleans, whatever the environment holds
+def _fold_comparison(operation):
+    def rewrite(arguments, symbols):
+        left, right, _ = arguments
+        return ((PUSH, symbols.index('true' if operation(left, right) else 'false')),)
+
+    return rewrite
+
+def _fold_branch(arguments, symbols):
+    condition, label = arguments
+    symbol = symbols.values[condition]
+
+    if symbol == 'true':
+        return ()
+
+    if symbol == 'false':
+        return ((JUMP, label),)
+
+    return None
+
+# The operation which gives the same result with its operands the other way
+# around
+SWAPPED_OPERATIONS = {
+    'add': 'add',
+    'eq': 'eq',
+    'gt': 'lt',
+    'gte': 'lte',
+    'lt': 'gt',
+    'lte': 'gte',
+    'mul': 'mul',
+    'neq': 'neq',
+}
+
+def _swap_operands(name):
+    def rewrite(arguments, symbols):
+        _, argument_count = arguments
+        return ((OPCODES_BY_NAME[name], argument_count),)
+
+    return rewrite
+
+PEEPHOLE_RULES = tuple(
+    PeepholeRule('push_drop', (opcode, DROP), _remove)
+    for opcode in sorted(PUSHING_INSTRUCTIONS_WITHOUT_SIDE_EFFECTS)
+) + (
+    # Popping a symbol's own value back into it changes nothing
+    PeepholeRule('push_pop_same_symbol', (PUSH, POP), _remove_if_same_symbol),
+    PeepholeRule('fold neg', (PUSH_INTEGER, OPCODES_BY_NAME['neg']), _fold_negation),
+    PeepholeRule('fold branch', (PUSH, JUMP_IF_FALSE), _fold_branch),
+) + tuple(
+    PeepholeRule('fold ' + name, (PUSH_INTEGER, PUSH_INTEGER, OPCODES_BY_NAME[name]), _fold_integer_operation(operation))
+    for name, operation in sorted(INTEGER_OPERATIONS.items())
+) + tuple(
+    PeepholeRule('fold ' + name, (PUSH_INTEGER, PUSH_INTEGER, OPCODES_BY_NAME[name]), _fold_comparison(operation))
+    for name, operation in sorted(COMPARISON_OPERATIONS.items())
+) + (
+    PeepholeRule('swap_swap', (SWAP, SWAP), _remove),
+) + tuple(
+    PeepholeRule('swap ' + name, (SWAP, OPCODES_BY_NAME[name]), _swap_operands(swapped_name))
+    for name, swapped_name in sorted(SWAPPED_OPERATIONS.items())
+)
+
+# Returns the rules keyed by the last two opcodes of their patterns, since no
+# rule matches a single instruction, and then for each window length, longest
+# first, by pattern
+def _rules_by_last_pair(rules):
+    rules_by_last_pair = {}
+
+    for rule in rules:
+        rules_by_length = rules_by_last_pair.setdefault(rule.pattern[-2:], {})
+        rules_by_length.setdefault(len(rule.pattern), {}).setdefault(rule.pattern, []).append(rule)
+
+    return {
+        last_pair: sorted(rules_by_length.items(), reverse=True)
+        for last_pair, rules_by_length in rules_by_last_pair.items()
+    }
+
+_PEEPHOLE_RULES_BY_LAST_PAIR = _rules_by_last_pair(PEEPHOLE_RULES)
+
+# Returns the length, rule name and replacement of the first rule which
+# rewrites a window ending at end, or None
+def _match_end(opcodes, arguments, end, symbols, rules_by_last_pair):
+    for length, rules_by_pattern in rules_by_last_pair.get(tuple(opcodes[end - 2:end]), ()):
+        rules = rules_by_pattern.get(tuple(opcodes[end - length:end]))
+
+        if rules is None:
+            continue
+
+        window_arguments = tuple(arguments[end - length:end])
+
+        for rule in rules:
+            replacement = rule.rewrite(window_arguments, symbols)
+
+            if replacement is not None:
+                return length, rule.name, replacement
+
+    return None
+
+# Rewrites the window at the end of the result, and then each window which
+# ends in an instruction of the replacement as it is appended
+def _rewrite_end(result_opcodes, result_arguments, rewrite, symbols, counters, rules_by_last_pair):
+    pending = []
 
-    while i < len(ir):
-        if isinstance(ir[i], CIRInstruction)\
-                and ir[i].instruction in PUSHING_INSTRUCTIONS_WITHOUT_SIDE_EFFECTS\
-                and i + 1 < len(ir)\
-                and isinstance(ir[i + 1], CIRInstruction)\
-                and ir[i + 1].instruction == 'drop':
-            i += 2
+    while rewrite is not None or pending:
+        if rewrite is not None:
+            length, name, replacement = rewrite
+            del result_opcodes[-length:]
+            del result_arguments[-length:]
+            pending.extend(reversed(replacement))
+
+            if counters is not None:
+                counters['peephole ' + name] += 1
+
+        else:
+            opcode, argument = pending.pop()
+            result_opcodes.append(opcode)
+            result_arguments.append(argument)
+
+        rewrite = _match_end(result_opcodes, result_arguments, len(result_opcodes), symbols, rules_by_last_pair)
+
+# Applies the rules in one pass from the start of the program, rewriting each
+# window as soon as its last instruction is reached, so a rewrite which brings
+# together instructions another rule matches, such as the push and drop around
+# a push and drop which were just removed, or an operation on a folded
+# constant, is followed straight away.
+#
+# Only the windows ending in the last two opcodes of a pattern are looked at,
+# along with the window ending in the instruction after a rewrite, since its
+# last two instructions weren't next to each other before. The runs between
+# rewrites are copied a slice at a time, and windows in them are matched in
+# the original arrays.
+def peephole_optimization(opcodes, arguments, symbols, labels, counters=None, rules=PEEPHOLE_RULES):
+    rules_by_last_pair = _PEEPHOLE_RULES_BY_LAST_PAIR if rules is PEEPHOLE_RULES else _rules_by_last_pair(rules)
+    longest = max(len(rule.pattern) for rule in rules)
+
+    pair_ends = iter([
+        end
+        for end, pair in enumerate(zip(opcodes, opcodes[1:]), 2)
+        if pair in rules_by_last_pair
+    ])
+
+    result_opcodes = opcode_array()
+    result_arguments = argument_array()
+
+    # The result holds opcodes[:copied] rewritten, and ends in
+    # opcodes[unchanged_start:copied] as it is
+    copied = 0
+    unchanged_start = 0
+
+    pair_end = next(pair_ends, None)
+    end_after_rewrite = None
+
+    while True:
+        if end_after_rewrite is not None:
+            end = end_after_rewrite
+            end_after_rewrite = None
+
+            if pair_end == end:
+                pair_end = next(pair_ends, None)
+
+        elif pair_end is not None:
+            end = pair_end
+            pair_end = next(pair_ends, None)
         else:
-            yield ir[i]
-            i += 1
+            break
+
+        if end - longest >= unchanged_start:
+            rewrite = _match_end(opcodes, arguments, end, symbols, rules_by_last_pair)
+        else:
+            _extend(result_opcodes, opcodes[copied:end])
+            _extend(result_arguments, arguments[copied:end])
+            copied = end
+            rewrite = _match_end(result_opcodes, result_arguments, len(result_opcodes), symbols, rules_by_last_pair)
+
+        if rewrite is not None:
+            _extend(result_opcodes, opcodes[copied:end])
+            _extend(result_arguments, arguments[copied:end])
+            copied = unchanged_start = end
+            _rewrite_end(result_opcodes, result_arguments, rewrite, symbols, counters, rules_by_last_pair)
+
+            if end < len(opcodes):
+                end_after_rewrite = end + 1
+
+    _extend(result_opcodes, opcodes[copied:])
+    _extend(result_arguments, arguments[copied:])
+    return result_opcodes, result_arguments
+
+CONSTANT_PUSHING_INSTRUCTIONS = set(
+    (PUSH_INTEGER, PUSH_STRING),
+)
+
+# Instructions which end a function's instructions, or the main program's
+UNIT_ENDING_INSTRUCTIONS = set(
+    (END, RETURN),
+)
+
+JUMPING_INSTRUCTIONS = set(
+    (JUMP, JUMP_IF_FALSE),
+)
+
+# Replaces pushes of a symbol with the constant popped into it on every path
+# to the push in the same function. Each function's instructions run in
+# their own environment, so pops elsewhere bind other variables, and
+# functions defined in the function are generated elsewhere, and aren't
+# changed. The functions come from the control flow graph rather than from
+# where returns are, so this still holds after control_flow_optimization,
+# which can leave returns in the middle of a function. Fur has no loops, and
+# jumps only go forward, so each block of a function runs after the blocks
+# before it which can run into it; a block which could be reached from one
+# after it would start with no constants. Only the functions which pop a
+# constant are looked at.
+def constant_propagation(opcodes, arguments, symbols, labels, counters=None):
+    constant_pops = [
+        end
+        for end, pair in enumerate(zip(opcodes, opcodes[1:]), 1)
+        if pair[0] in CONSTANT_PUSHING_INSTRUCTIONS and pair[1] == POP
+    ]
+
+    if not constant_pops:
+        return opcodes, arguments
+
+    result_opcodes = opcode_array()
+    result_arguments = argument_array()
+    _extend(result_opcodes, opcodes)
+    _extend(result_arguments, arguments)
+
+    blocks = build_control_flow_graph(opcodes, arguments)
+    functions, _ = _functions(opcodes, arguments, blocks, labels)
+
+    for entry, function_blocks in functions.items():
+        if not any(
+            bisect.bisect_left(constant_pops, blocks[index].start) != bisect.bisect_left(constant_pops, blocks[index].end)
+            for index in function_blocks
+        ):
+            continue
+
+        predecessors = {index: [] for index in function_blocks}
+
+        for index in function_blocks:
+            for successor in blocks[index].successors:
+                predecessors[successor].append(index)
+
+        # The constants bound when each block of the function has run
+        constants_after = {}
+
+        for index in function_blocks:
+            block = blocks[index]
+
+            if index == entry or not predecessors[index]:
+                constants = {}
+            else:
+                # Only the constants which every way into the block binds
+                incoming = [constants_after.get(predecessor, {}) for predecessor in predecessors[index]]
+                constants = {
+                    symbol: constant
+                    for symbol, constant in incoming[0].items()
+                    if all(other.get(symbol) == constant for other in incoming[1:])
+                }
+
+            for i in range(block.start, block.end):
+                opcode, argument = opcodes[i], arguments[i]
+
+                if opcode == PUSH:
+                    if argument in constants:
+                        result_opcodes[i], result_arguments[i] = constants[argument]
+
+                        if counters is not None:
+                            counters['constant propagation'] += 1
+
+                elif opcode == POP:
+                    if i > block.start and opcodes[i - 1] in CONSTANT_PUSHING_INSTRUCTIONS:
+                        constants[argument] = opcodes[i - 1], arguments[i - 1]
+                    else:
+                        constants.pop(argument, None)
+
+            constants_after[index] = constants
+
+    return result_opcodes, result_arguments
+
+# A basic block is a run of instructions which is only entered at its start
+# and only left at its end: opcodes[start:end], after the labels whose
+# arguments are in labels. Its successors are the indices of the blocks which
+# can run after it in the same function. A close isn't an edge, since making
+# a closure doesn't run it.
+BasicBlock = collections.namedtuple(
+    'BasicBlock',
+    (
+        'labels',
+        'start',
+        'end',
+        'successors',
+    ),
+)
+
+BLOCK_ENDING_INSTRUCTIONS = JUMPING_INSTRUCTIONS | UNIT_ENDING_INSTRUCTIONS
+
+BLOCK_BOUNDARY_INSTRUCTIONS = BLOCK_ENDING_INSTRUCTIONS | set(
+    (LABEL,),
+)
+
+# Instructions after which the next instruction doesn't run
+NOT_FALLING_THROUGH_INSTRUCTIONS = UNIT_ENDING_INSTRUCTIONS | set(
+    (JUMP,),
+)
+
+# Returns the basic blocks of a program in the order they are in the arrays
+def build_control_flow_graph(opcodes, arguments):
+    spans = []
+    block_labels = []
+    start = 0
+
+    for i in [i for i, opcode in enumerate(opcodes) if opcode in BLOCK_BOUNDARY_INSTRUCTIONS]:
+        if opcodes[i] == LABEL:
+            if i > start:
+                spans.append((tuple(block_labels), start, i))
+                block_labels = []
+
+            block_labels.append(arguments[i])
+            start = i + 1
+        else:
+            spans.append((tuple(block_labels), start, i + 1))
+            block_labels = []
+            start = i + 1
+
+    if block_labels or start < len(opcodes):
+        spans.append((tuple(block_labels), start, len(opcodes)))
+
+    blocks_by_label = {
+        label: index
+        for index, (block_labels, _, _) in enumerate(spans)
+        for label in block_labels
+    }
+    blocks = []
+
+    for index, (block_labels, start, end) in enumerate(spans):
+        last_opcode = opcodes[end - 1] if end > start else None
+
+        if last_opcode in JUMPING_INSTRUCTIONS:
+            successors = (blocks_by_label[arguments[end - 1]],)
+
+            if last_opcode == JUMP_IF_FALSE:
+                successors = (index + 1,) + successors
+
+        elif last_opcode in UNIT_ENDING_INSTRUCTIONS or index + 1 == len(spans):
+            successors = ()
+        else:
+            successors = (index + 1,)
+
+        blocks.append(BasicBlock(
+            labels=block_labels,
+            start=start,
+            end=end,
+            successors=successors,
+        ))
+
+    return tuple(blocks)
+
+def _blocks_by_label(blocks):
+    return {
+        label: index
+        for index, block in enumerate(blocks)
+        for label in block.labels
+    }
+
+def _is_only(opcodes, block, opcode):
+    return block.end - block.start == 1 and opcodes[block.start] == opcode
+
+# Returns the label a jump to label ends up at, through blocks which only
+# jump. Nested ifs each end by jumping to the end of the if around them, so
+# the labels passed through are remembered in targets.
+def _jump_target(opcodes, arguments, blocks, blocks_by_label, label, targets):
+    path = set()
+
+    while label not in targets and label not in path and _is_only(opcodes, blocks[blocks_by_label[label]], JUMP):
+        path.add(label)
+        label = arguments[blocks[blocks_by_label[label]].start]
+
+    target = targets.get(label, label)
+
+    for passed_label in path:
+        targets[passed_label] = target
+
+    return target
+
+# Retargets jumps to blocks which only jump at the blocks those jump to, and
+# replaces jumps to blocks which only return with returns
+def _thread_jumps(opcodes, arguments, result_opcodes, result_arguments, blocks, counters):
+    blocks_by_label = _blocks_by_label(blocks)
+    targets = {}
+
+    for block in blocks:
+        last = block.end - 1
+
+        if block.end == block.start or opcodes[last] not in JUMPING_INSTRUCTIONS:
+            continue
+
+        label = _jump_target(opcodes, arguments, blocks, blocks_by_label, arguments[last], targets)
+
+        if opcodes[last] == JUMP and _is_only(opcodes, blocks[blocks_by_label[label]], RETURN):
+            result_opcodes[last] = RETURN
+            result_arguments[last] = 0
+        elif label != arguments[last]:
+            result_arguments[last] = label
+        else:
+            continue
+
+        if counters is not None:
+            counters['control flow threaded jump'] += 1
+
+# Returns the labels which each block makes closures of
+def _closes_by_block(opcodes, arguments, blocks):
+    block_ends = [block.end for block in blocks]
+    closes_by_block = {}
+
+    for i in [i for i, opcode in enumerate(opcodes) if opcode == CLOSE]:
+        closes_by_block.setdefault(bisect.bisect_right(block_ends, i), []).append(arguments[i])
+
+    return closes_by_block
+
+# Returns the block the main program starts at, or the first block of
+# fragments of programs without a main program
+def _main_block(blocks, labels):
+    if MAIN_LABEL in labels:
+        return _blocks_by_label(blocks).get(labels.index(MAIN_LABEL), 0)
+
+    return 0
+
+# Returns the blocks which can run, starting from the main program's block,
+# along with the labels each block makes closures of
+def _reachable_blocks(opcodes, arguments, blocks, root):
+    blocks_by_label = _blocks_by_label(blocks)
+    closes_by_block = _closes_by_block(opcodes, arguments, blocks)
+
+    reachable = set((root,))
+    stack = [root]
+
+    while stack:
+        index = stack.pop()
+
+        for successor in blocks[index].successors + tuple(blocks_by_label[label] for label in closes_by_block.get(index, ())):
+            if successor not in reachable:
+                reachable.add(successor)
+                stack.append(successor)
+
+    return reachable, closes_by_block
+
+# Returns the order to lay out the reachable blocks in. Blocks which run into
+# the next make chains which stay together, and the chains are laid out in
+# their order, except that a chain which ends in a jump is followed by the
+# chain the jump goes to, if everything which jumps to that chain has been
+# laid out, so that the jump can be removed. Jumps still only go forward, and
+# each function's blocks stay together, since jumps stay in their function.
+def _block_order(opcodes, arguments, blocks, reachable, counters):
+    blocks_by_label = _blocks_by_label(blocks)
+    chains = []
+    chains_by_block = {}
+
+    for index in sorted(reachable):
+        previous = blocks[index - 1] if index > 0 else None
+
+        if previous is None or index - 1 not in reachable or (previous.end > previous.start and opcodes[previous.end - 1] in NOT_FALLING_THROUGH_INSTRUCTIONS):
+            chains.append([])
+
+        chains[-1].append(index)
+        chains_by_block[index] = len(chains) - 1
+
+    predecessors = [set() for _ in chains]
+
+    for chain_index, chain in enumerate(chains):
+        for index in chain:
+            block = blocks[index]
+
+            if block.end > block.start and opcodes[block.end - 1] in JUMPING_INSTRUCTIONS:
+                target_chain = chains_by_block[blocks_by_label[arguments[block.end - 1]]]
+
+                if target_chain != chain_index:
+                    predecessors[target_chain].add(chain_index)
+
+    order = []
+    placed = set()
+    next_in_order = 0
+    following = None
+
+    while len(placed) < len(chains):
+        while next_in_order in placed:
+            next_in_order += 1
+
+        if following is not None and following not in placed and predecessors[following] <= placed:
+            chain_index = following
+
+            if chain_index != next_in_order and counters is not None:
+                counters['control flow reordered block'] += len(chains[chain_index])
+
+        else:
+            chain_index = next_in_order
+
+        placed.add(chain_index)
+        order.extend(chains[chain_index])
+
+        last_block = blocks[chains[chain_index][-1]]
+        following = None
+
+        if last_block.end > last_block.start and opcodes[last_block.end - 1] == JUMP:
+            target = blocks_by_label[arguments[last_block.end - 1]]
+
+            if chains[chains_by_block[target]][0] == target:
+                following = chains_by_block[target]
+
+    return order
+
+# Simplifies the jumps of the program using its control flow graph: jumps to
+# jumps are threaded, blocks which can't run are removed, including those of
+# functions which are never made into closures, blocks are reordered so
+# that jumps go to the next block, which they then don't need to, and labels
+# which nothing jumps to or closes are removed
+def control_flow_optimization(opcodes, arguments, symbols, labels, counters=None):
+    result_opcodes = opcode_array()
+    result_arguments = argument_array()
+    _extend(result_opcodes, opcodes)
+    _extend(result_arguments, arguments)
+
+    blocks = build_control_flow_graph(opcodes, arguments)
+
+    if not blocks:
+        return result_opcodes, result_arguments
+
+    # Before threading, each function only returns at its end
+    function_starts = set((0,)) | set(
+        index + 1
+        for index, block in enumerate(blocks)
+        if block.end > block.start and opcodes[block.end - 1] in UNIT_ENDING_INSTRUCTIONS
+    )
+
+    _thread_jumps(opcodes, arguments, result_opcodes, result_arguments, blocks, counters)
+    opcodes, arguments = result_opcodes, result_arguments
+    blocks = build_control_flow_graph(opcodes, arguments)
+    blocks_by_label = _blocks_by_label(blocks)
+
+    main_label = labels.index(MAIN_LABEL) if MAIN_LABEL in labels else None
+    reachable, closes_by_block = _reachable_blocks(opcodes, arguments, blocks, _main_block(blocks, labels))
+
+    if counters is not None:
+        for index in range(len(blocks)):
+            if index not in reachable:
+                if index in function_starts:
+                    counters['control flow unreferenced function'] += 1
+                else:
+                    counters['control flow unreachable block'] += 1
+
+    order = _block_order(opcodes, arguments, blocks, reachable, counters)
+
+    # Jumps to the next block are removed, and a jump_if_false to the next
+    # block only has to drop its condition
+    referenced_labels = set(() if main_label is None else (main_label,))
+    jumps_to_next = set()
+
+    for position, index in enumerate(order):
+        block = blocks[index]
+        referenced_labels.update(closes_by_block.get(index, ()))
+
+        if block.end == block.start or opcodes[block.end - 1] not in JUMPING_INSTRUCTIONS:
+            continue
+
+        label = arguments[block.end - 1]
+
+        if position + 1 < len(order) and blocks_by_label[label] == order[position + 1]:
+            jumps_to_next.add(index)
+
+            if counters is not None:
+                counters['control flow jump to next'] += 1
+
+        else:
+            referenced_labels.add(label)
+
+    result_opcodes = opcode_array()
+    result_arguments = argument_array()
+
+    for index in order:
+        block = blocks[index]
+
+        for label in block.labels:
+            if label in referenced_labels:
+                result_opcodes.append(LABEL)
+                result_arguments.append(label)
+            elif counters is not None:
+                counters['control flow dead label'] += 1
+
+        if index in jumps_to_next:
+            _extend(result_opcodes, opcodes[block.start:block.end - 1])
+            _extend(result_arguments, arguments[block.start:block.end - 1])
+
+            if opcodes[block.end - 1] == JUMP_IF_FALSE:
+                result_opcodes.append(DROP)
+                result_arguments.append(0)
+
+        else:
+            _extend(result_opcodes, opcodes[block.start:block.end])
+            _extend(result_arguments, arguments[block.start:block.end])
+
+    return result_opcodes, result_arguments
+
+# Returns the blocks of the function starting at entry, in order: those its
+# instructions can run without calling or returning
+def _function_blocks(blocks, entry):
+    function_blocks = set((entry,))
+    stack = [entry]
+
+    while stack:
+        for successor in blocks[stack.pop()].successors:
+            if successor not in function_blocks:
+                function_blocks.add(successor)
+                stack.append(successor)
+
+    return sorted(function_blocks)
+
+# Returns the symbols which the blocks read before popping into them, and the
+# symbols they pop into
+def _uses_and_definitions(opcodes, arguments, block):
+    uses = set()
+    definitions = set()
+
+    for opcode, argument in zip(opcodes[block.start:block.end], arguments[block.start:block.end]):
+        if opcode in SYMBOL_USING_INSTRUCTIONS:
+            if argument not in definitions:
+                uses.add(argument)
+        elif opcode == POP:
+            definitions.add(argument)
+
+    return uses, definitions
+
+# Returns the blocks of each function, keyed by the block it starts at, and
+# the functions which are closed over (the main program never is)
+def _functions(opcodes, arguments, blocks, labels):
+    blocks_by_label = _blocks_by_label(blocks)
+    closed = set(
+        blocks_by_label[label]
+        for closed_labels in _closes_by_block(opcodes, arguments, blocks).values()
+        for label in closed_labels
+    )
+    entries = set((_main_block(blocks, labels),)) | closed
+
+    return {entry: _function_blocks(blocks, entry) for entry in entries}, closed
 
-# TODO We might be able to trace program flow to eliminate usages even if variables have the same name
-def unused_pop_optimization(ir):
-    ir = tuple(ir)
+# Returns the blocks of each function, keyed by the block it starts at, the
+# uses and definitions of the blocks of each function which is closed over,
+# and the symbols each function has to keep bound. A pop binds the symbol in the environment of the call to
+# the function it is in, so it is only read by the rest of that function, or
+# by closures the function makes, which can be called at any time, even after
+# the function returns. So every symbol read by a function it makes closures
+# of, or by the functions those make closures of, has to stay bound.
+def _functions_and_captured_symbols(opcodes, arguments, blocks, labels):
+    blocks_by_label = _blocks_by_label(blocks)
+    closes_by_block = _closes_by_block(opcodes, arguments, blocks)
+    functions, closed = _functions(opcodes, arguments, blocks, labels)
+    uses_and_definitions = {
+        index: _uses_and_definitions(opcodes, arguments, blocks[index])
+        for entry in closed
+        for index in functions[entry]
+    }
 
-    used_symbols = set()
+    nested_functions = {
+        entry: set(
+            blocks_by_label[label]
+            for index in function_blocks
+            for label in closes_by_block.get(index, ())
+        )
+        for entry, function_blocks in functions.items()
+    }
 
-    for entry in ir:
-        # TODO Having symbols be a string starting with "sym" is a bit hacky
-        if isinstance(entry, CIRInstruction)\
-                and entry.instruction != 'pop'\
-                and isinstance(entry.argument, str)\
-                and entry.argument.startswith('sym'):
-            used_symbols.add(entry.argument)
+    # The symbols read by each function, and by the closures it makes, which
+    # are found for the functions it makes closures of first
+    captured = {}
 
-    for entry in ir:
-        if isinstance(entry, CIRInstruction) and entry.instruction == 'pop' and entry.argument not in used_symbols:
-            yield CIRInstruction(instruction='drop', argument=None)
+    for entry in closed:
+        stack = [entry]
+
+        while stack:
+            function = stack[-1]
+
+            if function in captured:
+                stack.pop()
+                continue
+
+            unfinished = [nested for nested in nested_functions[function] if nested not in captured and nested not in stack]
+
+            if unfinished:
+                stack.extend(unfinished)
+                continue
+
+            read = set()
+
+            for index in functions[function]:
+                read.update(uses_and_definitions[index][0])
+
+            for nested in nested_functions[function]:
+                read.update(captured.get(nested, ()))
+
+            captured[function] = read
+            stack.pop()
+
+    captured_symbols = {}
+
+    for entry in functions:
+        captured_symbols[entry] = set()
+
+        for nested in nested_functions[entry]:
+            captured_symbols[entry].update(captured[nested])
+
+    return functions, uses_and_definitions, captured_symbols
+
+# Replaces pops into variables which are never read afterwards with drops.
+# Each function's liveness is found over its own blocks, with the symbols
+# the closures it makes can read live throughout.
+#
+# A push of a symbol straight before a dead pop only feeds the drop it
+# becomes, which the peephole rules remove, so it doesn't count as reading
+# the symbol. That removes the temporaries which closures are popped into
+# before being pushed into the variable they are assigned to.
+def dead_pop_elimination(opcodes, arguments, symbols, labels, counters=None):
+    result_opcodes = opcode_array()
+    result_arguments = argument_array()
+    _extend(result_opcodes, opcodes)
+    _extend(result_arguments, arguments)
+
+    blocks = build_control_flow_graph(opcodes, arguments)
+
+    if not blocks:
+        return result_opcodes, result_arguments
+
+    functions, uses_and_definitions, captured_symbols = _functions_and_captured_symbols(opcodes, arguments, blocks, labels)
+
+    live_pops = set()
+    pops = set()
+
+    for entry, function_blocks in functions.items():
+        always_live = captured_symbols[entry]
+
+        # Jumps only go forward, so this settles in one pass, and the second
+        # finds nothing changed
+        live_ins = {}
+        changed = True
+
+        while changed:
+            changed = False
+
+            for index in reversed(function_blocks):
+                live = set()
+
+                for successor in blocks[index].successors:
+                    live.update(live_ins.get(successor, ()))
+
+                if index not in uses_and_definitions:
+                    uses_and_definitions[index] = _uses_and_definitions(opcodes, arguments, blocks[index])
+
+                uses, definitions = uses_and_definitions[index]
+                live = uses | (live - definitions)
+
+                if live != live_ins.get(index):
+                    live_ins[index] = live
+                    changed = True
+
+        for index in function_blocks:
+            block = blocks[index]
+
+            if POP not in opcodes[block.start:block.end]:
+                continue
+
+            live = set(always_live)
+
+            for successor in block.successors:
+                live.update(live_ins[successor])
+
+            feeds_dead_pop = False
+
+            for i in reversed(range(block.start, block.end)):
+                opcode, argument = opcodes[i], arguments[i]
+
+                if opcode == POP:
+                    pops.add(i)
+
+                    if argument in live:
+                        live_pops.add(i)
+                        live.discard(argument)
+                        feeds_dead_pop = False
+                        continue
+
+                    feeds_dead_pop = True
+                    continue
+
+                if opcode in SYMBOL_USING_INSTRUCTIONS and not (feeds_dead_pop and opcode == PUSH):
+                    live.add(argument)
+
+                feeds_dead_pop = False
+
+    for i in sorted(pops - live_pops):
+        result_opcodes[i] = DROP
+        result_arguments[i] = 0
+
+        if counters is not None:
+            counters['dead pop'] += 1
+
+    return result_opcodes, result_arguments
+
+# How many values each instruction takes off the stack, and how many it puts
+# on, given its argument. A call takes the function and its arguments, and
+# the function leaves its result. Instructions which aren't here, like lists
+# and structures, which C generation can't generate yet, aren't looked past.
+STACK_EFFECTS = dict(
+    [
+        (CALL, lambda argument: (argument + 1, 1)),
+        (DROP, lambda argument: (1, 0)),
+        (DUP, lambda argument: (1, 2)),
+        (OPCODES_BY_NAME['neg'], lambda argument: (argument, 1)),
+        (POP, lambda argument: (1, 0)),
+        (ROT, lambda argument: (3, 3)),
+        (SWAP, lambda argument: (2, 2)),
+    ] + [
+        (opcode, lambda argument: (0, 1))
+        for opcode in PUSHING_INSTRUCTIONS_WITHOUT_SIDE_EFFECTS
+    ] + [
+        (OPCODES_BY_NAME[name], lambda argument: (argument, 1))
+        for name in sorted(INTEGER_OPERATIONS) + sorted(COMPARISON_OPERATIONS)
+    ]
+)
+
+# The instruction which brings the value under that many others to the top
+STACK_REACHING_INSTRUCTIONS = {
+    1: SWAP,
+    2: ROT,
+}
+
+# Symbols which push gives the runtime's own value of, rather than the one
+# they were popped into
+RUNTIME_SYMBOLS = set(('false', 'pow', 'print', 'true'))
+
+# Follows the stack through a block's instructions with the values of the
+# symbols in kept left on it, and returns the instructions which do that and
+# the symbols it could keep. pop_indices gives where in the block each kept
+# symbol is popped, and read_counts how many times it is read.
+#
+# The stack is a list of the symbol each value is kept for, or None, from
+# the bottom up; the values under the list aren't kept for any. A pop takes
+# the top value which isn't kept, which is where the original program's pop
+# would have found it, and marks it as kept. The last read of a kept value
+# brings it up from under the values above it, and each read before that has
+# to find it on top and copies it. Every other instruction must only take
+# values which aren't kept. While no value is kept, the instructions up to
+# the next pop of a kept symbol are copied as they are.
+#
+# A symbol whose value gets in the way isn't kept. Without it, the stack up
+# to that point would have been the same but for its value, so its value is
+# taken off and the block followed on from there, to find the rest of the
+# symbols which get in the way in the same pass. The instructions from that
+# pass are wrong for the symbols it dropped, so the block is followed again
+# for the symbols left.
+def _keep_on_stack(opcodes, arguments, kept, pop_indices, read_counts):
+    kept = set(kept)
+
+    while True:
+        result_opcodes, result_arguments, dropped = _follow_block(opcodes, arguments, kept, pop_indices, read_counts)
+
+        if not dropped:
+            return result_opcodes, result_arguments, kept
+
+        kept -= dropped
+
+# Follows the stack through a block once for _keep_on_stack, and returns the
+# instructions and the symbols it had to drop from kept
+def _follow_block(opcodes, arguments, kept, pop_indices, read_counts):
+    kept = set(kept)
+    dropped = set()
+    result_opcodes = []
+    result_arguments = []
+    kept_pop_indices = sorted(pop_indices[symbol] for symbol in kept)
+    kept_pop_indices.append(len(opcodes))
+    next_kept_pop = 0
+    stack = []
+    kept_values = 0
+    reads_left = dict(read_counts)
+    i = 0
+
+    while i < len(opcodes):
+        if kept_values == 0:
+            del stack[:]
+            result_opcodes.extend(opcodes[i:kept_pop_indices[next_kept_pop]])
+            result_arguments.extend(arguments[i:kept_pop_indices[next_kept_pop]])
+            i = kept_pop_indices[next_kept_pop]
+
+            if i == len(opcodes):
+                break
+
+        blocking_symbol = _follow_instruction(
+            opcodes[i],
+            arguments[i],
+            kept,
+            stack,
+            reads_left,
+            result_opcodes,
+            result_arguments,
+        )
+
+        if blocking_symbol is not None:
+            kept.discard(blocking_symbol)
+            dropped.add(blocking_symbol)
+            stack.remove(blocking_symbol)
+            kept_values -= 1
+            continue
+
+        if opcodes[i] == POP and arguments[i] in kept:
+            next_kept_pop += 1
+            kept_values += 1
+        elif opcodes[i] == PUSH and arguments[i] in kept and not reads_left[arguments[i]]:
+            kept_values -= 1
+
+        i += 1
+
+    return result_opcodes, result_arguments, dropped
+
+# Follows one instruction for _keep_on_stack, appending what it becomes, and
+# returns the kept symbol which gets in its way, if any
+def _follow_instruction(opcode, argument, kept, stack, reads_left, result_opcodes, result_arguments):
+    if opcode == POP and argument in kept:
+        j = len(stack) - 1
+
+        while j >= 0 and stack[j] is not None:
+            j -= 1
+
+        if j < 0:
+            stack.insert(0, argument)
         else:
-            yield entry
+            stack[j] = argument
+
+        return None
+
+    if opcode == PUSH and argument in kept:
+        j = len(stack) - 1
+
+        while stack[j] != argument:
+            j -= 1
+
+        depth = len(stack) - 1 - j
+        reads_left[argument] -= 1
+
+        if reads_left[argument]:
+            if depth != 0:
+                return argument
+
+            result_opcodes.append(DUP)
+            result_arguments.append(0)
+            stack.append(None)
+            return None
+
+        if depth not in STACK_REACHING_INSTRUCTIONS and depth != 0:
+            return argument
+
+        if depth != 0:
+            result_opcodes.append(STACK_REACHING_INSTRUCTIONS[depth])
+            result_arguments.append(0)
+
+        del stack[j]
+        stack.append(None)
+        return None
+
+    stack_effect = STACK_EFFECTS.get(opcode)
+
+    # Nothing kept can be left under an instruction which doesn't say
+    # what it takes, which is only ever the last of a block
+    if stack_effect is None:
+        taken, put = len(stack), 0
+    else:
+        taken, put = stack_effect(argument)
+
+    bottom = max(len(stack) - taken, 0)
+
+    for symbol in reversed(stack[bottom:]):
+        if symbol is not None:
+            return symbol
+
+    del stack[bottom:]
+    stack.extend((None,) * put)
+    result_opcodes.append(opcode)
+    result_arguments.append(argument)
+    return None
+
+# Keeps the values of variables on the stack, rather than popping them into
+# the environment and pushing them back, where every read of the variable
+# is in the same block as its only pop. Most of these are the temporaries
+# which lowering makes for the values of subexpressions, and the rest are
+# mostly arguments. Each pop and push of the environment allocates and looks
+# up the symbol at runtime, where the value on the stack only needs moving,
+# or copying with a dup if it is read more than once.
+#
+# Variables which closures can read are left alone, since the closures look
+# them up in the environment. A variable whose value gets in the way of the
+# stack the block's other instructions expect isn't kept either, and the
+# block is followed again without it.
+def stack_temporaries(opcodes, arguments, symbols, labels, counters=None):
+    result_opcodes = opcode_array()
+    result_arguments = argument_array()
+
+    blocks = build_control_flow_graph(opcodes, arguments)
+
+    if not blocks:
+        _extend(result_opcodes, opcodes)
+        _extend(result_arguments, arguments)
+        return result_opcodes, result_arguments
+
+    functions, _, captured_symbols = _functions_and_captured_symbols(opcodes, arguments, blocks, labels)
+    runtime_symbols = set(
+        index
+        for index, symbol in enumerate(symbols.values)
+        if symbol in RUNTIME_SYMBOLS
+    )
+
+    rewritten_blocks = {}
+
+    for entry, function_blocks in functions.items():
+        popped_once = set()
+        popped_again = set()
+
+        for index in function_blocks:
+            block = blocks[index]
+
+            for opcode, argument in zip(opcodes[block.start:block.end], arguments[block.start:block.end]):
+                if opcode == POP:
+                    if argument in popped_once:
+                        popped_again.add(argument)
+                    else:
+                        popped_once.add(argument)
+
+        candidates = popped_once - popped_again - captured_symbols[entry] - runtime_symbols
+
+        if not candidates:
+            continue
+
+        push_counts = collections.Counter()
+        other_uses = set()
+
+        # Where each block pops each candidate, and how many times it reads
+        # the candidate after that
+        block_pops = []
+
+        for index in function_blocks:
+            block = blocks[index]
+            block_opcodes = opcodes[block.start:block.end]
+            pop_indices = {}
+            read_counts = {}
+
+            # Arguments which aren't symbols can equal a candidate too, so
+            # the opcode is still checked
+            for i, argument in enumerate(arguments[block.start:block.end]):
+                if argument in candidates:
+                    opcode = block_opcodes[i]
+
+                    if opcode == POP:
+                        pop_indices[argument] = i
+                    elif opcode == PUSH:
+                        push_counts[argument] += 1
+
+                        if argument in pop_indices:
+                            read_counts[argument] = read_counts.get(argument, 0) + 1
+                    elif opcode in SYMBOL_USING_INSTRUCTIONS:
+                        other_uses.add(argument)
+
+            if pop_indices:
+                block_pops.append((index, pop_indices, read_counts))
+
+        for index, pop_indices, read_counts in block_pops:
+            kept = set(
+                symbol
+                for symbol, count in read_counts.items()
+                if push_counts[symbol] == count and symbol not in other_uses
+            )
+
+            if not kept:
+                continue
+
+            block = blocks[index]
+            block_opcodes = opcodes[block.start:block.end]
+            block_arguments = arguments[block.start:block.end]
+
+            kept_opcodes, kept_arguments, kept = _keep_on_stack(block_opcodes, block_arguments, kept, pop_indices, read_counts)
+
+            if kept:
+                rewritten_blocks[index] = kept_opcodes, kept_arguments
+
+                if counters is not None:
+                    counters['stack temporary'] += len(kept)
+
+    if not rewritten_blocks:
+        _extend(result_opcodes, opcodes)
+        _extend(result_arguments, arguments)
+        return result_opcodes, result_arguments
+
+    copied = 0
+
+    for index in sorted(rewritten_blocks):
+        block = blocks[index]
+        kept_opcodes, kept_arguments = rewritten_blocks[index]
+        _extend(result_opcodes, opcodes[copied:block.start])
+        _extend(result_arguments, arguments[copied:block.start])
+        result_opcodes.extend(kept_opcodes)
+        result_arguments.extend(kept_arguments)
+        copied = block.end
+
+    _extend(result_opcodes, opcodes[copied:])
+    _extend(result_arguments, arguments[copied:])
+
+    return result_opcodes, result_arguments
+
+def _fuse_symbol_and_integer(name):
+    def rewrite(arguments, symbols):
+        symbol, integer, argument_count = arguments
+
+        if argument_count != 2 or not INTEGER_MINIMUM <= integer <= INTEGER_MAXIMUM:
+            return None
+
+        return ((OPCODES_BY_NAME[name], pack_symbol_and_integer(symbol, integer)),)
+
+    return rewrite
+
+def _fuse_call(name):
+    def rewrite(arguments, symbols):
+        symbol, argument_count = arguments
+        return ((OPCODES_BY_NAME[name], pack_symbol_and_integer(symbol, argument_count)),)
+
+    return rewrite
+
+def _fuse_jump(name):
+    def rewrite(arguments, symbols):
+        argument_count, label = arguments
+
+        if argument_count != 2:
+            return None
+
+        return ((OPCODES_BY_NAME[name], label),)
+
+    return rewrite
+
+# Each superinstruction does the work of a sequence of instructions in one
+# dispatch, and doesn't push the values the sequence passes on the stack from
+# one instruction to the next. They are a call of a variable, the sequence
+# instruction_traces.py finds most often, and the operations on a variable
+# and a constant and the comparisons branched on which the recursive runtime
+# benchmarks are made of. Each is given with the sequence it replaces, and a
+# function of its name which rewrites the sequence, or returns None if it
+# can't.
+SUPERINSTRUCTIONS = (
+    ('call_symbol', (PUSH, CALL), _fuse_call),
+) + tuple(
+    (name + '_symbol_integer', (PUSH, PUSH_INTEGER, OPCODES_BY_NAME[name]), _fuse_symbol_and_integer)
+    for name in sorted(INTEGER_OPERATIONS)
+) + tuple(
+    (name + '_jump_if_false', (OPCODES_BY_NAME[name], JUMP_IF_FALSE), _fuse_jump)
+    for name in sorted(COMPARISON_OPERATIONS)
+)
+
+SUPERINSTRUCTION_RULES = tuple(
+    PeepholeRule('fuse ' + name, pattern, fuse(name))
+    for name, pattern, fuse in SUPERINSTRUCTIONS
+)
+
+# Replaces sequences with superinstructions, matching them as the peephole
+# rules are matched. Only C generation understands superinstructions, so this
+# is the last optimization. Comparisons aren't fused with the pushes of their
+# operands, so that a comparison, which is nearly always branched on, is
+# fused with the branch instead.
+def superinstruction_fusion(opcodes, arguments, symbols, labels, counters=None):
+    return peephole_optimization(opcodes, arguments, symbols, labels, counters, SUPERINSTRUCTION_RULES)
+
+OPTIMIZATIONS = (
+    peephole_optimization,
+    # Propagated constants can be folded, and folded constants propagated, so
+    # the peephole rules run again after
+    constant_propagation,
+    peephole_optimization,
+    dead_pop_elimination,
+    # Dead pops become drops, which the peephole rules can remove
+    peephole_optimization,
+    # Removing closures which are never used leaves functions which are
+    # never closed
+    control_flow_optimization,
+    # Removing jumps to the next block joins blocks, so more reads are in the
+    # same block as their pop
+    stack_temporaries,
+    # Swaps before operations which don't care about the order of their
+    # operands can be removed
+    peephole_optimization,
+    superinstruction_fusion,
+)
+
+def optimize(cir_program, counters=None, optimizations=OPTIMIZATIONS):
+    opcodes, arguments = cir_program.opcodes, cir_program.arguments
+    symbols = InternTable(cir_program.symbols)
+
+    for optimization in optimizations:
+        opcodes, arguments = optimization(opcodes, arguments, symbols, cir_program.labels, counters)
+
+    return CIRProgram(
+        opcodes=opcodes,
+        arguments=arguments,
+        symbols=tuple(symbols.values),
+        strings=cir_program.strings,
+        labels=cir_program.labels,
+    )
+
+def format_counters(counters):
+    return '\n'.join(
+        '{:>8}  {}'.format(count, name)
+        for name, count in sorted(counters.items())
+    )
+
+if __name__ == '__main__':
+    import unittest
+
+    from crossplatform_ir_generation import CIRInstruction, CIRLabel, pack, unpack
+
+    # Instructions are given as (name, argument) pairs, as in the listing,
+    # with labels as ('label', name)
+    def program_of(*instructions):
+        return pack(tuple(
+            CIRLabel(label=argument) if name == 'label' else CIRInstruction(instruction=name, argument=argument)
+            for name, argument in instructions
+        ))
+
+    # Superinstructions are tested on their own, so that the other tests
+    # show the instructions they would replace
+    UNFUSED_OPTIMIZATIONS = tuple(
+        optimization
+        for optimization in OPTIMIZATIONS
+        if optimization is not superinstruction_fusion
+    )
+
+    def optimized_instructions(program, counters=None, optimizations=UNFUSED_OPTIMIZATIONS):
+        return [
+            ('label', entry.label) if isinstance(entry, CIRLabel) else (entry.instruction, entry.argument)
+            for entry in unpack(optimize(program, counters, optimizations))
+        ]
+
+    class PeepholeTests(unittest.TestCase):
+        def test_removes_nested_pushes_and_drops(self):
+            program = program_of(
+                ('push_integer', 1),
+                ('push_string', '"a"'),
+                ('close', 'f'),
+                ('drop', None),
+                ('drop', None),
+                ('drop', None),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters), [('end', None)])
+            self.assertEqual(counters['peephole push_drop'], 3)
+
+        def test_removes_pushes_popped_into_the_same_symbol(self):
+            program = program_of(
+                ('push', 'sym(x)'),
+                ('pop', 'sym(x)'),
+                ('push', 'sym(x)'),
+                ('pop', 'sym(y)'),
+                ('push', 'sym(y)'),
+                ('end', None),
+            )
+
+            self.assertEqual(optimized_instructions(program), [
+                ('push', 'sym(x)'),
+                ('end', None),
+            ])
+
+        def test_leaves_pushes_and_drops_around_labels(self):
+            program = program_of(
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'l'),
+                ('push_integer', 1),
+                ('label', 'l'),
+                ('drop', None),
+                ('end', None),
+            )
+
+            self.assertEqual(optimized_instructions(program), [
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'l'),
+                ('push_integer', 1),
+                ('label', 'l'),
+                ('drop', None),
+                ('end', None),
+            ])
+
+        def test_applies_added_rules(self):
+            rules = (PeepholeRule('drop_drop', (DROP, DROP), _remove),)
+            program = program_of(('drop', None), ('drop', None), ('drop', None), ('end', None))
+            counters = collections.Counter()
+
+            opcodes, _ = peephole_optimization(program.opcodes, program.arguments, InternTable(), (), counters, rules)
+
+            self.assertEqual(list(opcodes), [DROP, END])
+            self.assertEqual(counters, {'peephole drop_drop': 1})
+
+    class ConstantFoldingTests(unittest.TestCase):
+        def test_folds_nested_operations(self):
+            program = program_of(
+                ('push_integer', 2),
+                ('push_integer', 3),
+                ('push_integer', 4),
+                ('mul', 2),
+                ('add', 2),
+                ('push_integer', -7),
+                ('push_integer', 2),
+                ('idiv', 2),
+                ('push_integer', -7),
+                ('push_integer', 2),
+                ('mod', 2),
+                ('neg', 1),
+                ('end', None),
+            )
+
+            self.assertEqual(optimized_instructions(program), [
+                ('push_integer', 14),
+                ('push_integer', -3),
+                ('push_integer', 1),
+                ('end', None),
+            ])
+
+        def test_leaves_division_by_zero_and_overflow_to_the_runtime(self):
+            instructions = (
+                ('push_integer', 1),
+                ('push_integer', 0),
+                ('idiv', 2),
+                ('push_integer', 2147483647),
+                ('push_integer', 1),
+                ('add', 2),
+                ('end', None),
+            )
+
+            self.assertEqual(optimized_instructions(program_of(*instructions)), list(instructions))
+
+        def test_folds_comparisons_and_branches(self):
+            program = program_of(
+                ('push_integer', 1),
+                ('push_integer', 2),
+                ('lt', 2),
+                ('jump_if_false', 'else'),
+                ('push_integer', 3),
+                ('label', 'else'),
+                ('push_integer', 1),
+                ('push_integer', 2),
+                ('gt', 2),
+                ('jump_if_false', 'end'),
+                ('push_integer', 4),
+                ('label', 'end'),
+                ('end', None),
+            )
+
+            # Once the branches are folded, the jump to the end goes to the
+            # next block after the one which can't run
+            self.assertEqual(optimized_instructions(program), [
+                ('push_integer', 3),
+                ('end', None),
+            ])
+
+        def test_propagates_constants_until_reassigned(self):
+            program = program_of(
+                ('push_integer', 2),
+                ('pop', 'sym(x)'),
+                ('push', 'sym(x)'),
+                ('push_integer', 3),
+                ('add', 2),
+                ('push', 'sym(f)'),
+                ('call', 1),
+                ('push_integer', 1),
+                ('pop', 'sym(y)'),
+                ('push', 'sym(y)'),
+                ('push', 'sym(z)'),
+                ('pop', 'sym(y)'),
+                ('push', 'sym(y)'),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters), [
+                ('push_integer', 5),
+                ('push', 'sym(f)'),
+                ('call', 1),
+                ('push_integer', 1),
+                ('push', 'sym(z)'),
+                ('end', None),
+            ])
+            self.assertEqual(counters['constant propagation'], 2)
+
+        def test_leaves_constants_assigned_in_branches(self):
+            instructions = (
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'else'),
+                ('push_integer', 1),
+                ('pop', 'sym(x)'),
+                ('label', 'else'),
+                ('push', 'sym(x)'),
+                ('end', None),
+            )
+
+            self.assertEqual(optimized_instructions(program_of(*instructions)), list(instructions))
+
+        def test_propagates_constants_after_control_flow_optimization(self):
+            # Threading the jump to the return leaves a return in the middle
+            # of the function, and the block after it is jumped to from
+            # before it
+            program = program_of(
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'else'),
+                ('push', 'sym(d)'),
+                ('jump_if_false', 'then'),
+                ('push_integer', 1),
+                ('pop', 'sym(y)'),
+                ('jump', 'return'),
+                ('label', 'then'),
+                ('push_integer', 2),
+                ('pop', 'sym(x)'),
+                ('label', 'else'),
+                ('push', 'sym(x)'),
+                ('push', 'sym(y)'),
+                ('label', 'return'),
+                ('return', None),
+            )
+            optimizations = (control_flow_optimization, constant_propagation)
+
+            self.assertEqual(optimized_instructions(program, optimizations=optimizations), [
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'else'),
+                ('push', 'sym(d)'),
+                ('jump_if_false', 'then'),
+                ('push_integer', 1),
+                ('pop', 'sym(y)'),
+                ('return', None),
+                ('label', 'then'),
+                ('push_integer', 2),
+                ('pop', 'sym(x)'),
+                ('label', 'else'),
+                ('push', 'sym(x)'),
+                ('push', 'sym(y)'),
+                ('return', None),
+            ])
+
+    class LivenessTests(unittest.TestCase):
+        def test_removes_pops_of_symbols_only_other_functions_read(self):
+            program = program_of(
+                ('label', 'f'),
+                ('pop', 'sym(x)'),
+                ('push_integer', 1),
+                ('return', None),
+                ('label', 'g'),
+                ('pop', 'sym(x)'),
+                ('push', 'sym(x)'),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('pop', 'sym(f)'),
+                ('close', 'g'),
+                ('pop', 'sym(g)'),
+                ('push_integer', 2),
+                ('push', 'sym(f)'),
+                ('call', 1),
+                ('push', 'sym(g)'),
+                ('call', 1),
+                ('drop', None),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters)[:4], [
+                ('label', 'f'),
+                ('drop', None),
+                ('push_integer', 1),
+                ('return', None),
+            ])
+            self.assertEqual(counters['dead pop'], 1)
+
+        def test_keeps_pops_which_closures_read(self):
+            instructions = (
+                ('label', 'get'),
+                ('push', 'sym(total)'),
+                ('return', None),
+                ('label', 'make'),
+                ('close', 'get'),
+                ('push', 'sym(start)'),
+                ('pop', 'sym(total)'),
+                ('return', None),
+                ('label', '__main__'),
+                ('push_integer', 1),
+                ('pop', 'sym(start)'),
+                ('close', 'make'),
+                ('call', 0),
+                ('call', 0),
+                ('drop', None),
+                ('end', None),
+            )
+
+            self.assertEqual(optimized_instructions(program_of(*instructions)), list(instructions))
+
+        def test_removes_closure_temporaries_which_are_never_read(self):
+            program = program_of(
+                ('label', 'f'),
+                ('push_integer', 1),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('pop', 'sym($0)'),
+                ('push', 'sym($0)'),
+                ('pop', 'sym(f)'),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters), [
+                ('label', '__main__'),
+                ('end', None),
+            ])
+            self.assertEqual(counters['dead pop'], 2)
+            self.assertEqual(counters['control flow unreferenced function'], 1)
+
+    class StackTemporaryTests(unittest.TestCase):
+        def test_leaves_temporaries_on_the_stack(self):
+            program = program_of(
+                ('label', 'f'),
+                ('pop', 'sym(b)'),
+                ('pop', 'sym(a)'),
+                ('push', 'sym(b)'),
+                ('push', 'sym(a)'),
+                ('sub', 2),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('pop', 'sym($0)'),
+                ('push_integer', 1),
+                ('push_integer', 2),
+                ('push', 'sym($0)'),
+                ('call', 2),
+                ('push', 'sym(print)'),
+                ('call', 1),
+                ('drop', None),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters), [
+                ('label', 'f'),
+                ('swap', None),
+                ('sub', 2),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('push_integer', 1),
+                ('push_integer', 2),
+                ('rot', None),
+                ('call', 2),
+                ('push', 'sym(print)'),
+                ('call', 1),
+                ('drop', None),
+                ('end', None),
+            ])
+            self.assertEqual(counters['stack temporary'], 3)
+
+        def test_copies_values_read_more_than_once(self):
+            program = program_of(
+                ('push', 'sym(x)'),
+                ('pop', 'sym(y)'),
+                ('push', 'sym(y)'),
+                ('push_integer', 1),
+                ('add', 2),
+                ('push', 'sym(y)'),
+                ('mul', 2),
+                ('end', None),
+            )
+
+            self.assertEqual(optimized_instructions(program), [
+                ('push', 'sym(x)'),
+                ('dup', None),
+                ('push_integer', 1),
+                ('add', 2),
+                ('mul', 2),
+                ('end', None),
+            ])
+
+        def test_leaves_variables_read_from_too_deep(self):
+            instructions = [('label', '__main__')]
+
+            for name in 'abcd':
+                instructions.extend((('push', 'sym(x)'), ('pop', 'sym({})'.format(name))))
+
+            for name in 'adcb':
+                instructions.append(('push', 'sym({})'.format(name)))
+
+                if name != 'a':
+                    instructions.append(('sub', 2))
+
+            instructions.extend((('push', 'sym(print)'), ('call', 1), ('drop', None), ('end', None)))
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program_of(*instructions), counters), [
+                ('label', '__main__'),
+                ('push', 'sym(x)'),
+                ('pop', 'sym(a)'),
+                ('push', 'sym(x)'),
+                ('push', 'sym(x)'),
+                ('push', 'sym(x)'),
+                ('push', 'sym(a)'),
+                ('swap', None),
+                ('sub', 2),
+                ('swap', None),
+                ('sub', 2),
+                ('swap', None),
+                ('sub', 2),
+                ('push', 'sym(print)'),
+                ('call', 1),
+                ('drop', None),
+                ('end', None),
+            ])
+            self.assertEqual(counters['stack temporary'], 3)
+
+        def test_leaves_variables_closures_read_or_read_in_other_blocks(self):
+            instructions = (
+                ('label', 'get'),
+                ('push', 'sym(x)'),
+                ('return', None),
+                ('label', '__main__'),
+                ('push', 'sym(a)'),
+                ('pop', 'sym(x)'),
+                ('close', 'get'),
+                ('push', 'sym(x)'),
+                ('push', 'sym(print)'),
+                ('call', 2),
+                ('pop', 'sym(y)'),
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'else'),
+                ('push', 'sym(y)'),
+                ('push', 'sym(print)'),
+                ('call', 1),
+                ('drop', None),
+                ('label', 'else'),
+                ('end', None),
+            )
+
+            self.assertEqual(optimized_instructions(program_of(*instructions)), list(instructions))
+
+    class ControlFlowTests(unittest.TestCase):
+        # The CIR generated for if and else
+        if_else = (
+            ('push', 'sym(c)'),
+            ('jump_if_false', '__else$0__'),
+            ('jump', '__if$0__'),
+            ('label', '__if$0__'),
+            ('push', 'sym(a)'),
+            ('jump', '__endif$0__'),
+            ('label', '__else$0__'),
+            ('push', 'sym(b)'),
+            ('label', '__endif$0__'),
+        )
+
+        def test_builds_blocks_with_their_successors(self):
+            program = program_of(('label', '__main__'), *self.if_else + (('end', None),))
+            blocks = build_control_flow_graph(program.opcodes, program.arguments)
+
+            self.assertEqual(
+                [(block.end - block.start, block.successors) for block in blocks],
+                [(2, (1, 3)), (1, (2,)), (2, (4,)), (1, (4,)), (1, ())],
+            )
+            self.assertEqual([len(block.labels) for block in blocks], [1, 0, 1, 1, 1])
+
+        def test_removes_jumps_to_the_next_block_and_their_labels(self):
+            program = program_of(('label', '__main__'), *self.if_else + (('drop', None), ('end', None)))
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters), [
+                ('label', '__main__'),
+                ('push', 'sym(c)'),
+                ('jump_if_false', '__else$0__'),
+                ('push', 'sym(a)'),
+                ('jump', '__endif$0__'),
+                ('label', '__else$0__'),
+                ('push', 'sym(b)'),
+                ('label', '__endif$0__'),
+                ('drop', None),
+                ('end', None),
+            ])
+            self.assertEqual(counters['control flow jump to next'], 1)
+            self.assertEqual(counters['control flow dead label'], 1)
+
+        def test_threads_jumps_to_jumps_and_returns(self):
+            program = program_of(
+                ('label', 'f'),
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'else'),
+                ('push', 'sym(d)'),
+                ('jump_if_false', 'inner_else'),
+                ('push', 'sym(a)'),
+                ('jump', 'inner_endif'),
+                ('label', 'inner_else'),
+                ('push', 'sym(b)'),
+                ('label', 'inner_endif'),
+                ('jump', 'endif'),
+                ('label', 'else'),
+                ('push', 'sym(e)'),
+                ('label', 'endif'),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('push', 'sym(g)'),
+                ('call', 1),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters), [
+                ('label', 'f'),
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'else'),
+                ('push', 'sym(d)'),
+                ('jump_if_false', 'inner_else'),
+                ('push', 'sym(a)'),
+                ('return', None),
+                ('label', 'inner_else'),
+                ('push', 'sym(b)'),
+                ('return', None),
+                ('label', 'else'),
+                ('push', 'sym(e)'),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('push', 'sym(g)'),
+                ('call', 1),
+                ('end', None),
+            ])
+            self.assertEqual(counters['control flow threaded jump'], 2)
+
+        def test_removes_functions_which_are_never_closed(self):
+            program = program_of(
+                ('label', 'f'),
+                ('push_integer', 1),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('drop', None),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters), [
+                ('label', '__main__'),
+                ('end', None),
+            ])
+            self.assertEqual(counters['control flow unreferenced function'], 1)
+
+        def test_moves_blocks_after_the_jumps_to_them(self):
+            program = program_of(
+                ('label', '__main__'),
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'b'),
+                ('jump', 'a'),
+                ('label', 'b'),
+                ('push', 'sym(y)'),
+                ('end', None),
+                ('label', 'a'),
+                ('push', 'sym(x)'),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters), [
+                ('label', '__main__'),
+                ('push', 'sym(c)'),
+                ('jump_if_false', 'b'),
+                ('push', 'sym(x)'),
+                ('end', None),
+                ('label', 'b'),
+                ('push', 'sym(y)'),
+                ('end', None),
+            ])
+            self.assertEqual(counters['control flow reordered block'], 1)
+            self.assertEqual(counters['control flow jump to next'], 1)
+
+    class SuperinstructionTests(unittest.TestCase):
+        def test_fuses_calls_operations_and_branches(self):
+            program = program_of(
+                ('label', 'f'),
+                ('pop', 'sym(n)'),
+                ('push', 'sym(n)'),
+                ('push_integer', 2),
+                ('lt', 2),
+                ('jump_if_false', 'else'),
+                ('push', 'sym(n)'),
+                ('return', None),
+                ('label', 'else'),
+                ('push', 'sym(n)'),
+                ('push_integer', 1),
+                ('sub', 2),
+                ('push', 'sym(f)'),
+                ('call', 1),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('pop', 'sym(f)'),
+                ('push_integer', 3),
+                ('push', 'sym(f)'),
+                ('call', 1),
+                ('push', 'sym(print)'),
+                ('call', 1),
+                ('drop', None),
+                ('end', None),
+            )
+            counters = collections.Counter()
+
+            self.assertEqual(optimized_instructions(program, counters, OPTIMIZATIONS), [
+                ('label', 'f'),
+                ('pop', 'sym(n)'),
+                ('push', 'sym(n)'),
+                ('push_integer', 2),
+                ('lt_jump_if_false', 'else'),
+                ('push', 'sym(n)'),
+                ('return', None),
+                ('label', 'else'),
+                ('sub_symbol_integer', ('sym(n)', 1)),
+                ('call_symbol', ('sym(f)', 1)),
+                ('return', None),
+                ('label', '__main__'),
+                ('close', 'f'),
+                ('pop', 'sym(f)'),
+                ('push_integer', 3),
+                ('call_symbol', ('sym(f)', 1)),
+                ('call_symbol', ('sym(print)', 1)),
+                ('drop', None),
+                ('end', None),
+            ])
+            self.assertEqual(counters['peephole fuse call_symbol'], 3)
+            self.assertEqual(counters['peephole fuse lt_jump_if_false'], 1)
+            self.assertEqual(counters['peephole fuse sub_symbol_integer'], 1)
 
-def optimize(cir_program):
-    ir = cir_program.entry_list
+        def test_leaves_integers_which_do_not_fit_the_argument(self):
+            program = program_of(
+                ('push', 'sym(x)'),
+                ('push_integer', 2 ** 40),
+                ('add', 2),
+                ('end', None),
+            )
 
-    ir = push_drop_optimization(ir)
-    ir = unused_pop_optimization(ir)
+            self.assertEqual(optimized_instructions(program, optimizations=OPTIMIZATIONS), [
+                ('push', 'sym(x)'),
+                ('push_integer', 2 ** 40),
+                ('add', 2),
+                ('end', None),
+            ])
 
-    return CIRProgram(entry_list=tuple(ir))
+    unittest.main()
@@ -1,22 +1,165 @@
-import collections
+import collections.abc
+
+import util
+
+# Gives the parser indexed access to a stream of tokens, buffering only the
+# tokens from the last released index onwards
+class TokenWindow(object):
+    def __init__(self, tokens, memo=None):
+        self._tokens = iter(tokens)
+        self._buffer = []
+        self._offset = 0
+        self.memo = memo
+
+    def __getitem__(self, index):
+        position = index - self._offset
+
+        if position < 0:
+            raise Exception('Token {} was already released'.format(index))
+
+        buffer = self._buffer
+
+        while position >= len(buffer):
+            try:
+                buffer.append(next(self._tokens))
+            except StopIteration:
+                raise IndexError('Token index out of range')
+
+        return buffer[position]
+
+    def release(self, index):
+        # The parser never backtracks past the start of a top-level statement,
+        # so once one is parsed the tokens before it can be dropped
+        del self._buffer[:index - self._offset]
+        self._offset = index
+
+        if self.memo is not None:
+            self.memo.clear()
+
+# Tokens which are all held anyway, with the memo for their parse. Indexing
+# stays as fast as a tuple's, which a TokenWindow's isn't.
+class _MemoizedTokens(tuple):
+    def __new__(cls, tokens, memo):
+        result = super().__new__(cls, tokens)
+        result.memo = memo
+        return result
+
+# Packrat memo table for a single parse, keyed by (rule, index). Parsers only
+# depend on the tokens and the index, so a result computed once can be reused
+# by every alternative that tries the same rule at the same place.
+class PackratMemo(object):
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._table = {}
+
+    def lookup(self, key):
+        result = self._table.get(key)
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return result
+
+    def store(self, key, result):
+        if len(self._table) >= self.max_entries:
+            # Dicts keep insertion order, so this evicts the oldest entry
+            del self._table[next(iter(self._table))]
+            self.evictions += 1
+
+        self._table[key] = result
+
+    def clear(self):
+        self._table.clear()
+
+def _memoized_parser(rule):
+    def decorator(parser):
+        def storing_parser(index, tokens, memo, key):
+            result = yield parser(index, tokens)
+            memo.store(key, result)
+            return result
+
+        def result_parser(index, tokens):
+            memo = getattr(tokens, 'memo', None)
+
+            if memo is None:
+                return parser(index, tokens)
+
+            key = (rule, index)
+            result = memo.lookup(key)
+
+            if result is None:
+                return storing_parser(index, tokens, memo, key)
+
+            return result
+
+        return result_parser
+
+    return decorator
+
+def _has_token(index, tokens):
+    try:
+        tokens[index]
+    except IndexError:
+        return False
+
+    return True
 
 def consume_newlines(index, tokens):
-    while index < len(tokens) and tokens[index].type == 'newline':
+    while _has_token(index, tokens) and tokens[index].type == 'newline':
         index += 1
 
     return True, index, None
 
 def _or_parser(*parsers):
+    def remaining_parser(index, tokens, position, pending):
+        while True:
+            result = yield pending
+
+            if result[0]:
+                return result
+
+            for position in range(position + 1, len(parsers)):
+                pending = parsers[position](index, tokens)
+
+                if type(pending) is not tuple:
+                    break
+
+                if pending[0]:
+                    return pending
+            else:
+                return (False, index, None)
+
     def result_parser(index, tokens):
-        failure = (False, index, None)
+        # Leaves, and rules which fail on their first token, return their
+        # result directly. We only need a generator, and the trampoline, from
+        # the first alternative which returns one.
+        for position, parser in enumerate(parsers):
+            result = parser(index, tokens)
 
-        for parser in parsers:
-            success, index, value = parser(index, tokens)
+            if type(result) is not tuple:
+                return remaining_parser(index, tokens, position, result)
 
-            if success:
-                return (success, index, value)
+            if result[0]:
+                return result
 
-        return failure
+        return (False, index, None)
+
+    return result_parser
+
+def _token_type_dispatch_parser(parsers_by_token_type):
+    # Tries only the alternatives which can start with the current token
+    def result_parser(index, tokens):
+        parser = parsers_by_token_type.get(tokens[index].type)
+
+        if parser is None:
+            return (False, index, None)
+
+        return parser(index, tokens)
 
     return result_parser
 
@@ -24,8 +167,8 @@ def _zero_or_more_parser(formatter, parser):
     def result_parser(index, tokens):
         values = []
 
-        while index < len(tokens):
-            success, index, value = parser(index, tokens)
+        while _has_token(index, tokens):
+            success, index, value = yield parser(index, tokens)
 
             if success:
                 values.append(value)
@@ -36,14 +179,14 @@ def _zero_or_more_parser(formatter, parser):
 
     return result_parser
 
-FurIntegerLiteralExpression = collections.namedtuple(
+FurIntegerLiteralExpression = util.node_type(
     'FurIntegerLiteralExpression',
     [
         'integer',
     ],
 )
 
-FurLambdaExpression = collections.namedtuple(
+FurLambdaExpression = util.node_type(
     'FurLambdaExpression',
     (
         'argument_name_list',
@@ -51,14 +194,14 @@ FurLambdaExpression = collections.namedtuple(
     ),
 )
 
-FurStringLiteralExpression = collections.namedtuple(
+FurStringLiteralExpression = util.node_type(
     'FurStringLiteralExpression',
     [
         'string',
     ],
 )
 
-FurSymbolExpression = collections.namedtuple(
+FurSymbolExpression = util.node_type(
     'FurSymbolExpression',
     [
         'metadata',
@@ -66,7 +209,7 @@ FurSymbolExpression = collections.namedtuple(
     ],
 )
 
-FurNegationExpression = collections.namedtuple(
+FurNegationExpression = util.node_type(
     'FurNegationExpression',
     [
         'metadata',
@@ -74,7 +217,7 @@ FurNegationExpression = collections.namedtuple(
     ],
 )
 
-FurInfixExpression = collections.namedtuple(
+FurInfixExpression = util.node_type(
     'FurInfixExpression',
     [
         'metadata',
@@ -85,14 +228,14 @@ FurInfixExpression = collections.namedtuple(
     ],
 )
 
-FurListLiteralExpression = collections.namedtuple(
+FurListLiteralExpression = util.node_type(
     'FurListLiteralExpression',
     [
         'item_expression_list',
     ],
 )
 
-FurIfExpression = collections.namedtuple(
+FurIfExpression = util.node_type(
     'FurIfExpression',
     [
         'condition_expression',
@@ -101,7 +244,7 @@ FurIfExpression = collections.namedtuple(
     ],
 )
 
-FurSymbolExpressionPair = collections.namedtuple(
+FurSymbolExpressionPair = util.node_type(
     'FurSymbolExpressionPair',
     [
         'symbol',
@@ -109,7 +252,7 @@ FurSymbolExpressionPair = collections.namedtuple(
     ],
 )
 
-FurStructureLiteralExpression = collections.namedtuple(
+FurStructureLiteralExpression = util.node_type(
     'FurStructureLiteralExpression',
     [
         'fields',
@@ -148,6 +291,40 @@ def _symbol_expression_parser(index, tokens):
 
     return (False, index, None)
 
+def _first_token_parser(token_type, match, parser):
+    # Most rules are tried at tokens where they fail straight away, so check
+    # the first token before creating a generator for the rest of the rule
+    def result_parser(index, tokens):
+        token = tokens[index]
+
+        if token.type != token_type or (match is not None and token.match != match):
+            return (False, index, None)
+
+        return parser(index, tokens)
+
+    return result_parser
+
+def _postfix_guard_parser(operand_parser, suffix_parser, parser):
+    # Postfix rules are tried at every operand, but the operand is usually a
+    # symbol with no suffix after it, which we can rule out the same way
+    def result_parser(index, tokens):
+        result = operand_parser(index, tokens)
+
+        if type(result) is tuple:
+            success, end, _ = result
+
+            if not success or not _has_token(end, tokens):
+                return (False, index, None)
+
+            result = suffix_parser(end, tokens)
+
+            if type(result) is tuple and not result[0]:
+                return (False, index, None)
+
+        return parser(index, tokens)
+
+    return result_parser
+
 def _wrapped_parser(open_token, close_token, internal_parser):
     def result_parser(index, tokens):
         failure = (False, index, None)
@@ -157,7 +334,7 @@ def _wrapped_parser(open_token, close_token, internal_parser):
         else:
             return failure
 
-        success, index, internal = internal_parser(index, tokens)
+        success, index, internal = yield internal_parser(index, tokens)
         if not success:
             return failure
 
@@ -166,13 +343,13 @@ def _wrapped_parser(open_token, close_token, internal_parser):
         else:
             # TODO Put the actual expected character in the error message
             raise Exception('Expected closing token on line {}, found "{}"'.format(
-                tokens[index].line,
+                tokens[index].metadata.line,
                 tokens[index].match,
             ))
 
         return True, index, internal
 
-    return result_parser
+    return _first_token_parser(open_token, None, result_parser)
 
 def _bracket_wrapped_parser(internal_parser):
     return _wrapped_parser('open_bracket', 'close_bracket', internal_parser)
@@ -180,164 +357,152 @@ def _bracket_wrapped_parser(internal_parser):
 def _parenthese_wrapped_parser(internal_parser):
     return _wrapped_parser('open_parenthese', 'close_parenthese', internal_parser)
 
-def _parenthesized_expression_parser(index, tokens):
-    return _parenthese_wrapped_parser(_expression_parser)(index, tokens)
+def _deferred_parser(grammar, rule):
+    # Lets rules refer to rules of the grammar which haven't been built yet
+    def result_parser(index, tokens):
+        return getattr(grammar, rule)(index, tokens)
 
-def symbol_expression_pair_parser(index, tokens):
-    failure = (False, index, None)
+    return result_parser
 
-    if tokens[index].type == 'symbol':
-        symbol = tokens[index].match
-        index += 1
-    else:
-        return failure
+def symbol_expression_pair_parser(expression_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
 
-    if tokens[index].type == 'colon':
-        index += 1
-    else:
-        return failure
+        if tokens[index].type == 'symbol':
+            symbol = tokens[index].match
+            index += 1
+        else:
+            return failure
 
-    success, index, expression = _expression_parser(index, tokens)
-
-    if not success:
-        raise Exception()
-
-    return (
-        True,
-        index,
-        FurSymbolExpressionPair(
-            symbol=symbol,
-            expression=expression,
-        ),
-    )
-
-def _structure_literal_parser(index, tokens):
-    success, index, result = _parenthese_wrapped_parser(_comma_separated_list_parser(symbol_expression_pair_parser))(index, tokens)
-    return (
-        success,
-        index,
-        FurStructureLiteralExpression(
-            fields=result,
-        ),
-    )
-
-def _lambda_expression_parser(index, tokens):
-    failure = (False, index, None)
+        if tokens[index].type == 'colon':
+            index += 1
+        else:
+            return failure
 
-    if tokens[index].type == 'keyword' and tokens[index].match == 'lambda':
-        index += 1
-    else:
-        return failure
+        success, index, expression = yield expression_parser(index, tokens)
 
-    if tokens[index].type == 'open_parenthese':
-        index += 1
-    else:
-        raise Exception('Expected "(", found "{}" on line {}'.format(
-            tokens[index].match,
-            tokens[index].metadata.line,
-        ))
+        if not success:
+            raise Exception()
 
-    success, index, argument_name_list = _comma_separated_list_parser(_symbol_expression_parser)(
-        index,
-        tokens,
-    )
+        return (
+            True,
+            index,
+            FurSymbolExpressionPair(
+                symbol=symbol,
+                expression=expression,
+            ),
+        )
 
-    if tokens[index].type == 'close_parenthese':
-        index += 1
-    else:
-        raise Exception('Expected ")", found "{}" on line {}'.format(
-            tokens[index].match,
-            tokens[index].line,
-        ))
+    return result_parser
 
-    if tokens[index].match == 'do':
-        index += 1
-    else:
-        return failure
+def _structure_literal_parser(fields_parser):
+    def result_parser(index, tokens):
+        success, index, result = yield fields_parser(index, tokens)
+        return (
+            success,
+            index,
+            FurStructureLiteralExpression(
+                fields=result,
+            ),
+        )
 
-    success, index, statement_list = _zero_or_more_parser(tuple, _statement_parser)(index, tokens)
+    return result_parser
 
-    _, index, _ = consume_newlines(index, tokens)
+def _lambda_expression_parser(argument_name_list_parser, statement_list_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
 
-    if tokens[index].type == 'keyword' and tokens[index].match == 'end':
-        index += 1
-    else:
-        return failure
+        if tokens[index].type == 'keyword' and tokens[index].match == 'lambda':
+            index += 1
+        else:
+            return failure
 
-    return True, index, FurLambdaExpression(
-        argument_name_list=tuple(an.symbol for an in argument_name_list),
-        statement_list=statement_list,
-    )
+        if tokens[index].type == 'open_parenthese':
+            index += 1
+        else:
+            raise Exception('Expected "(", found "{}" on line {}'.format(
+                tokens[index].match,
+                tokens[index].metadata.line,
+            ))
 
+        success, index, argument_name_list = yield argument_name_list_parser(index, tokens)
 
+        if tokens[index].type == 'close_parenthese':
+            index += 1
+        else:
+            raise Exception('Expected ")", found "{}" on line {}'.format(
+                tokens[index].match,
+                tokens[index].metadata.line,
+            ))
 
-def _list_literal_expression_parser(index, tokens):
-    failure = (False, index, None)
+        if tokens[index].match == 'do':
+            index += 1
+        else:
+            return failure
 
-    success, index, item_expression_list = _bracket_wrapped_parser(_comma_separated_expression_list_parser)(index, tokens)
+        success, index, statement_list = yield statement_list_parser(index, tokens)
 
-    if success:
-        return success, index, FurListLiteralExpression(
-            item_expression_list=item_expression_list,
+        _, index, _ = consume_newlines(index, tokens)
+
+        if tokens[index].type == 'keyword' and tokens[index].match == 'end':
+            index += 1
+        else:
+            return failure
+
+        return True, index, FurLambdaExpression(
+            argument_name_list=tuple(an.symbol for an in argument_name_list),
+            statement_list=statement_list,
         )
-    else:
-        return failure
 
-def _literal_level_expression_parser(index, tokens):
-    return _or_parser(
-        _list_item_expression_parser,
-        _function_call_expression_parser,
-        _parenthesized_expression_parser,
-        _integer_literal_expression_parser,
-        _string_literal_expression_parser,
-        _list_literal_expression_parser,
-        _lambda_expression_parser,
-        _symbol_expression_parser,
-        _structure_literal_parser,
-    )(index, tokens)
-
-def _dot_expression_parser(index, tokens):
-    return _left_recursive_infix_operator_parser(
-        lambda token: token.type == 'period',
-        _literal_level_expression_parser,
-        'dot_level',
-    )(index, tokens)
-
-def _negation_expression_parser(index, tokens):
-    failure = (False, index, None)
+    return result_parser
 
-    if tokens[index].match != '-':
-        return failure
+def _list_literal_expression_parser(item_expression_list_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
 
-    metadata = tokens[index].metadata
+        success, index, item_expression_list = yield item_expression_list_parser(index, tokens)
 
-    success, index, value = _dot_expression_parser(index + 1, tokens)
+        if success:
+            return success, index, FurListLiteralExpression(
+                item_expression_list=item_expression_list,
+            )
+        else:
+            return failure
 
-    if not success:
-        return failure
+    return result_parser
 
-    return (True, index, FurNegationExpression(metadata=metadata, value=value))
+def _negation_expression_parser(operand_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
 
-def _negation_level_expression_parser(index, tokens):
-    return _or_parser(
-        _dot_expression_parser,
-        _negation_expression_parser,
-    )(index, tokens)
+        if tokens[index].match != '-':
+            return failure
+
+        metadata = tokens[index].metadata
+
+        success, index, value = yield operand_parser(index + 1, tokens)
+
+        if not success:
+            return failure
+
+        return (True, index, FurNegationExpression(metadata=metadata, value=value))
+
+    return result_parser
 
 def _left_recursive_infix_operator_parser(operator_token_matcher, operand_parser, order):
-    def result_parser(index, tokens):
+    def operator_chain_parser(index, tokens, operand):
         failure = (False, index, None)
 
-        success, index, result = operand_parser(index, tokens)
+        success, index, result = yield operand
 
         if not success:
             return failure
 
-        while success and index < len(tokens) and operator_token_matcher(tokens[index]):
+        while success and _has_token(index, tokens) and operator_token_matcher(tokens[index]):
             success = False
 
-            if index + 1 < len(tokens):
-                success, try_index, value = operand_parser(index + 1, tokens)
+            if _has_token(index + 1, tokens):
+                success, try_index, value = yield operand_parser(index + 1, tokens)
 
             if success:
                 result = FurInfixExpression(
@@ -351,42 +516,117 @@ def _left_recursive_infix_operator_parser(operator_token_matcher, operand_parser
 
         return True, index, result
 
+    def result_parser(index, tokens):
+        operand = operand_parser(index, tokens)
+
+        # Most operands have no operator after them, and are returned as they
+        # are without creating a generator
+        if type(operand) is tuple:
+            success, end, _ = operand
+
+            if not success:
+                return (False, index, None)
+
+            if not _has_token(end, tokens) or not operator_token_matcher(tokens[end]):
+                return operand
+
+        return operator_chain_parser(index, tokens, operand)
+
     return result_parser
 
-def _multiplication_level_expression_parser(index, tokens):
-    return _left_recursive_infix_operator_parser(
-        lambda token: token.type == 'multiplication_level_operator',
-        _negation_level_expression_parser,
-        'multiplication_level',
-    )(index, tokens)
-
-def _addition_level_expression_parser(index, tokens):
-    return _left_recursive_infix_operator_parser(
-        lambda token: token.type == 'addition_level_operator',
-        _multiplication_level_expression_parser,
-        'addition_level',
-    )(index, tokens)
-
-def _comparison_level_expression_parser(index, tokens):
-    return _left_recursive_infix_operator_parser(
-        lambda token: token.type == 'comparison_level_operator',
-        _addition_level_expression_parser,
-        'comparison_level',
-    )(index, tokens)
-
-def _and_level_expression_parser(index, tokens):
-    return _left_recursive_infix_operator_parser(
-        lambda token: token.type == 'symbol' and token.match == 'and',
-        _comparison_level_expression_parser,
-        'and_level',
-    )(index, tokens)
-
-def _or_level_expression_parser(index, tokens):
-    return _left_recursive_infix_operator_parser(
-        lambda token: token.type == 'symbol' and token.match == 'or',
-        _and_level_expression_parser,
-        'or_level',
-    )(index, tokens)
+# Infix operators from loosest to tightest binding. Operators are matched by
+# token type, or by symbol for word operators like "and". All infix operators
+# are left associative.
+INFIX_OPERATOR_LEVELS = (
+    ('or_level',                ('symbol', 'or')),
+    ('and_level',               ('symbol', 'and')),
+    ('comparison_level',        ('comparison_level_operator', None)),
+    ('addition_level',          ('addition_level_operator', None)),
+    ('multiplication_level',    ('multiplication_level_operator', None)),
+)
+
+_INFIX_OPERATORS_BY_TOKEN_TYPE = {
+    token_type: (binding_power, order)
+    for binding_power, (order, (token_type, symbol)) in enumerate(INFIX_OPERATOR_LEVELS)
+    if symbol is None
+}
+
+_INFIX_OPERATORS_BY_SYMBOL = {
+    symbol: (binding_power, order)
+    for binding_power, (order, (token_type, symbol)) in enumerate(INFIX_OPERATOR_LEVELS)
+    if symbol is not None
+}
+
+def _infix_operator(token):
+    if token.type == 'symbol':
+        return _INFIX_OPERATORS_BY_SYMBOL.get(token.match)
+
+    return _INFIX_OPERATORS_BY_TOKEN_TYPE.get(token.type)
+
+# Precedence climbing over INFIX_OPERATOR_LEVELS. This builds the same trees
+# as one left recursive parser per level, but each operand is parsed directly
+# rather than through a call for every level.
+def _infix_expression_parser(operand_parser):
+    def climbing_generator(index, tokens, minimum_binding_power, operand):
+        failure = (False, index, None)
+
+        success, index, result = yield operand
+
+        if not success:
+            return failure
+
+        while _has_token(index, tokens):
+            operator = _infix_operator(tokens[index])
+
+            if operator is None:
+                break
+
+            binding_power, order = operator
+
+            if binding_power < minimum_binding_power or not _has_token(index + 1, tokens):
+                break
+
+            success, try_index, value = yield climbing_parser(index + 1, tokens, binding_power + 1)
+
+            if not success:
+                break
+
+            result = FurInfixExpression(
+                metadata=tokens[index].metadata,
+                order=order,
+                operator=tokens[index].match,
+                left=result,
+                right=value,
+            )
+            index = try_index
+
+        return True, index, result
+
+    def climbing_parser(index, tokens, minimum_binding_power):
+        operand = operand_parser(index, tokens)
+
+        # As for the dot operator, an operand with no operator that binds it
+        # is returned without creating a generator
+        if type(operand) is tuple:
+            success, end, _ = operand
+
+            if not success:
+                return (False, index, None)
+
+            if not _has_token(end, tokens):
+                return operand
+
+            operator = _infix_operator(tokens[end])
+
+            if operator is None or operator[0] < minimum_binding_power or not _has_token(end + 1, tokens):
+                return operand
+
+        return climbing_generator(index, tokens, minimum_binding_power, operand)
+
+    def result_parser(index, tokens):
+        return climbing_parser(index, tokens, 0)
+
+    return result_parser
 
 def _comma_separated_list_parser(subparser):
     def result_parser(index, tokens):
@@ -396,21 +636,21 @@ def _comma_separated_list_parser(subparser):
 
         _, index, _ = consume_newlines(index, tokens)
 
-        success, index, item = subparser(index, tokens)
+        success, index, item = yield subparser(index, tokens)
 
         if success:
             items.append(item)
         else:
             return (True, start_index, ())
 
-        while success and index < len(tokens) and tokens[index].type == 'comma':
+        while success and _has_token(index, tokens) and tokens[index].type == 'comma':
             index += 1
             success = False
 
             _, index, _ = consume_newlines(index, tokens)
 
-            if index < len(tokens):
-                success, try_index, item = subparser(index, tokens)
+            if _has_token(index, tokens):
+                success, try_index, item = yield subparser(index, tokens)
 
             if success:
                 items.append(item)
@@ -420,10 +660,7 @@ def _comma_separated_list_parser(subparser):
 
     return result_parser
 
-def _comma_separated_expression_list_parser(index, tokens):
-    return _comma_separated_list_parser(_expression_parser)(index, tokens)
-
-FurListItemExpression = collections.namedtuple(
+FurListItemExpression = util.node_type(
     'FurListItemExpression',
     [
         'list_expression',
@@ -432,7 +669,7 @@ FurListItemExpression = collections.namedtuple(
     ],
 )
 
-FurFunctionCallExpression = collections.namedtuple(
+FurFunctionCallExpression = util.node_type(
     'FurFunctionCallExpression',
     [
         'metadata',
@@ -441,14 +678,14 @@ FurFunctionCallExpression = collections.namedtuple(
     ],
 )
 
-FurExpressionStatement = collections.namedtuple(
+FurExpressionStatement = util.node_type(
     'FurExpressionStatement',
     [
         'expression',
     ],
 )
 
-FurAssignmentStatement = collections.namedtuple(
+FurAssignmentStatement = util.node_type(
     'FurAssignmentStatement',
     [
         'target',
@@ -456,7 +693,7 @@ FurAssignmentStatement = collections.namedtuple(
     ],
 )
 
-FurFunctionDefinitionStatement = collections.namedtuple(
+FurFunctionDefinitionStatement = util.node_type(
     'FurFunctionDefinitionStatement',
     [
         'name',
@@ -465,267 +702,389 @@ FurFunctionDefinitionStatement = collections.namedtuple(
     ],
 )
 
-FurProgram = collections.namedtuple(
+FurProgram = util.node_type(
     'FurProgram',
     [
         'statement_list',
     ],
 )
 
-def _list_item_expression_parser(index, tokens):
-    failure = (False, index, None)
+# We have to be careful what expressions we pass as list_expression_parser. Otherwise
+# expressions like "a + b[0]" become ambiguous to the parser.
+def _list_item_expression_parser(list_expression_parser, index_expression_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
 
-    # We have to be careful what expressions we add here. Otherwise expressions
-    # like "a + b[0]" become ambiguous to the parser.
-    success, index, list_expression = _or_parser(
-        _symbol_expression_parser,
-        _parenthesized_expression_parser,
-    )(index, tokens)
+        success, index, list_expression = yield list_expression_parser(index, tokens)
 
-    if not success:
-        return failure
+        if not success or not _has_token(index, tokens):
+            return failure
 
-    metadata = tokens[index].metadata
+        metadata = tokens[index].metadata
 
-    success, index, index_expression = _bracket_wrapped_parser(_expression_parser)(
-        index,
-        tokens,
-    )
+        success, index, index_expression = yield index_expression_parser(index, tokens)
 
-    if not success:
-        return failure
+        if not success:
+            return failure
 
-    while success and index < len(tokens):
-        # "list_expression" is actually the full list item expression if the next parse attempt doesn't succeed
-        # We can't give this a better name without a bunch of checks, however.
-        list_expression = FurListItemExpression(
-            list_expression=list_expression,
-            metadata=metadata,
-            index_expression=index_expression,
-        )
+        while success:
+            # "list_expression" is actually the full list item expression if the next parse attempt doesn't succeed
+            # We can't give this a better name without a bunch of checks, however.
+            list_expression = FurListItemExpression(
+                list_expression=list_expression,
+                metadata=metadata,
+                index_expression=index_expression,
+            )
 
-        metadata = tokens[index].metadata
+            if not _has_token(index, tokens):
+                break
 
-        success, index, index_expression = _bracket_wrapped_parser(_expression_parser)(
-            index,
-            tokens,
-        )
+            metadata = tokens[index].metadata
 
-    return True, index, list_expression
+            success, index, index_expression = yield index_expression_parser(index, tokens)
 
-def _function_call_expression_parser(index, tokens):
-    failure = (False, index, None)
+        return True, index, list_expression
 
-    # We have to be careful what expressions we add here. Otherwise expressions
-    # like "a + b()" become ambiguous to the parser.
-    success, index, function = _or_parser(
-        _symbol_expression_parser,
-        _parenthesized_expression_parser,
-    )(index, tokens)
+    return result_parser
 
-    if not success:
-        return failure
+# We have to be careful what expressions we pass as function_parser. Otherwise
+# expressions like "a + b()" become ambiguous to the parser.
+def _function_call_expression_parser(function_parser, arguments_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
 
-    metadata = tokens[index].metadata
+        success, index, function = yield function_parser(index, tokens)
 
-    success, index, arguments = _parenthese_wrapped_parser(_comma_separated_expression_list_parser)(
-        index,
-        tokens,
-    )
+        if not success or not _has_token(index, tokens):
+            return failure
 
-    if not success:
-        return failure
+        metadata = tokens[index].metadata
 
-    while success and index < len(tokens):
-        # "function" is actually the full function call if the next parse attempt doesn't succeed
-        # We can't give this a better name without a bunch of checks, however.
-        function = FurFunctionCallExpression(
-            metadata=metadata,
-            function=function,
-            arguments=arguments,
-        )
+        success, index, arguments = yield arguments_parser(index, tokens)
 
-        metadata = tokens[index].metadata
+        if not success:
+            return failure
 
-        success, index, arguments = _parenthese_wrapped_parser(_comma_separated_expression_list_parser)(
-            index,
-            tokens,
-        )
+        while success:
+            # "function" is actually the full function call if the next parse attempt doesn't succeed
+            # We can't give this a better name without a bunch of checks, however.
+            function = FurFunctionCallExpression(
+                metadata=metadata,
+                function=function,
+                arguments=arguments,
+            )
 
-    return True, index, function
+            if not _has_token(index, tokens):
+                break
 
-def _if_expression_parser(index, tokens):
-    failure = (False, index, None)
+            metadata = tokens[index].metadata
 
-    if tokens[index].match == 'if':
-        index += 1
-    else:
-        return failure
+            success, index, arguments = yield arguments_parser(index, tokens)
 
-    success, index, condition_expression = _or_level_expression_parser(index, tokens)
+        return True, index, function
 
-    if not success:
-        raise Exception('Expected condition after "if" on line {}'.format(tokens[index].line))
+    return result_parser
 
-    if tokens[index].match == 'do':
-        index += 1
-    else:
-        raise Exception('Expected "do" after "if" on line {}'.format(tokens[index].line))
+def _if_expression_parser(condition_parser, statement_list_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
+
+        if tokens[index].match == 'if':
+            index += 1
+        else:
+            return failure
 
+        success, index, condition_expression = yield condition_parser(index, tokens)
 
-    success, index, if_statement_list = _zero_or_more_parser(tuple, _statement_parser)(index, tokens)
-    _, index, _ = consume_newlines(index, tokens)
+        if not success:
+            raise Exception('Expected condition after "if" on line {}'.format(tokens[index].metadata.line))
 
-    if tokens[index].match == 'else':
-        index += 1
-        success, index, else_statement_list = _zero_or_more_parser(tuple, _statement_parser)(index, tokens)
+        if tokens[index].match == 'do':
+            index += 1
+        else:
+            raise Exception('Expected "do" after "if" on line {}'.format(tokens[index].metadata.line))
+
+
+        success, index, if_statement_list = yield statement_list_parser(index, tokens)
         _, index, _ = consume_newlines(index, tokens)
-    else:
-        else_statement_list = ()
 
-    if tokens[index].match == 'end':
-        index += 1
-    else:
-        raise Exception('Expected "end" after "if" on line {}'.format(tokens[index].line))
-
-    return (
-        True,
-        index,
-        FurIfExpression(
-            condition_expression=condition_expression,
-            if_statement_list=if_statement_list,
-            else_statement_list=else_statement_list,
-        ),
-    )
-
-_expression_parser = _or_parser(
-    _or_level_expression_parser,
-    _if_expression_parser, # This should always be at the top level
-)
+        if tokens[index].match == 'else':
+            index += 1
+            success, index, else_statement_list = yield statement_list_parser(index, tokens)
+            _, index, _ = consume_newlines(index, tokens)
+        else:
+            else_statement_list = ()
 
-def _expression_statement_parser(index, tokens):
-    failure = (False, index, None)
+        if tokens[index].match == 'end':
+            index += 1
+        else:
+            raise Exception('Expected "end" after "if" on line {}'.format(tokens[index].metadata.line))
 
-    success, index, expression = _expression_parser(index, tokens)
+        return (
+            True,
+            index,
+            FurIfExpression(
+                condition_expression=condition_expression,
+                if_statement_list=if_statement_list,
+                else_statement_list=else_statement_list,
+            ),
+        )
 
-    if not success:
-        return failure
+    return result_parser
+
+def _expression_statement_parser(expression_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
+
+        success, index, expression = yield expression_parser(index, tokens)
+
+        if not success:
+            return failure
+
+        return (True, index, FurExpressionStatement(expression=expression))
 
-    return (True, index, FurExpressionStatement(expression=expression))
+    return result_parser
 
 BUILTINS = {'print', 'pow'}
 
-def _assignment_statement_parser(index, tokens):
-    failure = (False, index, None)
+def _assignment_statement_parser(expression_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
 
-    if tokens[index].type == 'symbol':
-        target = tokens[index].match
-        target_assignment_line = tokens[index].metadata.line
+        if tokens[index].type == 'symbol':
+            target = tokens[index].match
+            target_assignment_line = tokens[index].metadata.line
 
-        index += 1
-    else:
-        return failure
+            index += 1
+        else:
+            return failure
+
+
+        if tokens[index].type == 'assignment_operator':
+            if target in BUILTINS:
+                raise Exception(
+                    'Trying to assign to builtin "{}" on line {}'.format(target, target_assignment_line),
+                )
+            assignment_operator_index = index
+        else:
+            return failure
 
+        success, index, expression = yield expression_parser(index + 1, tokens)
 
-    if tokens[index].type == 'assignment_operator':
-        if target in BUILTINS:
+        if not success:
             raise Exception(
-                'Trying to assign to builtin "{}" on line {}'.format(target, target_assignment_line),
+                'Expected expression after assignment operator on line {}'.format(
+                    tokens[assignment_operator_index].metadata.line
+                )
             )
-        assignment_operator_index = index
-    else:
-        return failure
 
-    success, index, expression = _expression_parser(index + 1, tokens)
+        return True, index, FurAssignmentStatement(target=target, expression=expression)
 
-    if not success:
-        raise Exception(
-            'Expected expression after assignment operator on line {}'.format(
-                tokens[assignment_operator_index].line
-            )
+    return result_parser
+
+def _function_definition_statement_parser(argument_name_list_parser, statement_list_parser):
+    def result_parser(index, tokens):
+        failure = (False, index, None)
+
+        if tokens[index].type == 'keyword' and tokens[index].match == 'def':
+            index += 1
+        else:
+            return failure
+
+        if tokens[index].type == 'symbol':
+            name = tokens[index].match
+            index += 1
+        else:
+            raise Exception('Expected function name, found "{}" on line {}'.format(
+                tokens[index].match,
+                tokens[index].metadata.line,
+            ))
+
+        if tokens[index].type == 'open_parenthese':
+            index += 1
+        else:
+            raise Exception('Expected "(", found "{}" on line {}'.format(
+                tokens[index].match,
+                tokens[index].metadata.line,
+            ))
+
+        success, index, argument_name_list = yield argument_name_list_parser(index, tokens)
+
+        if tokens[index].type == 'close_parenthese':
+            index += 1
+        else:
+            raise Exception('Expected ")", found "{}" on line {}'.format(
+                tokens[index].match,
+                tokens[index].metadata.line,
+            ))
+
+        if tokens[index].match == 'do':
+            index += 1
+        else:
+            return failure
+
+        success, index, statement_list = yield statement_list_parser(index, tokens)
+
+        _, index, _ = consume_newlines(index, tokens)
+
+        if tokens[index].type == 'keyword' and tokens[index].match == 'end':
+            index += 1
+        else:
+            return failure
+
+        return True, index, FurFunctionDefinitionStatement(
+            name=name,
+            argument_name_list=tuple(an.symbol for an in argument_name_list),
+            statement_list=statement_list,
         )
 
-    return True, index, FurAssignmentStatement(target=target, expression=expression)
+    return result_parser
 
-def _function_definition_statement_parser(index, tokens):
-    failure = (False, index, None)
+def _statement_parser(alternatives_parser):
+    def result_parser(index, tokens):
+        _, index, _ = consume_newlines(index, tokens)
 
-    if tokens[index].type == 'keyword' and tokens[index].match == 'def':
-        index += 1
-    else:
-        return failure
+        if not _has_token(index, tokens):
+            return (False, index, None)
 
-    if tokens[index].type == 'symbol':
-        name = tokens[index].match
-        index += 1
-    else:
-        raise Exception('Expected function name, found "{}" on line {}'.format(
-            tokens[index].match,
-            tokens[index].line,
-        ))
+        return alternatives_parser(index, tokens)
 
-    if tokens[index].type == 'open_parenthese':
-        index += 1
-    else:
-        raise Exception('Expected "(", found "{}" on line {}'.format(
-            tokens[index].match,
-            tokens[index].line,
-        ))
+    return result_parser
 
-    success, index, argument_name_list = _comma_separated_list_parser(_symbol_expression_parser)(
-        index,
-        tokens,
-    )
+def _program_parser(statement_parser):
+    def result_parser(index, tokens):
+        statement_list = []
 
-    if tokens[index].type == 'close_parenthese':
-        index += 1
-    else:
-        raise Exception('Expected ")", found "{}" on line {}'.format(
-            tokens[index].match,
-            tokens[index].line,
-        ))
+        while _has_token(index, tokens):
+            success, index, statement = yield statement_parser(index, tokens)
 
-    if tokens[index].match == 'do':
-        index += 1
-    else:
-        return failure
+            if not success:
+                break
 
-    success, index, statement_list = _zero_or_more_parser(tuple, _statement_parser)(index, tokens)
+            statement_list.append(statement)
 
-    _, index, _ = consume_newlines(index, tokens)
+            if isinstance(tokens, TokenWindow):
+                tokens.release(index)
 
-    if tokens[index].type == 'keyword' and tokens[index].match == 'end':
-        index += 1
-    else:
-        return failure
+        return True, index, FurProgram(statement_list=statement_list)
 
-    return True, index, FurFunctionDefinitionStatement(
-        name=name,
-        argument_name_list=tuple(an.symbol for an in argument_name_list),
-        statement_list=statement_list,
-    )
+    return result_parser
 
-def _statement_parser(index, tokens):
-    _, index, _ = consume_newlines(index, tokens)
+# The rules are built once here and shared by every parse, rather than being
+# rebuilt each time a rule is tried
+class Grammar(object):
+    def __init__(self):
+        expression = _deferred_parser(self, 'expression')
+        statement = _deferred_parser(self, 'statement')
+
+        argument_name_list = _comma_separated_list_parser(_symbol_expression_parser)
+        comma_separated_expression_list = _comma_separated_list_parser(expression)
+        statement_list = _zero_or_more_parser(tuple, statement)
+
+        # Three of the alternatives for a literal level expression starting
+        # with a parenthese start with a parenthesized expression, so without
+        # the memo each level of parentheses would triple the work. No other
+        # rule is parsed again at the same place, so nothing else is memoized.
+        self.parenthesized_expression = _memoized_parser('parenthesized_expression')(
+            _parenthese_wrapped_parser(expression),
+        )
 
-    if index == len(tokens):
-        return (False, index, None)
+        postfix_operand = _or_parser(
+            _symbol_expression_parser,
+            self.parenthesized_expression,
+        )
 
-    return _or_parser(
-        _assignment_statement_parser,
-        _expression_statement_parser,
-        _function_definition_statement_parser,
-    )(index, tokens)
+        index_suffix = _bracket_wrapped_parser(expression)
+        arguments_suffix = _parenthese_wrapped_parser(comma_separated_expression_list)
 
-def _program_formatter(statement_list):
-    return FurProgram(statement_list=statement_list)
+        self.list_item_expression = _postfix_guard_parser(
+            postfix_operand,
+            index_suffix,
+            _list_item_expression_parser(postfix_operand, index_suffix),
+        )
+        self.function_call_expression = _postfix_guard_parser(
+            postfix_operand,
+            arguments_suffix,
+            _function_call_expression_parser(postfix_operand, arguments_suffix),
+        )
+        self.list_literal_expression = _list_literal_expression_parser(
+            _bracket_wrapped_parser(comma_separated_expression_list),
+        )
+        self.lambda_expression = _first_token_parser(
+            'keyword',
+            'lambda',
+            _lambda_expression_parser(argument_name_list, statement_list),
+        )
+        self.structure_literal = _structure_literal_parser(
+            _parenthese_wrapped_parser(_comma_separated_list_parser(symbol_expression_pair_parser(expression))),
+        )
+
+        # Each entry keeps the order the alternatives had when they were all
+        # tried in turn
+        self.literal_level_expression = _token_type_dispatch_parser({
+            'symbol': _or_parser(
+                self.list_item_expression,
+                self.function_call_expression,
+                _symbol_expression_parser,
+            ),
+            'open_parenthese': _or_parser(
+                self.list_item_expression,
+                self.function_call_expression,
+                self.parenthesized_expression,
+                self.structure_literal,
+            ),
+            'integer_literal': _integer_literal_expression_parser,
+            'single_quoted_string_literal': _string_literal_expression_parser,
+            'double_quoted_string_literal': _string_literal_expression_parser,
+            'open_bracket': self.list_literal_expression,
+            'keyword': self.lambda_expression,
+        })
+
+        self.dot_expression = _left_recursive_infix_operator_parser(
+            lambda token: token.type == 'period',
+            self.literal_level_expression,
+            'dot_level',
+        )
+        self.negation_level_expression = _or_parser(
+            self.dot_expression,
+            _first_token_parser(
+                'addition_level_operator',
+                '-',
+                _negation_expression_parser(self.dot_expression),
+            ),
+        )
 
-_program_parser = _zero_or_more_parser(_program_formatter, _statement_parser)
+        self.infix_expression = _infix_expression_parser(self.negation_level_expression)
+
+        self.if_expression = _first_token_parser(
+            'keyword',
+            'if',
+            _if_expression_parser(self.infix_expression, statement_list),
+        )
+
+        self.expression = _or_parser(
+            self.infix_expression,
+            self.if_expression, # This should always be at the top level
+        )
+
+        self.statement = _statement_parser(_or_parser(
+            _assignment_statement_parser(self.expression),
+            _expression_statement_parser(self.expression),
+            _first_token_parser(
+                'keyword',
+                'def',
+                _function_definition_statement_parser(argument_name_list, statement_list),
+            ),
+        ))
+
+        self.program = _program_parser(self.statement)
+
+GRAMMAR = Grammar()
 
 def _parse(parser, tokens):
-    success, index, result = parser(0, tokens)
+    success, index, result = util.trampoline(parser(0, tokens))
 
-    if index < len(tokens):
+    if _has_token(index, tokens):
         raise Exception('Unable to parse token {}'.format(tokens[index]))
 
     if success:
@@ -733,10 +1092,21 @@ def _parse(parser, tokens):
 
     raise Exception('Unable to parse')
 
-def parse(tokens):
-    return _parse(_program_parser, tokens)
+def parse(tokens, memo=None):
+    if not isinstance(tokens, collections.abc.Sequence):
+        tokens = TokenWindow(tokens, memo=memo)
+    elif memo is not None:
+        tokens = _MemoizedTokens(tokens, memo)
+
+    return _parse(GRAMMAR.program, tokens)
+
+# How the compiler parses. Without a memo, each level of nested parentheses
+# multiplies the work of parsing what's inside them.
+def parse_memoized(tokens):
+    return parse(tokens, PackratMemo())
 
 if __name__ == '__main__':
+    import io
     import unittest
 
     import tokenization
@@ -755,15 +1125,92 @@ if __name__ == '__main__':
     class FurFunctionCallExpressionParserTests(unittest.TestCase):
         def test_parses_function_with_string_literal_argument(self):
             self.assertEqual(
-                _function_call_expression_parser(0, tokenization.tokenize("print('Hello, world')")),
+                util.trampoline(GRAMMAR.function_call_expression(
+                    0,
+                    tokenization.tokenize("print('Hello, world')"),
+                )),
                 (
                     True,
                     4,
                     FurFunctionCallExpression(
-                        name='print',
+                        metadata=tokenization.NodeMetadata(index=5, line=1),
+                        function=FurSymbolExpression(
+                            metadata=tokenization.NodeMetadata(index=0, line=1),
+                            symbol='print',
+                        ),
                         arguments=(FurStringLiteralExpression(string='Hello, world'),),
                     ),
                 ),
             )
 
+    class ParseTests(unittest.TestCase):
+        source = 'x = 1\ndef f() do\n  x + 2\nend\nprint(f())\n'
+
+        def test_parses_token_streams_like_token_tuples(self):
+            self.assertEqual(
+                parse(tokenization.tokenize_stream(io.StringIO(self.source))),
+                parse(tokenization.tokenize(self.source)),
+            )
+
+        def test_releases_tokens_of_parsed_statements(self):
+            window = TokenWindow(tokenization.tokenize(self.source))
+            util.trampoline(GRAMMAR.program(0, window))
+
+            with self.assertRaises(Exception):
+                window[0]
+
+        def test_parses_deeply_nested_expressions(self):
+            depth = 10000
+            program = parse(tokenization.tokenize('(' * depth + 'x' + ')' * depth + '\n'), memo=PackratMemo())
+
+            self.assertEqual(
+                program.statement_list[0].expression,
+                FurSymbolExpression(metadata=tokenization.NodeMetadata(index=depth, line=1), symbol='x'),
+            )
+
+    class InfixExpressionParserTests(unittest.TestCase):
+        def test_parses_by_precedence_and_left_associativity(self):
+            success, index, expression = util.trampoline(GRAMMAR.infix_expression(
+                0,
+                tokenization.tokenize('a - b * c - d < e and f'),
+            ))
+
+            def shape(expression):
+                if isinstance(expression, FurInfixExpression):
+                    return (expression.order, expression.operator, shape(expression.left), shape(expression.right))
+                return expression.symbol
+
+            self.assertEqual(
+                shape(expression),
+                ('and_level', 'and',
+                    ('comparison_level', '<',
+                        ('addition_level', '-',
+                            ('addition_level', '-', 'a', ('multiplication_level', '*', 'b', 'c')),
+                            'd'),
+                        'e'),
+                    'f'),
+            )
+
+    class PackratMemoTests(unittest.TestCase):
+        source = 'print(((((((1 + 2)))))))\n'
+
+        def test_parses_the_same_with_memoization(self):
+            self.assertEqual(
+                parse(tokenization.tokenize(self.source), memo=PackratMemo()),
+                parse(tokenization.tokenize(self.source)),
+            )
+
+        def test_counts_hits_and_misses(self):
+            memo = PackratMemo()
+            parse(tokenization.tokenize(self.source), memo=memo)
+
+            self.assertGreater(memo.hits, 0)
+            self.assertGreater(memo.misses, 0)
+
+        def test_bounds_memo_table(self):
+            memo = PackratMemo(max_entries=4)
+            parse(tokenization.tokenize(self.source), memo=memo)
+
+            self.assertGreater(memo.evictions, 0)
+
     unittest.main()
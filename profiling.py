@@ -0,0 +1,272 @@
+import cProfile
+import collections
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import c_generation
+import conversion
+import crossplatform_ir_generation
+import desugaring
+import lowering
+import normalization
+import optimization
+import parsing
+import tokenization
+
+# Runs the compiler one pass at a time and records what each pass costs.
+#
+# Each pass is run once to time it, and again under tracemalloc to find its
+# peak memory, because tracing slows everything down too much to time it at
+# the same time. Given a directory, each pass is run a third time under
+# cProfile, and the stats are dumped to <directory>/<pass>.prof.
+#
+# tracemalloc is global to the process, so when compile_server.py profiles
+# requests on several threads, one pass stopping it would cut short the
+# tracing of another. Passes are profiled one at a time under
+# _PROFILE_LOCK, which also keeps them from adding to each other's peaks.
+
+PASSES = (
+    ('tokenize', tokenization.tokenize),
+    ('parse', parsing.parse_memoized),
+    ('lower', lowering.lower),
+    ('generate', crossplatform_ir_generation.generate),
+    ('optimize', optimization.optimize),
+    ('c', c_generation.generate),
+)
+
+# The passes lowering.lower does in one traversal, as they ran before it.
+# The compiler doesn't run these, but profile_source profiles them on the
+# parsed program too, after the passes it does run, to show which of them
+# lowering spends its time on.
+UNFUSED_LOWERING_PASSES = (
+    ('desugar', desugaring.desugar),
+    ('normalize', normalization.normalize),
+    ('convert', conversion.convert),
+)
+
+_PROFILE_LOCK = threading.Lock()
+
+PassProfile = collections.namedtuple(
+    'PassProfile',
+    (
+        'name',
+        'wall_seconds',
+        'cpu_seconds',
+        'peak_bytes',
+        'input_count',
+        'input_unit',
+        'output_count',
+        'output_unit',
+    ),
+)
+
+def _count_nodes(tree):
+    count = 0
+    stack = [tree]
+
+    while stack:
+        value = stack.pop()
+
+        if isinstance(value, (tuple, list)):
+            stack.extend(value)
+        elif hasattr(value, '_fields'):
+            count += 1
+            stack.extend(getattr(value, field) for field in value._fields if field != 'metadata')
+
+    return count
+
+# Returns how big what goes into or comes out of a pass is, and in what
+def count(value):
+    if isinstance(value, str):
+        return value.count('\n'), 'lines'
+
+    if isinstance(value, crossplatform_ir_generation.CIRProgram):
+        return len(value.opcodes), 'instructions'
+
+    if isinstance(value, tuple) and value and isinstance(value[0], tokenization.Token):
+        return len(value), 'tokens'
+
+    return _count_nodes(value), 'nodes'
+
+def profile_pass(name, function, value, profile_directory=None):
+    with _PROFILE_LOCK:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = function(value)
+        cpu_seconds = time.process_time() - cpu_start
+        wall_seconds = time.perf_counter() - wall_start
+
+        tracemalloc.start()
+
+        try:
+            function(value)
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        if profile_directory is not None:
+            profiler = cProfile.Profile()
+            profiler.runcall(function, value)
+            profiler.dump_stats(os.path.join(profile_directory, '{}.prof'.format(name)))
+
+    input_count, input_unit = count(value)
+    output_count, output_unit = count(result)
+
+    return result, PassProfile(
+        name=name,
+        wall_seconds=wall_seconds,
+        cpu_seconds=cpu_seconds,
+        peak_bytes=peak_bytes,
+        input_count=input_count,
+        input_unit=input_unit,
+        output_count=output_count,
+        output_unit=output_unit,
+    )
+
+# Runs the passes in order, each on what the one before returned, and
+# returns what the last returned and the profile of each
+def profile_passes(value, passes=PASSES, profile_directory=None):
+    if profile_directory is not None:
+        os.makedirs(profile_directory, exist_ok=True)
+
+    profiles = []
+
+    for name, function in passes:
+        value, profile = profile_pass(name, function, value, profile_directory)
+        profiles.append(profile)
+
+    return value, profiles
+
+# Compiles source as compilation.compile_source does, returning the listing,
+# the C and the profile of each pass, followed by the unfused lowering passes
+def profile_source(source, profile_directory=None):
+    parsed, profiles = profile_passes(source, PASSES[:2], profile_directory)
+    optimized, cir_profiles = profile_passes(parsed, PASSES[2:-1], profile_directory)
+    listing = crossplatform_ir_generation.output(optimized)
+    generated, c_profiles = profile_passes(optimized, PASSES[-1:], profile_directory)
+    _, unfused_profiles = profile_passes(parsed, UNFUSED_LOWERING_PASSES, profile_directory)
+    return listing, generated, profiles + cir_profiles + c_profiles + unfused_profiles
+
+def _format_row(profile):
+    return '{:>10} {:>10.2f} {:>10.2f} {:>10} {:>20} {:>20}'.format(
+        profile.name,
+        profile.wall_seconds * 1000,
+        profile.cpu_seconds * 1000,
+        profile.peak_bytes // 1024,
+        '{} {}'.format(profile.input_count, profile.input_unit),
+        '{} {}'.format(profile.output_count, profile.output_unit),
+    )
+
+def format_table(profiles):
+    lines = ['{:>10} {:>10} {:>10} {:>10} {:>20} {:>20}'.format(
+        'pass', 'wall ms', 'cpu ms', 'peak KB', 'input', 'output',
+    )]
+
+    # The unfused passes repeat the work of lower, so they come after the
+    # total rather than counting towards it
+    pass_names = set(name for name, _ in PASSES)
+    compiler_profiles = [profile for profile in profiles if profile.name in pass_names]
+
+    lines.extend(_format_row(profile) for profile in compiler_profiles)
+
+    lines.append('{:>10} {:>10.2f} {:>10.2f}'.format(
+        'total',
+        sum(profile.wall_seconds for profile in compiler_profiles) * 1000,
+        sum(profile.cpu_seconds for profile in compiler_profiles) * 1000,
+    ))
+
+    lines.extend(_format_row(profile) for profile in profiles if profile.name not in pass_names)
+
+    return '\n'.join(lines)
+
+def format_json(profiles):
+    return json.dumps([profile._asdict() for profile in profiles], indent=2)
+
+FORMATTERS = {
+    'json': format_json,
+    'table': format_table,
+}
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import unittest
+
+    import compilation
+
+    class ProfilePassesTests(unittest.TestCase):
+        source = 'def add_one(x) do\n  x + 1\nend\nprint(add_one(1))\n'
+
+        def test_profiles_each_pass(self):
+            program, profiles = profile_passes(self.source, PASSES[:-1])
+
+            self.assertEqual([profile.name for profile in profiles], [name for name, _ in PASSES[:-1]])
+            self.assertEqual(profiles[0].output_count, len(tokenization.tokenize(self.source)))
+            self.assertEqual(profiles[0].output_unit, 'tokens')
+            self.assertEqual(profiles[-1].output_count, len(program.opcodes))
+            self.assertEqual(profiles[-1].output_unit, 'instructions')
+
+            for profile in profiles:
+                self.assertGreater(profile.peak_bytes, 0)
+
+        def test_compiles_as_the_compiler_does(self):
+            listing, generated, profiles = profile_source(self.source)
+
+            self.assertEqual((listing, generated), compilation.compile_source(self.source))
+            self.assertEqual(
+                [profile.name for profile in profiles],
+                [name for name, _ in PASSES + UNFUSED_LOWERING_PASSES],
+            )
+            self.assertEqual(profiles[len(PASSES) - 1].output_unit, 'lines')
+
+        def test_profiles_lowering_as_the_compiler_runs_it(self):
+            parsed = parsing.parse(tokenization.tokenize(self.source))
+            lowered, profiles = profile_passes(parsed, PASSES[2:3])
+            unfused, unfused_profiles = profile_passes(parsed, UNFUSED_LOWERING_PASSES)
+
+            self.assertEqual([profile.name for profile in profiles], ['lower'])
+            self.assertEqual(lowered, unfused)
+
+            table = format_table(profiles + unfused_profiles).splitlines()
+
+            self.assertEqual(
+                [line.split()[0] for line in table],
+                ['pass', 'lower', 'total', 'desugar', 'normalize', 'convert'],
+            )
+            self.assertEqual(table[2].split()[1], '{:.2f}'.format(profiles[0].wall_seconds * 1000))
+
+        def test_profiles_on_several_threads_at_once(self):
+            results = []
+
+            def profile():
+                results.append(profile_passes(self.source, PASSES[:-1])[1])
+
+            threads = [threading.Thread(target=profile) for _ in range(4)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(results), len(threads))
+
+            for profiles in results:
+                for profile in profiles:
+                    self.assertGreater(profile.peak_bytes, 0)
+
+        def test_dumps_a_cprofile_for_each_pass(self):
+            directory = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, directory)
+
+            profile_passes(self.source, PASSES[:2], directory)
+
+            self.assertEqual(sorted(os.listdir(directory)), ['parse.prof', 'tokenize.prof'])
+
+        def test_counts_nodes_without_metadata(self):
+            self.assertEqual(count(parsing.parse(tokenization.tokenize('f(1)\n'))), (5, 'nodes'))
+
+    unittest.main()
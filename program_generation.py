@@ -0,0 +1,142 @@
+# Generates Fur programs of a given size and shape, so that passes can be
+# benchmarked on programs much bigger than the examples. Each shape takes a
+# size and returns the source of a program which compiles; the size is the
+# number of functions, nesting levels, operators or items, so the source grows
+# about linearly with it.
+#
+# Values the shapes branch on or compute with are returned by a function,
+# rather than written as literals, so that constant folding can't reduce the
+# program to its result before the later stages see it.
+
+# Symbols can't have digits in them, so indices are spelled with letters
+def symbol_name(index):
+    return ''.join(chr(ord('a') + int(digit)) for digit in str(index))
+
+def functions(count, edited=None):
+    # Each function's body depends only on its index, and on whether it is
+    # the edited one, so that changing edited changes exactly one function
+    sources = []
+
+    for index in range(count):
+        sources.append(
+            'def function_{name}(x) do\n'
+            '  def inner(y) do\n'
+            '    y + {constant}\n'
+            '  end\n'
+            '  if x < {index} do\n'
+            '    inner(x)\n'
+            '  else\n'
+            '    -inner(x * 2)\n'
+            '  end\n'
+            'end\n'.format(name=symbol_name(index), index=index, constant=2 if index == edited else 1)
+        )
+
+    # Every function is called, so that none is removed as unreferenced
+    return ''.join(sources) + ''.join(
+        'print(function_{}(1))\n'.format(symbol_name(index))
+        for index in range(count)
+    )
+
+def nesting(depth):
+    return (
+        'def get_depth() do\n  {}\nend\n'.format(depth)
+        + 'depth = get_depth()\n'
+        + 'x = '
+        + ''.join('if {} < depth do\n'.format(level) for level in range(depth))
+        + 'print(1)\n'
+        + 'else\n  print(2)\nend\n' * depth
+    )
+
+OPERATORS = ('+', '*', '-', '//', '%', '+')
+
+# Operators which bind tighter than + and - take one as their right hand
+# side, so that no two literals are ever operands of the same operator
+_MULTIPLICATION_LEVEL_OPERATORS = set(('*', '//', '%'))
+
+def operators(count):
+    # Right hand sides are never 0, so nothing divides by zero
+    return 'def get_one() do\n  1\nend\none = get_one()\nx = one{}\nprint(x < 1 or x >= 2 and x != 3)\n'.format(''.join(
+        ' {} {}'.format(
+            OPERATORS[index % len(OPERATORS)],
+            'one' if OPERATORS[index % len(OPERATORS)] in _MULTIPLICATION_LEVEL_OPERATORS else index % 9 + 1,
+        )
+        for index in range(count)
+    ))
+
+# CIR generation can't index lists yet, so the list is only built
+def lists(count):
+    return 'x = [\n{}]\n'.format(''.join(
+        "  {},\n".format(index) if index % 2 else "  '{}',\n".format(symbol_name(index))
+        for index in range(count)
+    ))
+
+def structures(count):
+    return 'x = (\n{})\nprint(x.field_a)\n'.format(''.join(
+        '  field_{}: {},\n'.format(symbol_name(index), index)
+        for index in range(count)
+    ))
+
+def closures(count):
+    sources = []
+
+    for index in range(count):
+        sources.append(
+            'def make_{name}(start) do\n'
+            '  total = start + {index}\n'
+            '  def get() do\n'
+            '    total\n'
+            '  end\n'
+            '  get\n'
+            'end\n'
+            'get_{name} = make_{name}({index})\n'
+            'print(get_{name}())\n'.format(name=symbol_name(index), index=index)
+        )
+
+    return ''.join(sources)
+
+SHAPES = {
+    'closures': closures,
+    'functions': functions,
+    'lists': lists,
+    'nesting': nesting,
+    'operators': operators,
+    'structures': structures,
+}
+
+if __name__ == '__main__':
+    import unittest
+
+    import compilation
+    import crossplatform_ir_generation
+    import lowering
+    import parsing
+    import tokenization
+
+    class ShapeTests(unittest.TestCase):
+        def test_shapes_generate_cir(self):
+            for name, shape in sorted(SHAPES.items()):
+                with self.subTest(shape=name):
+                    program = crossplatform_ir_generation.generate(
+                        lowering.lower(parsing.parse(tokenization.tokenize(shape(20)))),
+                    )
+                    self.assertGreater(len(program.opcodes), 20)
+
+        def test_shapes_generate_c(self):
+            # C generation can't generate list and structure instructions yet
+            for name in sorted(set(SHAPES) - set(('lists', 'structures'))):
+                with self.subTest(shape=name):
+                    _, generated = compilation.compile_source(SHAPES[name](20))
+                    self.assertIn('int main(', generated)
+
+        def test_edits_one_function(self):
+            source = functions(20).split('\n')
+            edited = functions(20, edited=7).split('\n')
+
+            self.assertEqual(len(source), len(edited))
+            self.assertEqual(sum(line != edited_line for line, edited_line in zip(source, edited)), 1)
+
+        def test_spells_indices_with_letters(self):
+            self.assertEqual(symbol_name(0), 'a')
+            self.assertEqual(symbol_name(109), 'baj')
+
+    unittest.main()
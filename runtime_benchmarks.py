@@ -0,0 +1,282 @@
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import c_generation
+import program_generation
+
+# Usage:
+#     python runtime_benchmarks.py                          runs every workload
+#     python runtime_benchmarks.py calls closures           runs some workloads
+#     python runtime_benchmarks.py examples/04_math.fur     also runs any .fur file
+#     python runtime_benchmarks.py --json=results.json      saves the results
+#     python runtime_benchmarks.py --compare=results.json   compares with saved results
+#
+# Measures how fast compiled Fur programs run, rather than how fast they
+# compile. Each workload is compiled through main.py, without the cache, and
+# then by gcc at each of OPTIMIZATION_LEVELS, and the executable is run
+# REPEATS times. The report gives the median wall and CPU time, the largest
+# max RSS, and the instructions executed, which perf counts if it is
+# installed.
+#
+# Results name the runtime template the programs were built on, so results
+# saved with --json on one runtime can be compared with --compare on
+# another. A workload which doesn't compile, crashes, or prints the wrong
+# output is reported as failed at that stage rather than timed.
+
+# Go to the directory of the current file so we know where we are in the filesystem
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+OPTIMIZATION_LEVELS = ('-O0', '-O2')
+REPEATS = 5
+TIMEOUT = 60
+
+# The runtime can't yet call a closure with arguments, or one which reads a
+# variable of the function that made it, and C generation can't generate
+# strings being joined, lists or structures. Fur has no loops either, so each
+# workload repeats its work through a chain of functions without arguments,
+# each of which calls the next more than once: the last is run 2 ** depth
+# times, or 3 ** depth times for the branches.
+def _chain(depth, last_body, body='{next}() + {next}()'):
+    sources = [
+        'def level_{}() do\n  {}\nend\n'.format(
+            program_generation.symbol_name(index),
+            body.format(next='level_' + program_generation.symbol_name(index + 1)),
+        )
+        for index in range(depth)
+    ]
+    sources.append('def level_{}() do\n  {}\nend\n'.format(program_generation.symbol_name(depth), last_body))
+
+    return '\n'.join(sources) + "\nprint(level_a(), '\\n')\n"
+
+# Each workload is the source of a program and what it should print
+WORKLOADS = {
+    # Calls of functions which are defined once
+    'calls': (
+        _chain(20, '1'),
+        '{}\n'.format(2 ** 20),
+    ),
+    # Calls of a closure which is made again before each call
+    'closures': (
+        'def make_one() do\n'
+        '  def one() do\n'
+        '    1\n'
+        '  end\n'
+        '\n'
+        '  one\n'
+        'end\n'
+        '\n' + _chain(18, 'make_one()()'),
+        '{}\n'.format(2 ** 18),
+    ),
+    # Comparisons and the jumps they choose between
+    'branches': (
+        _chain(12, '1', 'if {next}() < 1 do\n    0\n  else\n    {next}() + {next}()\n  end'),
+        '{}\n'.format(2 ** 12),
+    ),
+}
+
+class WorkloadFailed(Exception):
+    pass
+
+def _check_call(stage, arguments):
+    # stdin is closed so that nothing the compiler or a program runs waits
+    # for input
+    completed = subprocess.run(
+        arguments,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=TIMEOUT,
+    )
+
+    if completed.returncode != 0:
+        lines = completed.stderr.decode('utf-8', 'replace').strip().splitlines()
+        raise WorkloadFailed('{} exited with {}: {}'.format(
+            stage,
+            completed.returncode,
+            lines[-1] if lines else '',
+        ))
+
+def compile_workload(source_path, executable_path, optimization_level):
+    _check_call('main.py', [sys.executable, 'main.py', source_path, '--no-cache'])
+    _check_call('gcc', ['gcc', optimization_level, '-o', executable_path, source_path + '.c'])
+
+# Runs the executable and returns its wall time, CPU time, max RSS in KB and
+# output
+def run_once(executable_path):
+    with tempfile.TemporaryFile() as stdout:
+        start = time.perf_counter()
+        process = subprocess.Popen([executable_path], stdin=subprocess.DEVNULL, stdout=stdout, stderr=subprocess.DEVNULL)
+        timer = threading.Timer(TIMEOUT, process.kill)
+        timer.start()
+
+        try:
+            # wait4 gives the resource usage of this child alone
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+        finally:
+            timer.cancel()
+
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        if elapsed >= TIMEOUT:
+            raise WorkloadFailed('run timed out after {}s'.format(TIMEOUT))
+
+        if process.returncode != 0:
+            raise WorkloadFailed('run exited with {}'.format(process.returncode))
+
+        stdout.seek(0)
+        output = stdout.read().decode('utf-8', 'replace')
+
+    return elapsed, usage.ru_utime + usage.ru_stime, usage.ru_maxrss, output
+
+def count_instructions(executable_path):
+    if shutil.which('perf') is None:
+        return None
+
+    with tempfile.NamedTemporaryFile('r') as counters:
+        subprocess.run(
+            ['perf', 'stat', '-x', ',', '-e', 'instructions:u', '-o', counters.name, executable_path],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=TIMEOUT,
+        )
+
+        for line in counters:
+            fields = line.split(',')
+
+            if len(fields) > 2 and fields[2].startswith('instructions') and fields[0].isdigit():
+                return int(fields[0])
+
+    return None
+
+def benchmark_workload(name, source_path, expected_output, optimization_level, directory):
+    result = {
+        'workload': name,
+        'optimization': optimization_level,
+        'status': 'ok',
+        'median_seconds': None,
+        'median_cpu_seconds': None,
+        'max_rss_kb': None,
+        'instructions': None,
+    }
+
+    executable_path = os.path.join(directory, '{}{}'.format(name, optimization_level))
+
+    try:
+        compile_workload(source_path, executable_path, optimization_level)
+        runs = [run_once(executable_path) for _ in range(REPEATS)]
+
+        for _, _, _, output in runs:
+            if expected_output is not None and output != expected_output:
+                raise WorkloadFailed('run printed {!r}, expected {!r}'.format(output[:40], expected_output[:40]))
+
+    except (WorkloadFailed, subprocess.TimeoutExpired) as e:
+        result['status'] = 'FAILED: {}'.format(e)
+        return result
+
+    result['median_seconds'] = statistics.median(elapsed for elapsed, _, _, _ in runs)
+    result['median_cpu_seconds'] = statistics.median(cpu for _, cpu, _, _ in runs)
+    result['max_rss_kb'] = max(max_rss for _, _, max_rss, _ in runs)
+    result['instructions'] = count_instructions(executable_path)
+    return result
+
+def gcc_version():
+    completed = subprocess.run(['gcc', '--version'], stdout=subprocess.PIPE, timeout=TIMEOUT)
+    return completed.stdout.decode('utf-8', 'replace').splitlines()[0]
+
+def format_optional(format_string, value):
+    return '-' if value is None else format_string.format(value)
+
+def print_results(results, compared):
+    print('{:>12} {:>5} {:>10} {:>10} {:>14} {:>10} {:>10}'.format(
+        'workload', 'opt', 'median s', 'cpu s', 'instructions', 'max RSS KB', 'compared',
+    ))
+
+    for result in results:
+        if result['status'] != 'ok':
+            print('{:>12} {:>5} {}'.format(result['workload'], result['optimization'], result['status']))
+            continue
+
+        previous = compared.get((result['workload'], result['optimization']))
+        ratio = None
+
+        if previous is not None and previous['status'] == 'ok':
+            ratio = result['median_seconds'] / previous['median_seconds']
+
+        print('{:>12} {:>5} {:>10.4f} {:>10.4f} {:>14} {:>10} {:>10}'.format(
+            result['workload'],
+            result['optimization'],
+            result['median_seconds'],
+            result['median_cpu_seconds'],
+            format_optional('{}', result['instructions']),
+            result['max_rss_kb'],
+            format_optional('{:.2f}x', ratio),
+        ))
+
+def main(arguments):
+    flags = [argument for argument in arguments if argument.startswith('--')]
+    names = [argument for argument in arguments if not argument.startswith('--')] or sorted(WORKLOADS)
+
+    json_path = None
+    compared = {}
+
+    for flag in flags:
+        if flag.startswith('--json='):
+            json_path = flag[len('--json='):]
+        elif flag.startswith('--compare='):
+            with open(flag[len('--compare='):], 'r') as f:
+                previous = json.load(f)
+
+            print('Compared with {} on {}'.format(previous['runtime'], previous['compiler']))
+            compared = {
+                (result['workload'], result['optimization']): result
+                for result in previous['results']
+            }
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            if name.endswith('.fur'):
+                source_path = os.path.join(directory, os.path.basename(name))
+                shutil.copyfile(name, source_path)
+                name = os.path.basename(name)[:-len('.fur')]
+                expected_output = None
+
+            elif name in WORKLOADS:
+                source_path = os.path.join(directory, name + '.fur')
+                source, expected_output = WORKLOADS[name]
+
+                with open(source_path, 'w') as f:
+                    f.write(source)
+
+            else:
+                raise Exception('Unknown workload "{}"'.format(name))
+
+            for optimization_level in OPTIMIZATION_LEVELS:
+                results.append(benchmark_workload(name, source_path, expected_output, optimization_level, directory))
+
+    print('Runtime {} on {}'.format(c_generation.TEMPLATE_NAME, gcc_version()))
+    print_results(results, compared)
+
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump({
+                'runtime': c_generation.TEMPLATE_NAME,
+                'compiler': gcc_version(),
+                'results': results,
+            }, f, indent=2)
+            f.write('\n')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
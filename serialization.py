@@ -0,0 +1,188 @@
+import array
+import mmap
+import os
+import struct
+import sys
+
+import crossplatform_ir_generation
+
+# A .furc file holds a CIR program in binary, so that it can be saved after
+# CIR generation and loaded again without running the front end. The layout,
+# with every integer little endian:
+#
+#     header       magic, version, and the instruction, symbol, string and
+#                  label counts (see HEADER)
+#     arguments    one signed 64 bit integer per instruction
+#     opcodes      one unsigned 16 bit integer per instruction, padded to a
+#                  multiple of 8 bytes
+#     offsets      one unsigned 64 bit integer per symbol, string and label,
+#                  plus one at the end, giving where each starts in the text
+#     text         the symbols, then the strings, then the labels, in UTF-8
+#
+# Arguments come first so that both arrays are aligned for their item size.
+# Reading maps the file and returns memoryviews over the two arrays, so
+# nothing is copied however many instructions there are; the tables are
+# small, so they're decoded into tuples.
+
+MAGIC = b'FURC'
+
+# Opcodes are saved by number, so the version changes whenever OPCODES does
+VERSION = 3
+
+HEADER = struct.Struct('<4sHHQQQQ')
+
+def _padding(size):
+    return -size % 8
+
+def _little_endian(items):
+    if sys.byteorder == 'little':
+        return items
+
+    items = array.array(items.typecode, items)
+    items.byteswap()
+    return items
+
+def write(program, path):
+    # Tables are written in this order and read back in the same order
+    tables = (program.symbols, program.strings, program.labels)
+    encoded = [value.encode('utf-8') for table in tables for value in table]
+
+    offsets = array.array('Q', [0])
+
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+
+    opcodes = crossplatform_ir_generation.opcode_array(program.opcodes)
+    arguments = crossplatform_ir_generation.argument_array(program.arguments)
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC,
+            VERSION,
+            0,
+            len(opcodes),
+            len(program.symbols),
+            len(program.strings),
+            len(program.labels),
+        ))
+
+        f.write(_little_endian(arguments).tobytes())
+        f.write(_little_endian(opcodes).tobytes())
+        f.write(b'\0' * _padding(len(opcodes) * opcodes.itemsize))
+        f.write(_little_endian(offsets).tobytes())
+        f.write(b''.join(encoded))
+
+def read(path):
+    with open(path, 'rb') as f:
+        # An empty file can't be mapped, so this is checked first
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise Exception('File "{}" is too short to be a .furc file'.format(path))
+
+        # The map stays open as long as the memoryviews over it are alive
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, _, instruction_count, symbol_count, string_count, label_count = HEADER.unpack_from(mapped)
+
+    if magic != MAGIC:
+        raise Exception('File "{}" is not a .furc file'.format(path))
+
+    if version != VERSION:
+        raise Exception('File "{}" is .furc version {}, expected version {}'.format(path, version, VERSION))
+
+    view = memoryview(mapped)
+
+    arguments_start = HEADER.size
+    opcodes_start = arguments_start + 8 * instruction_count
+    offsets_start = opcodes_start + 2 * instruction_count + _padding(2 * instruction_count)
+    table_size = symbol_count + string_count + label_count
+    text_start = offsets_start + 8 * (table_size + 1)
+
+    if len(mapped) < text_start:
+        raise Exception('File "{}" is truncated'.format(path))
+
+    arguments = view[arguments_start:opcodes_start].cast('q')
+    opcodes = view[opcodes_start:opcodes_start + 2 * instruction_count].cast('H')
+    offsets = view[offsets_start:text_start].cast('Q')
+
+    if sys.byteorder != 'little':
+        arguments = _little_endian(array.array('q', arguments))
+        opcodes = _little_endian(array.array('H', opcodes))
+        offsets = _little_endian(array.array('Q', offsets))
+
+    if len(mapped) < text_start + offsets[-1]:
+        raise Exception('File "{}" is truncated'.format(path))
+
+    values = tuple(
+        mapped[text_start + offsets[i]:text_start + offsets[i + 1]].decode('utf-8')
+        for i in range(table_size)
+    )
+
+    return crossplatform_ir_generation.CIRProgram(
+        opcodes=opcodes,
+        arguments=arguments,
+        symbols=values[:symbol_count],
+        strings=values[symbol_count:symbol_count + string_count],
+        labels=values[symbol_count + string_count:],
+    )
+
+if __name__ == '__main__':
+    import tempfile
+    import unittest
+
+    import lowering
+    import optimization
+    import parsing
+    import tokenization
+
+    def generate_source(source):
+        return crossplatform_ir_generation.generate(lowering.lower(parsing.parse(tokenization.tokenize(source))))
+
+    class SerializationTests(unittest.TestCase):
+        source = "x = 'ä'\ndef f(a) do\n  if a < 2 do\n    x\n  else\n    -a\n  end\nend\nprint(f(1))\n"
+
+        def setUp(self):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.path = os.path.join(directory.name, 'program.furc')
+
+        def test_reads_back_the_program_it_wrote(self):
+            program = generate_source(self.source)
+            write(program, self.path)
+            self.assertEqual(read(self.path), program)
+
+        def test_optimizes_programs_that_were_read(self):
+            program = generate_source(self.source)
+            write(program, self.path)
+
+            self.assertEqual(
+                crossplatform_ir_generation.output(optimization.optimize(read(self.path))),
+                crossplatform_ir_generation.output(optimization.optimize(program)),
+            )
+
+        def test_reads_empty_programs(self):
+            program = crossplatform_ir_generation.CIRProgram(
+                opcodes=crossplatform_ir_generation.opcode_array(),
+                arguments=crossplatform_ir_generation.argument_array(),
+                symbols=(),
+                strings=(),
+                labels=(),
+            )
+
+            write(program, self.path)
+            self.assertEqual(read(self.path), program)
+
+        def test_raises_on_other_files(self):
+            with open(self.path, 'wb') as f:
+                f.write(b'\0' * HEADER.size)
+
+            with self.assertRaises(Exception):
+                read(self.path)
+
+            for contents in (b'', b'\0'):
+                with open(self.path, 'wb') as f:
+                    f.write(contents)
+
+                with self.assertRaisesRegex(Exception, 'too short'):
+                    read(self.path)
+
+    unittest.main()
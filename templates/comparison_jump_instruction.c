@@ -0,0 +1,14 @@
+void inst_{{ name }}_jump_if_false(struct Thread* thread, const union Argument argument) {
+  // Does what {{ name }} and jump_if_false would, without pushing the boolean
+  assert(!Stack_isEmpty(&(thread->stack)));
+  Object right = Stack_pop(&(thread->stack));
+  assert(right.type == INTEGER);
+
+  assert(!Stack_isEmpty(&(thread->stack)));
+  Object left = Stack_pop(&(thread->stack));
+  assert(left.type == INTEGER);
+
+  if(!(left.value.integer {{ operation }} right.value.integer)) {
+    Thread_setProgramCounter(thread, argument.label - 1); // We will increment before running
+  }
+}
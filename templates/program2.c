@@ -99,8 +99,42 @@ union Argument {
   void* pointer;
   char* string;
   int32_t integer;
+  struct {
+    char* symbol;
+    int32_t integer;
+  } symbolAndInteger;
 };
 
+// Returns what push pushes for the symbol, which call_symbol and the
+// *_symbol_integer instructions use without pushing it
+Object lookupSymbol(Thread* thread, char* symbol) {
+  if(strcmp(symbol, "false") == 0) {
+    return (Object){ BOOLEAN, false };
+  } else if(strcmp(symbol, "pow") == 0) {
+    Object result;
+    result.type = BUILTIN;
+    result.value.builtin = POW;
+    return result;
+  } else if(strcmp(symbol, "print") == 0) {
+    Object result;
+    result.type = BUILTIN;
+    result.value.builtin = PRINT;
+    return result;
+  } else if(strcmp(symbol, "true") == 0) {
+    return (Object){ BOOLEAN, true };
+  }
+
+  Environment_get_Result result = Environment_get(
+    Thread_getEnvironment(thread),
+    symbol
+  );
+  if(!result.found) {
+    fprintf(stderr, "Variable `%s` not found", symbol);
+    assert(false);
+  }
+  return result.result;
+}
+
 void callBuiltinPow(Thread* thread, size_t argumentCount) {
   assert(argumentCount == 2);
   assert(!Stack_isEmpty(&(thread->stack)));
@@ -187,11 +221,7 @@ void callClosure(Thread* thread, Closure closure, size_t argumentCount) {
   );
 }
 
-void inst_call(Thread* thread, Argument argument) {
-  assert(!Stack_isEmpty(&(thread->stack)));
-  Object f = Stack_pop(&(thread->stack));
-  size_t argumentCount = argument.label;
-
+void callObject(Thread* thread, Object f, size_t argumentCount) {
   switch(f.type) {
     case BUILTIN:
       callBuiltin(thread, f.value.builtin, argumentCount);
@@ -206,8 +236,20 @@ void inst_call(Thread* thread, Argument argument) {
   }
 }
 
+void inst_call(Thread* thread, Argument argument) {
+  assert(!Stack_isEmpty(&(thread->stack)));
+  Object f = Stack_pop(&(thread->stack));
+  callObject(thread, f, argument.label);
+}
+
+void inst_call_symbol(Thread* thread, Argument argument) {
+  Object f = lookupSymbol(thread, argument.symbolAndInteger.symbol);
+  callObject(thread, f, argument.symbolAndInteger.integer);
+}
+
 {% with name='add', operation='+' %}
   {% include "arithmetic_instruction.c" %}
+  {% include "symbol_integer_instruction.c" %}
 {% endwith %}
 
 void inst_close(Thread* thread, Argument argument) {
@@ -225,23 +267,32 @@ void inst_drop(Thread* thread, Argument argument) {
   Object_deinitialize(&result);
 }
 
+void inst_dup(Thread* thread, Argument argument) {
+  assert(!Stack_isEmpty(&(thread->stack)));
+  Stack_push(&(thread->stack), Stack_peek(&(thread->stack)));
+}
+
 void inst_end(Thread* thread, Argument argument) {
 }
 
 {% with name='eq', operation='==' %}
   {% include "comparison_instruction.c" %}
+  {% include "comparison_jump_instruction.c" %}
 {% endwith %}
 
 {% with name='gt', operation='>' %}
   {% include "comparison_instruction.c" %}
+  {% include "comparison_jump_instruction.c" %}
 {% endwith %}
 
 {% with name='gte', operation='>=' %}
   {% include "comparison_instruction.c" %}
+  {% include "comparison_jump_instruction.c" %}
 {% endwith %}
 
 {% with name='idiv', operation='/' %}
   {% include "arithmetic_instruction.c" %}
+  {% include "symbol_integer_instruction.c" %}
 {% endwith %}
 
 void inst_jump(Thread* thread, Argument argument) {
@@ -260,22 +311,27 @@ void inst_jump_if_false(Thread* thread, Argument argument) {
 
 {% with name='lt', operation='<' %}
   {% include "comparison_instruction.c" %}
+  {% include "comparison_jump_instruction.c" %}
 {% endwith %}
 
 {% with name='lte', operation='<=' %}
   {% include "comparison_instruction.c" %}
+  {% include "comparison_jump_instruction.c" %}
 {% endwith %}
 
 {% with name='mod', operation='%' %}
   {% include "arithmetic_instruction.c" %}
+  {% include "symbol_integer_instruction.c" %}
 {% endwith %}
 
 {% with name='mul', operation='*' %}
   {% include "arithmetic_instruction.c" %}
+  {% include "symbol_integer_instruction.c" %}
 {% endwith %}
 
 {% with name='neq', operation='!=' %}
   {% include "comparison_instruction.c" %}
+  {% include "comparison_jump_instruction.c" %}
 {% endwith %}
 
 void inst_neg(Thread* thread, Argument argument) {
@@ -305,33 +361,7 @@ void inst_pop(Thread* thread, Argument argument) {
 }
 
 void inst_push(Thread* thread, Argument argument) {
-  char* argumentString = argument.string;
-
-  if(strcmp(argumentString, "false") == 0) {
-    Stack_push(&(thread->stack), (Object){ BOOLEAN, false });
-  }else if(strcmp(argumentString, "pow") == 0) {
-    Object result;
-    result.type = BUILTIN;
-    result.value.builtin = POW;
-    Stack_push(&(thread->stack), result);
-  } else if(strcmp(argumentString, "print") == 0) {
-    Object result;
-    result.type = BUILTIN;
-    result.value.builtin = PRINT;
-    Stack_push(&(thread->stack), result);
-  } else if(strcmp(argumentString, "true") == 0) {
-    Stack_push(&(thread->stack), (Object){ BOOLEAN, true });
-  } else {
-    Environment_get_Result result = Environment_get(
-      Thread_getEnvironment(thread),
-      argumentString
-    );
-    if(!result.found) {
-      fprintf(stderr, "Variable `%s` not found", argumentString);
-      assert(false);
-    }
-    Stack_push(&(thread->stack), result.result);
-  }
+  Stack_push(&(thread->stack), lookupSymbol(thread, argument.string));
 }
 
 void inst_push_integer(Thread* thread, Argument argument) {
@@ -352,6 +382,7 @@ void inst_push_string(Thread* thread, Argument argument) {
 
 {% with name='sub', operation='-' %}
   {% include "arithmetic_instruction.c" %}
+  {% include "symbol_integer_instruction.c" %}
 {% endwith %}
 
 void inst_return(Thread* thread, Argument argument) {
@@ -369,6 +400,14 @@ void inst_return(Thread* thread, Argument argument) {
   free(returnFrame);
 }
 
+void inst_rot(Thread* thread, Argument argument) {
+  Stack_rotate(&(thread->stack));
+}
+
+void inst_swap(Thread* thread, Argument argument) {
+  Stack_swap(&(thread->stack));
+}
+
 struct Instruction;
 typedef const struct Instruction Instruction;
 struct Instruction {
@@ -381,8 +420,8 @@ struct Instruction {
 {% endfor %}
 
 const Instruction program[] = {
-{% for instruction in instruction_list %}
-  (Instruction){ inst_{{ instruction.instruction }}, (Argument){{ generate_argument(instruction) }} },
+{% for instruction, argument in instruction_list %}
+  (Instruction){ inst_{{ instruction }}, {{ argument }} },
 {% endfor %}
 };
 
@@ -391,6 +430,13 @@ int main() {
   Thread_initialize(&thread, LABEL___main__);
 
   for(; program[Thread_getProgramCounter(&thread)].instruction != inst_end; Thread_incrementProgramCounter(&thread)) {
+#ifdef TRACE
+    // Built with -DTRACE, prints the index of each instruction before it
+    // runs, for instruction_traces.py. stderr isn't buffered, so the trace
+    // is complete even if the program aborts.
+    fprintf(stderr, "trace %zu\n", Thread_getProgramCounter(&thread));
+#endif
+
     program[Thread_getProgramCounter(&thread)].instruction(
       &thread,
       program[Thread_getProgramCounter(&thread)].argument
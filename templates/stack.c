@@ -45,3 +45,31 @@ Object Stack_pop(Stack* self) {
   free(node);
   return result;
 }
+
+Object Stack_peek(Stack* self) {
+  assert(self->top != NULL);
+  return self->top->value;
+}
+
+// Swapping and rotating move the values between the nodes they're already
+// in, so that nothing is freed and allocated again
+
+void Stack_swap(Stack* self) {
+  assert(self->top != NULL && self->top->next != NULL);
+
+  Object top = self->top->value;
+  self->top->value = self->top->next->value;
+  self->top->next->value = top;
+}
+
+// Moves the third value from the top to the top
+void Stack_rotate(Stack* self) {
+  assert(self->top != NULL && self->top->next != NULL && self->top->next->next != NULL);
+
+  _StackNode* second = self->top->next;
+  _StackNode* third = second->next;
+  Object value = third->value;
+  third->value = second->value;
+  second->value = self->top->value;
+  self->top->value = value;
+}
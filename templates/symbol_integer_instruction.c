@@ -0,0 +1,10 @@
+void inst_{{ name }}_symbol_integer(struct Thread* thread, const union Argument argument) {
+  // Does what pushing the symbol, pushing the integer and {{ name }} would,
+  // without pushing either of them
+  Object result = lookupSymbol(thread, argument.symbolAndInteger.symbol);
+  assert(result.type == INTEGER);
+
+  result.value.integer = result.value.integer {{ operation }} argument.symbolAndInteger.integer;
+
+  Stack_push(&(thread->stack), result);
+}
@@ -1,5 +1,6 @@
 import collections
 import re
+import sys
 
 import util
 
@@ -12,7 +13,7 @@ Token = collections.namedtuple(
     ),
 )
 
-NodeMetadata = collections.namedtuple(
+NodeMetadata = util.node_type(
     'NodeMetadata',
     (
         'index',
@@ -20,33 +21,10 @@ NodeMetadata = collections.namedtuple(
     ),
 )
 
-def _make_token_matcher(definition):
-    name, regex = definition
-    regex_matcher = re.compile(regex)
-
-    def token_matcher(index, source, line):
-        match = regex_matcher.match(source[index:])
-
-        if match is None:
-            return False, index, None
-
-        return (
-            True,
-            index + len(match.group()),
-            Token(
-                type=name,
-                match=match.group(),
-                metadata=NodeMetadata(
-                    index=index,
-                    line=line,
-                ),
-            ),
-        )
-
-    return token_matcher
-
-_TOKEN_MATCHERS = [
-    ('keyword',                         r'(def|do|else|end|if|lambda)(?![a-z_])'),
+_TOKEN_DEFINITIONS = [
+    ('space',                           r' +'),
+    ('comment',                         r'#[^\n]*'),
+    ('keyword',                         r'(?:def|do|else|end|if|lambda)(?![a-z_])'),
     ('open_bracket',                    r'\['),
     ('close_bracket',                   r'\]'),
     ('open_parenthese',                 r'\('),
@@ -58,50 +36,105 @@ _TOKEN_MATCHERS = [
     ('symbol',                          r'[a-z_]+'),
     ('single_quoted_string_literal',    r"'.*?'"),
     ('double_quoted_string_literal',    r'".*?"'),
-    ('comparison_level_operator',       r'(<=|>=|==|!=|<|>)'),
+    ('comparison_level_operator',       r'(?:<=|>=|==|!=|<|>)'),
     ('assignment_operator',             r'='),
-    ('addition_level_operator',         r'(\+\+|\+|-)'),
-    ('multiplication_level_operator',   r'(\*|//|%)'),
+    ('addition_level_operator',         r'(?:\+\+|\+|-)'),
+    ('multiplication_level_operator',   r'(?:\*|//|%)'),
     ('newline',                         r'\n'),
 ]
 
-_TOKEN_MATCHERS = list(map(_make_token_matcher, _TOKEN_MATCHERS))
+# Matches are skipped rather than yielded as tokens
+_SKIPPED_TOKEN_TYPES = {'space', 'comment'}
 
-@util.force_generator(tuple)
-def tokenize(source):
+_INTERNED_TOKEN_TYPES = {'keyword', 'symbol'}
+
+# The alternatives are tried in order, so earlier definitions take priority
+# just as they would if each regex were tried separately
+_TOKEN_MATCHER = re.compile('|'.join(
+    '(?P<{}>{})'.format(name, regex)
+    for name, regex in _TOKEN_DEFINITIONS
+))
+
+def _tokenize_chunk(chunk, offset, line):
     index = 0
-    line = 1
+    match = _TOKEN_MATCHER.match
 
-    while index < len(source):
-        if source[index] == ' ':
-            index += 1
-            continue
+    while index < len(chunk):
+        token_match = match(chunk, index)
 
-        if source[index] == '#':
-            while index < len(source) and source[index] != '\n':
-                index += 1
+        if token_match is None:
+            raise Exception('Unexpected character "{}" on line {}'.format(
+                chunk[index],
+                line,
+            ))
 
-            continue
+        token_type = token_match.lastgroup
+        end = token_match.end()
 
-        success = False
+        if token_type not in _SKIPPED_TOKEN_TYPES:
+            text = chunk[index:end]
 
-        for matcher in _TOKEN_MATCHERS:
-            success, index, token = matcher(index, source, line)
+            # The tree keeps the text of every symbol, and programs use the same
+            # few names over and over, so share one copy of each
+            if token_type in _INTERNED_TOKEN_TYPES:
+                text = sys.intern(text)
 
-            if success:
-                yield token
-                break
+            # Positional arguments are noticeably faster here, and this runs once per token
+            yield Token(token_type, text, NodeMetadata(offset + index, line))
 
-        if not success:
-            raise Exception('Unexpected character "{}" on line {}'.format(
-                source[index],
-                line,
-            ))
+            if token_type == 'newline':
+                line += 1
+
+        index = end
 
-        if token.type == 'newline':
-            line += 1
+# A source which is part of a larger one can be tokenized with the offset and
+# line it starts at, so its tokens have the right metadata
+@util.force_generator(tuple)
+def tokenize(source, offset=0, line=1):
+    return _tokenize_chunk(source, offset, line)
+
+# Finds keywords without building tokens, for when all we need is the block
+# structure of a program. Comments and string literals are matched so that
+# the words in them are skipped.
+_KEYWORD_SCANNER = re.compile(r'''#[^\n]*|'.*?'|".*?"|(?P<word>[a-z_]+)''')
+
+def scan_keywords(source, keywords):
+    for scanned in _KEYWORD_SCANNER.finditer(source):
+        word = scanned.group('word')
+
+        if word in keywords:
+            yield word, scanned.start(), scanned.end()
+
+def _read_lines(source_file):
+    while True:
+        line = source_file.readline()
+
+        if not line:
+            return
+
+        # Binary files and mmaps give us bytes, so translate them the way a
+        # file opened in text mode would
+        if isinstance(line, bytes):
+            line = line.decode('utf-8').replace('\r\n', '\n')
+
+        yield line
+
+def tokenize_stream(source_file):
+    # No token spans a newline, so we never need to look further ahead than
+    # the end of the current line
+    offset = 0
+    line = 1
+
+    for chunk in _read_lines(source_file):
+        yield from _tokenize_chunk(chunk, offset, line)
+
+        offset += len(chunk)
+        line += 1
 
 if __name__ == '__main__':
+    import io
+    import mmap
+    import tempfile
     import unittest
 
     class TokenizeTests(unittest.TestCase):
@@ -111,8 +144,10 @@ if __name__ == '__main__':
                 (Token(
                     type='open_parenthese',
                     match='(',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -122,8 +157,10 @@ if __name__ == '__main__':
                 (Token(
                     type='close_parenthese',
                     match=')',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -133,8 +170,10 @@ if __name__ == '__main__':
                 (Token(
                     type='symbol',
                     match='print',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -144,8 +183,10 @@ if __name__ == '__main__':
                 (Token(
                     type='single_quoted_string_literal',
                     match="'Hello, world'",
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -155,8 +196,10 @@ if __name__ == '__main__':
                 (Token(
                     type='addition_level_operator',
                     match='+',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -166,8 +209,10 @@ if __name__ == '__main__':
                 (Token(
                     type='addition_level_operator',
                     match='-',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -177,8 +222,10 @@ if __name__ == '__main__':
                 (Token(
                     type='multiplication_level_operator',
                     match='*',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -188,8 +235,10 @@ if __name__ == '__main__':
                 (Token(
                     type='multiplication_level_operator',
                     match='//',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -199,8 +248,10 @@ if __name__ == '__main__':
                 (Token(
                     type='multiplication_level_operator',
                     match='%',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -210,8 +261,10 @@ if __name__ == '__main__':
                 (Token(
                     type='comma',
                     match=',',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -221,8 +274,10 @@ if __name__ == '__main__':
                 (Token(
                     type='assignment_operator',
                     match='=',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -232,8 +287,10 @@ if __name__ == '__main__':
                 (Token(
                     type='comparison_level_operator',
                     match='==',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -243,8 +300,10 @@ if __name__ == '__main__':
                 (Token(
                     type='comparison_level_operator',
                     match='>=',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -254,8 +313,10 @@ if __name__ == '__main__':
                 (Token(
                     type='comparison_level_operator',
                     match='<=',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -265,8 +326,10 @@ if __name__ == '__main__':
                 (Token(
                     type='comparison_level_operator',
                     match='>',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -276,8 +339,10 @@ if __name__ == '__main__':
                 (Token(
                     type='comparison_level_operator',
                     match='<',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -287,8 +352,10 @@ if __name__ == '__main__':
                 (Token(
                     type='comparison_level_operator',
                     match='!=',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -298,8 +365,10 @@ if __name__ == '__main__':
                 (Token(
                     type='newline',
                     match='\n',
-                    index=0,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -309,8 +378,10 @@ if __name__ == '__main__':
                 (Token(
                     type='symbol',
                     match='print',
-                    index=1,
-                    line=1,
+                    metadata=NodeMetadata(
+                        index=1,
+                        line=1,
+                    ),
                 ),),
             )
 
@@ -321,23 +392,97 @@ if __name__ == '__main__':
                     Token(
                         type='symbol',
                         match='print',
-                        index=0,
-                        line=1,
+                        metadata=NodeMetadata(
+                            index=0,
+                            line=1,
+                        ),
                     ),
                     Token(
                         type='newline',
                         match='\n',
-                        index=5,
-                        line=1,
+                        metadata=NodeMetadata(
+                            index=5,
+                            line=1,
+                        ),
                     ),
                     Token(
                         type='open_parenthese',
                         match='(',
-                        index=6,
-                        line=2,
+                        metadata=NodeMetadata(
+                            index=6,
+                            line=2,
+                        ),
+                    ),
+                ),
+            )
+
+        def test_skips_comments(self):
+            self.assertEqual(
+                tokenize('# comment\nprint'),
+                (
+                    Token(
+                        type='newline',
+                        match='\n',
+                        metadata=NodeMetadata(
+                            index=9,
+                            line=1,
+                        ),
+                    ),
+                    Token(
+                        type='symbol',
+                        match='print',
+                        metadata=NodeMetadata(
+                            index=10,
+                            line=2,
+                        ),
                     ),
                 ),
             )
 
+        def test_tokenizes_symbol_starting_with_keyword(self):
+            self.assertEqual(
+                tokenize('done'),
+                (Token(
+                    type='symbol',
+                    match='done',
+                    metadata=NodeMetadata(
+                        index=0,
+                        line=1,
+                    ),
+                ),),
+            )
+
+        def test_raises_on_unexpected_character(self):
+            with self.assertRaises(Exception):
+                tokenize('print\n@')
+
+    class TokenizeStreamTests(unittest.TestCase):
+        source = "# comment\nx = 'a'\n\nprint(x, 1 + 2)"
+
+        def test_tokenizes_file_like_objects_like_strings(self):
+            self.assertEqual(
+                tuple(tokenize_stream(io.StringIO(self.source))),
+                tokenize(self.source),
+            )
+
+        def test_tokenizes_mmaps_like_strings(self):
+            with tempfile.TemporaryFile() as f:
+                f.write(self.source.encode('utf-8'))
+                f.flush()
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    self.assertEqual(
+                        tuple(tokenize_stream(m)),
+                        tokenize(self.source),
+                    )
+
+        def test_tokenizes_lazily(self):
+            tokens = tokenize_stream(io.StringIO('print\n@'))
+
+            self.assertEqual(next(tokens).match, 'print')
+            self.assertEqual(next(tokens).match, '\n')
+
+            with self.assertRaises(Exception):
+                next(tokens)
 
     unittest.main()
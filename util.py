@@ -1,4 +1,7 @@
 import functools
+import operator
+import sys
+import types
 
 def force_generator(to_type):
     def decorator(generator_function):
@@ -10,6 +13,78 @@ def force_generator(to_type):
 
     return decorator
 
+# Runs a recursive computation on an explicit stack instead of the Python call
+# stack, so it isn't limited by the recursion limit. A step recurses by
+# yielding the generator for the sub-computation, and the yield evaluates to
+# that generator's return value. Yielding anything other than a generator
+# evaluates to the yielded value itself, which lets steps that never recurse
+# be plain functions.
+def trampoline(generator):
+    # The stack holds the send methods of the suspended generators, and the
+    # running one's is kept in a local, since this loop runs once per step
+    stack = []
+    send = generator.send
+    value = None
+    generator_type = types.GeneratorType
+
+    while True:
+        try:
+            child = send(value)
+        except StopIteration as stop:
+            if not stack:
+                return stop.value
+
+            send = stack.pop()
+            value = stop.value
+        else:
+            if type(child) is generator_type:
+                stack.append(send)
+                send = child.send
+                value = None
+            else:
+                value = child
+
+# Builds a class for tree nodes with the interface of collections.namedtuple
+# that the passes use: construction by position or keyword, attribute access,
+# equality, hashing, repr and _fields. The fields live in __slots__ rather
+# than in a tuple, which with no per-instance __dict__ makes every node a few
+# words smaller, and the passes build a lot of nodes.
+def node_type(typename, field_names):
+    field_names = tuple(field_names)
+    namespace = {}
+
+    # Generated like namedtuple's __new__, so that construction runs no
+    # Python code besides the assignments
+    exec('def __init__(self, {}):\n{}'.format(
+        ', '.join(field_names),
+        ''.join('    self.{0} = {0}\n'.format(name) for name in field_names),
+    ), namespace)
+
+    values = operator.attrgetter(*field_names)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and values(self) == values(other)
+
+    def __hash__(self):
+        return hash(values(self))
+
+    def __repr__(self):
+        return '{}({})'.format(
+            type(self).__name__,
+            ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in field_names),
+        )
+
+    return type(typename, (object,), {
+        '__slots__': field_names,
+        '__init__': namespace['__init__'],
+        '__eq__': __eq__,
+        '__hash__': __hash__,
+        '__repr__': __repr__,
+        '_fields': field_names,
+        # Lets pickle find the class, as namedtuple does
+        '__module__': sys._getframe(1).f_globals.get('__name__', '__main__'),
+    })
+
 if __name__ == '__main__':
     import unittest
 
@@ -22,4 +97,54 @@ if __name__ == '__main__':
                 [0, 1, 2, 3, 4, 5, 6, 7, 8, 9],
             )
 
+    class TrampolineTests(unittest.TestCase):
+        def test_returns_generator_return_value(self):
+            def answer():
+                return 42
+                yield
+
+            self.assertEqual(trampoline(answer()), 42)
+
+        def test_passes_non_generator_values_through(self):
+            def double(value):
+                value = yield value
+                return value * 2
+
+            self.assertEqual(trampoline(double(21)), 42)
+
+        def test_recurses_deeper_than_the_recursion_limit(self):
+            def depth(n):
+                if n == 0:
+                    return 0
+
+                return (yield depth(n - 1)) + 1
+
+            self.assertEqual(trampoline(depth(100000)), 100000)
+
+    Point = node_type('Point', ('x', 'y'))
+
+    class NodeTypeTests(unittest.TestCase):
+        def test_constructs_by_position_and_keyword(self):
+            self.assertEqual(Point(1, y=2), Point(x=1, y=2))
+            self.assertEqual((Point(1, 2).x, Point(1, 2).y), (1, 2))
+
+        def test_compares_by_type_and_fields(self):
+            Other = node_type('Other', ('x', 'y'))
+
+            self.assertNotEqual(Point(1, 2), Point(1, 3))
+            self.assertNotEqual(Point(1, 2), Other(1, 2))
+            self.assertEqual(hash(Point(1, 2)), hash(Point(1, 2)))
+
+        def test_reprs_like_namedtuple(self):
+            self.assertEqual(repr(Point(x=1, y='a')), "Point(x=1, y='a')")
+
+        def test_has_no_instance_dict(self):
+            with self.assertRaises(AttributeError):
+                Point(1, 2).__dict__
+
+        def test_pickles(self):
+            import pickle
+
+            self.assertEqual(pickle.loads(pickle.dumps(Point(1, (2, 3)))), Point(1, (2, 3)))
+
     unittest.main()